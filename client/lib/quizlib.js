@@ -777,7 +777,27 @@ module.exports = function Quiz(rawLocalStorage, ajaxApi) {
                         // Trigger the lecture data to be cached, update all stats
                         progressFn(1, 3, "Fetching questions...");
                         return self._getQuestionData(curLecture).then(function (all_qns) {
-                            curLecture.questions = all_qns.stats;
+                            var liveStats = {};
+
+                            // Cached material doesn't have up-to-date answer counts, prefer the lecture's
+                            (newLecture.questions || []).map(function (qn) {
+                                liveStats[qn.uri] = qn;
+                            });
+                            curLecture.questions = all_qns.stats.map(function (qn) {
+                                var out = {};
+
+                                Object.keys(qn).map(function (k) {
+                                    out[k] = qn[k];
+                                });
+                                if (liveStats[qn.uri]) {
+                                    out.chosen = liveStats[qn.uri].chosen;
+                                    out.correct = liveStats[qn.uri].correct;
+                                } else if (!out.hasOwnProperty('chosen')) {
+                                    out.chosen = out.initial_answered;
+                                    out.correct = out.initial_correct;
+                                }
+                                return out;
+                            });
                             return curLecture;
                         });
                     }
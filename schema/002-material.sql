@@ -35,6 +35,73 @@ COMMENT ON COLUMN material_source.next_material_source_id IS
     'This bank/path/revision has been superseded by this one, i.e. this one should be ignored';
 
 
+CREATE TABLE IF NOT EXISTS material_bank_file (
+    bank                     TEXT NOT NULL,
+    path                     TEXT NOT NULL,
+    PRIMARY KEY (bank, path),
+
+    size                     BIGINT NOT NULL,
+    mtime_ns                 BIGINT NOT NULL,
+    md5sum                   TEXT NOT NULL
+);
+COMMENT ON TABLE  material_bank_file IS 'Index of material files seen by the last scan, to know which need re-reading';
+COMMENT ON COLUMN material_bank_file.mtime_ns IS 'File modification time, in nanoseconds since epoch';
+CREATE TABLE IF NOT EXISTS material_bank_scan (
+    bank                     TEXT PRIMARY KEY,
+
+    git_commit               TEXT NULL,
+    scan_time_ns             BIGINT NOT NULL,
+    lastupdate               TIMESTAMP NOT NULL DEFAULT NOW()
+);
+SELECT ddl_lastupdate_trigger('material_bank_scan');
+COMMENT ON TABLE  material_bank_scan IS 'When each material bank was last scanned';
+COMMENT ON COLUMN material_bank_scan.git_commit IS 'HEAD of the material bank at the time of the scan, if a git repository';
+COMMENT ON COLUMN material_bank_scan.scan_time_ns IS 'When the scan started, in nanoseconds since epoch';
+
+
+CREATE TABLE IF NOT EXISTS material_render_cache (
+    material_source_id       INTEGER NOT NULL,
+    FOREIGN KEY (material_source_id) REFERENCES material_source(material_source_id) ON DELETE CASCADE,
+    permutation              INTEGER NOT NULL,
+    dataframe_hash           TEXT NOT NULL,
+    PRIMARY KEY (material_source_id, permutation, dataframe_hash),
+
+    rendered                 JSONB NOT NULL,
+    last_used                TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS material_render_cache_last_used ON material_render_cache(last_used);
+COMMENT ON TABLE  material_render_cache IS 'Rendered question permutations, so we do not have to re-run R';
+COMMENT ON COLUMN material_render_cache.dataframe_hash IS 'Hash of the student dataframes the question was rendered with';
+COMMENT ON COLUMN material_render_cache.last_used IS 'When this entry was last used (to the nearest hour), for LRU eviction';
+CREATE OR REPLACE FUNCTION material_render_cache_invalidate_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- Superseded material won't be rendered again, forget about it
+   DELETE FROM material_render_cache WHERE material_source_id = NEW.material_source_id;
+   RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS material_render_cache_invalidate on material_source;
+CREATE TRIGGER material_render_cache_invalidate AFTER UPDATE OF md5sum, next_material_source_id ON material_source
+    FOR EACH ROW WHEN (NEW.next_material_source_id IS NOT NULL OR OLD.md5sum IS DISTINCT FROM NEW.md5sum)
+    EXECUTE PROCEDURE material_render_cache_invalidate_fn();
+CREATE OR REPLACE FUNCTION material_render_cache_evict(max_entries INTEGER) RETURNS INTEGER AS $$
+DECLARE
+   evicted INTEGER;
+BEGIN
+   -- Remove least-recently-used entries until we are within max_entries
+   DELETE FROM material_render_cache
+    WHERE ctid IN (
+        SELECT ctid
+          FROM material_render_cache
+      ORDER BY last_used
+         LIMIT GREATEST((SELECT COUNT(*) FROM material_render_cache) - max_entries, 0));
+   GET DIAGNOSTICS evicted = ROW_COUNT;
+   RETURN evicted;
+END;
+$$ LANGUAGE 'plpgsql';
+COMMENT ON FUNCTION material_render_cache_evict(INTEGER) IS 'Trim material_render_cache down to max_entries, oldest first';
+
+
 CREATE OR REPLACE VIEW all_material_tags AS
     SELECT DISTINCT UNNEST(material_tags) FROM material_source;
 COMMENT ON VIEW all_material_tags IS 'All currently used material_tags';
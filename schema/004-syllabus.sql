@@ -58,6 +58,19 @@ COMMENT ON COLUMN stage.stage_setting_spec IS 'dict of setting key to a combinat
     '...or "variant:registered", and another set of values below it'
     '...or "deleted", if this stage is now removed';
 COMMENT ON COLUMN stage.next_stage_id IS 'The replacement stage_id, or NULL if this field is current';
+
+CREATE TABLE IF NOT EXISTS stage_lineage (
+    stage_id                 INTEGER PRIMARY KEY,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id),
+    latest_stage_id          INTEGER NOT NULL,
+    FOREIGN KEY (latest_stage_id) REFERENCES stage(stage_id),
+    version                  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stage_lineage_latest_stage_id ON stage_lineage(latest_stage_id);
+COMMENT ON TABLE  stage_lineage IS 'Every stage revision, by the latest stage ID, maintained by stage triggers';
+COMMENT ON COLUMN stage_lineage.latest_stage_id IS 'The current revision of this stage';
+COMMENT ON COLUMN stage_lineage.version IS 'Numeric version of this revision, starting at 1';
+
 CREATE OR REPLACE FUNCTION stage_next_stage_id_before_insert_fn() RETURNS TRIGGER AS $$
 BEGIN
    NEW.next_stage_id := NULL;
@@ -77,6 +90,18 @@ BEGIN
        AND stage_name = NEW.stage_name
        AND stage_id != NEW.stage_id
        AND next_stage_id IS NULL;
+
+   -- All old versions are now a revision of us
+   UPDATE stage_lineage
+       SET latest_stage_id = NEW.stage_id
+       WHERE latest_stage_id IN (
+           SELECT stage_id
+             FROM stage
+            WHERE syllabus_id = NEW.syllabus_id
+              AND stage_name = NEW.stage_name
+              AND stage_id != NEW.stage_id);
+   INSERT INTO stage_lineage (stage_id, latest_stage_id, version)
+        VALUES (NEW.stage_id, NEW.stage_id, NEW.version);
    RETURN NEW;
 END;
 $$ LANGUAGE 'plpgsql';
@@ -84,30 +109,50 @@ DROP TRIGGER IF EXISTS stage_next_stage_id_after_insert on stage;
 CREATE TRIGGER stage_next_stage_id_after_insert AFTER INSERT ON stage FOR EACH ROW EXECUTE PROCEDURE stage_next_stage_id_after_insert_fn();
 
 
+DO
+$$
+BEGIN
+    IF EXISTS(SELECT * FROM stage s LEFT JOIN stage_lineage sl ON sl.stage_id = s.stage_id WHERE sl.stage_id IS NULL) THEN
+        -- Populate from existing stages, walking next_stage_id back from each current version
+        INSERT INTO stage_lineage (stage_id, latest_stage_id, version)
+            WITH RECURSIVE asv(v, stage_id, latest_stage_id) AS (
+                SELECT 0 v
+                     , stage.stage_id
+                     , stage.stage_id latest_stage_id
+                  FROM stage
+                 WHERE next_stage_id IS NULL
+                    UNION ALL
+                SELECT (asv.v + 1) v
+                     , stage.stage_id
+                     , asv.latest_stage_id latest_stage_id
+                  FROM stage
+                     , asv
+                 WHERE stage.next_stage_id = asv.stage_id
+            )
+            SELECT stage_id
+                 , latest_stage_id
+                 , COUNT(*) OVER (PARTITION BY latest_stage_id)::INT - v
+              FROM asv
+        ON CONFLICT (stage_id) DO NOTHING;
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+
+
 CREATE OR REPLACE VIEW all_stage_versions AS
-    WITH RECURSIVE all_stage_versions(v, stage_id, syllabus_id, stage_name, latest_stage_id, next_stage_id) AS (
-        SELECT 0 v
-             , stage.stage_id
-             , stage.syllabus_id
-             , stage.stage_name
-             , stage.stage_id latest_stage_id
-             , stage.next_stage_id
-          FROM stage
-         WHERE next_stage_id IS NULL
-            UNION ALL
-        SELECT (all_stage_versions.v + 1) v
-             , stage.stage_id
-             , stage.syllabus_id
-             , stage.stage_name
-             , all_stage_versions.latest_stage_id latest_stage_id
-             , stage.next_stage_id
-          FROM stage
-             , all_stage_versions
-         WHERE stage.next_stage_id = all_stage_versions.stage_id
-    )
-    SELECT COUNT(*) OVER (PARTITION BY all_stage_versions.latest_stage_id)::INT - all_stage_versions.v AS v
-         , stage_id, syllabus_id, stage_name, latest_stage_id, next_stage_id FROM all_stage_versions;
+    SELECT sl.version v
+         , s.stage_id
+         , s.syllabus_id
+         , s.stage_name
+         , sl.latest_stage_id
+         , s.next_stage_id
+      FROM stage s
+      JOIN stage_lineage sl ON sl.stage_id = s.stage_id;
 COMMENT ON VIEW all_stage_versions IS 'IDs of all stage revisions, by the latest stage ID, with a numeric version';
+CREATE OR REPLACE FUNCTION stage_latest_id(in_stage_id INTEGER) RETURNS INTEGER AS $$
+    SELECT latest_stage_id FROM stage_lineage WHERE stage_id = in_stage_id;
+$$ LANGUAGE 'sql' STABLE;
+COMMENT ON FUNCTION stage_latest_id(INTEGER) IS 'The latest stage_id for any revision of a stage';
 
 CREATE TABLE IF NOT EXISTS stage_setting (
     stage_id                 INTEGER NOT NULL,
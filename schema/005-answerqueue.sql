@@ -36,29 +36,270 @@ COMMENT ON COLUMN answer.student_answer IS 'The student_answer object, i.e. the
 COMMENT ON COLUMN answer.review IS 'The students review of the material, if they did one';
 
 
-CREATE OR REPLACE VIEW answer_stats AS
-    SELECT a.stage_id
-         , a.material_source_id
-         , a.permutation
-         , COUNT(*) answered
-         , COUNT(NULLIF(a.correct, false)) correct
-    FROM answer a
-    GROUP BY 1, 2, 3;
-COMMENT ON VIEW answer_stats IS 'Answer stats for each stage/material_source/permutation combo';
-
-
-CREATE OR REPLACE VIEW stage_material AS
-    SELECT s.stage_id
-         , ms.material_source_id
-         , GENERATE_SERIES(1, ms.permutation_count) "permutation"
-         , ms.initial_answered
-         , ms.initial_correct
-    FROM stage s
-    JOIN material_source ms
-      ON s.material_tags <@ ms.material_tags
-    WHERE ms.next_material_source_id IS NULL
-      AND s.next_stage_id IS NULL;
-COMMENT ON VIEW stage_material IS 'All appropriate current material for all current stages, and their stats';
+CREATE TABLE IF NOT EXISTS answer_grade_hwm (
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id),
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id),
+    PRIMARY KEY (user_id, stage_id),
+
+    grade_hwm                NUMERIC(5, 3) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answer_grade_hwm_stage_id ON answer_grade_hwm(stage_id);  -- For re-pointing at new stage versions
+COMMENT ON TABLE  answer_grade_hwm IS 'Highest grade each student has reached in each stage, maintained by triggers';
+COMMENT ON COLUMN answer_grade_hwm.stage_id IS 'The latest version of the stage, includes answers against older versions';
+CREATE OR REPLACE FUNCTION answer_grade_hwm_after_insert_fn() RETURNS TRIGGER AS $$
+BEGIN
+   IF NEW.user_id IS NULL THEN
+       RETURN NEW;
+   END IF;
+   INSERT INTO answer_grade_hwm (user_id, stage_id, grade_hwm)
+        VALUES (NEW.user_id, stage_latest_id(NEW.stage_id), NEW.grade)
+   ON CONFLICT (user_id, stage_id) DO UPDATE
+           SET grade_hwm = GREATEST(answer_grade_hwm.grade_hwm, EXCLUDED.grade_hwm);
+   RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_grade_hwm_after_insert on answer;
+CREATE TRIGGER answer_grade_hwm_after_insert AFTER INSERT OR UPDATE OF grade, stage_id ON answer FOR EACH ROW EXECUTE PROCEDURE answer_grade_hwm_after_insert_fn();
+CREATE OR REPLACE FUNCTION answer_grade_hwm_stage_after_insert_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- High-water-marks for old versions now belong to us
+   UPDATE answer_grade_hwm
+       SET stage_id = NEW.stage_id
+       WHERE stage_id IN (
+           SELECT stage_id
+             FROM stage
+            WHERE syllabus_id = NEW.syllabus_id
+              AND stage_name = NEW.stage_name
+              AND stage_id != NEW.stage_id);
+   RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_grade_hwm_stage_after_insert on stage;
+CREATE TRIGGER answer_grade_hwm_stage_after_insert AFTER INSERT ON stage FOR EACH ROW EXECUTE PROCEDURE answer_grade_hwm_stage_after_insert_fn();
+DO
+$$
+BEGIN
+    IF NOT EXISTS(SELECT * FROM answer_grade_hwm) THEN
+        -- Populate from existing answers
+        INSERT INTO answer_grade_hwm (user_id, stage_id, grade_hwm)
+            SELECT a.user_id, asv.latest_stage_id, MAX(a.grade)
+              FROM answer a, all_stage_versions asv
+             WHERE a.stage_id = asv.stage_id
+               AND a.user_id IS NOT NULL
+             GROUP BY 1, 2;
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+
+
+DO
+$$
+BEGIN
+    -- answer_stats used to be a view, replace it with the table below
+    IF EXISTS(SELECT * FROM information_schema.views WHERE table_schema = 'public' AND table_name = 'answer_stats') THEN
+        DROP VIEW answer_stats;
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+CREATE TABLE IF NOT EXISTS answer_stats (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id),
+    material_source_id       INTEGER NOT NULL,
+    permutation              INTEGER NOT NULL,
+    PRIMARY KEY (stage_id, material_source_id, permutation),
+
+    answered                 INTEGER NOT NULL DEFAULT 0,
+    correct                  INTEGER NOT NULL DEFAULT 0
+);
+COMMENT ON TABLE  answer_stats IS 'Answer stats for each stage/material_source/permutation combo, maintained by triggers';
+COMMENT ON COLUMN answer_stats.answered IS 'Number of answers to this question';
+COMMENT ON COLUMN answer_stats.correct IS 'Number of answers marked correct, for UG content whether the verdict is correct';
+CREATE OR REPLACE FUNCTION answer_stats_rebuild() RETURNS VOID AS $$
+BEGIN
+   DELETE FROM answer_stats;
+   INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+       SELECT a.stage_id
+            , a.material_source_id
+            , a.permutation
+            , COUNT(*) answered
+            , COUNT(NULLIF(a.correct, false)) correct
+         FROM answer a
+        WHERE a.material_source_id IS NOT NULL
+          AND a.permutation IS NOT NULL
+     GROUP BY 1, 2, 3;
+END;
+$$ LANGUAGE 'plpgsql';
+COMMENT ON FUNCTION answer_stats_rebuild() IS 'Regenerate answer_stats from scratch';
+CREATE OR REPLACE FUNCTION answer_stats_answer_after_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- Sum up the whole statement's changes per question, then apply them in key order.
+   -- Concurrent syncs then lock answer_stats rows in the same order, so can't deadlock
+   IF TG_OP = 'INSERT' THEN
+       INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+           SELECT n.stage_id
+                , n.material_source_id
+                , n.permutation
+                , COUNT(*) answered
+                , COUNT(NULLIF(n.correct, false)) correct
+             FROM answer_new n
+            WHERE n.material_source_id IS NOT NULL
+              AND n.permutation IS NOT NULL
+         GROUP BY 1, 2, 3
+         ORDER BY 1, 2, 3
+       ON CONFLICT (stage_id, material_source_id, permutation) DO UPDATE
+               SET answered = answer_stats.answered + EXCLUDED.answered
+                 , correct = answer_stats.correct + EXCLUDED.correct;
+
+   ELSIF TG_OP = 'DELETE' THEN
+       INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+           SELECT o.stage_id
+                , o.material_source_id
+                , o.permutation
+                , -COUNT(*) answered
+                , -COUNT(NULLIF(o.correct, false)) correct
+             FROM answer_old o
+            WHERE o.material_source_id IS NOT NULL
+              AND o.permutation IS NOT NULL
+         GROUP BY 1, 2, 3
+         ORDER BY 1, 2, 3
+       ON CONFLICT (stage_id, material_source_id, permutation) DO UPDATE
+               SET answered = answer_stats.answered + EXCLUDED.answered
+                 , correct = answer_stats.correct + EXCLUDED.correct;
+
+   ELSIF TG_OP = 'UPDATE' THEN
+       INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+           SELECT d.stage_id
+                , d.material_source_id
+                , d.permutation
+                , SUM(d.answered) answered
+                , SUM(d.correct) correct
+             FROM (
+                   SELECT n.stage_id, n.material_source_id, n.permutation, 1 answered, CASE WHEN n.correct THEN 1 ELSE 0 END correct
+                     FROM answer_new n
+                UNION ALL
+                   SELECT o.stage_id, o.material_source_id, o.permutation, -1 answered, CASE WHEN o.correct THEN -1 ELSE 0 END correct
+                     FROM answer_old o
+             ) d
+            WHERE d.material_source_id IS NOT NULL
+              AND d.permutation IS NOT NULL
+         GROUP BY 1, 2, 3
+           HAVING SUM(d.answered) <> 0 OR SUM(d.correct) <> 0  -- i.e. something that affects stats changed
+         ORDER BY 1, 2, 3
+       ON CONFLICT (stage_id, material_source_id, permutation) DO UPDATE
+               SET answered = answer_stats.answered + EXCLUDED.answered
+                 , correct = answer_stats.correct + EXCLUDED.correct;
+   END IF;
+
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_stats_answer_after on answer;
+DROP TRIGGER IF EXISTS answer_stats_answer_insert on answer;
+CREATE TRIGGER answer_stats_answer_insert AFTER INSERT ON answer REFERENCING NEW TABLE AS answer_new FOR EACH STATEMENT EXECUTE PROCEDURE answer_stats_answer_after_fn();
+DROP TRIGGER IF EXISTS answer_stats_answer_update on answer;
+CREATE TRIGGER answer_stats_answer_update AFTER UPDATE ON answer REFERENCING OLD TABLE AS answer_old NEW TABLE AS answer_new FOR EACH STATEMENT EXECUTE PROCEDURE answer_stats_answer_after_fn();
+DROP TRIGGER IF EXISTS answer_stats_answer_delete on answer;
+CREATE TRIGGER answer_stats_answer_delete AFTER DELETE ON answer REFERENCING OLD TABLE AS answer_old FOR EACH STATEMENT EXECUTE PROCEDURE answer_stats_answer_after_fn();
+DO
+$$
+BEGIN
+    IF NOT EXISTS(SELECT * FROM answer_stats) THEN
+        -- Populate from existing answers
+        PERFORM answer_stats_rebuild();
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+
+
+DO
+$$
+BEGIN
+    -- stage_material used to be a view, replace it with the table below
+    IF EXISTS(SELECT * FROM information_schema.views WHERE table_schema = 'public' AND table_name = 'stage_material') THEN
+        DROP VIEW stage_material;
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+CREATE TABLE IF NOT EXISTS stage_material (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    material_source_id       INTEGER NOT NULL,
+    FOREIGN KEY (material_source_id) REFERENCES material_source(material_source_id) ON DELETE CASCADE,
+    permutation              INTEGER NOT NULL,
+    PRIMARY KEY (stage_id, material_source_id, permutation),
+
+    initial_answered         INTEGER NOT NULL DEFAULT 0,
+    initial_correct          INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS stage_material_material_source_id ON stage_material(material_source_id);
+COMMENT ON TABLE  stage_material IS 'All appropriate current material for all current stages, and their stats, maintained by triggers';
+CREATE OR REPLACE FUNCTION stage_material_refresh_stage(in_stage_id INTEGER) RETURNS VOID AS $$
+BEGIN
+   DELETE FROM stage_material WHERE stage_id = in_stage_id;
+   INSERT INTO stage_material (stage_id, material_source_id, permutation, initial_answered, initial_correct)
+       SELECT s.stage_id
+            , ms.material_source_id
+            , GENERATE_SERIES(1, ms.permutation_count) "permutation"
+            , ms.initial_answered
+            , ms.initial_correct
+         FROM stage s
+         JOIN material_source ms
+           ON s.material_tags <@ ms.material_tags
+        WHERE s.stage_id = in_stage_id
+          AND ms.next_material_source_id IS NULL
+          AND s.next_stage_id IS NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+COMMENT ON FUNCTION stage_material_refresh_stage(INTEGER) IS 'Recalculate stage_material for a stage';
+CREATE OR REPLACE FUNCTION stage_material_refresh_material(in_material_source_id INTEGER) RETURNS VOID AS $$
+BEGIN
+   DELETE FROM stage_material WHERE material_source_id = in_material_source_id;
+   INSERT INTO stage_material (stage_id, material_source_id, permutation, initial_answered, initial_correct)
+       SELECT s.stage_id
+            , ms.material_source_id
+            , GENERATE_SERIES(1, ms.permutation_count) "permutation"
+            , ms.initial_answered
+            , ms.initial_correct
+         FROM material_source ms
+         JOIN stage s
+           ON s.material_tags <@ ms.material_tags
+        WHERE ms.material_source_id = in_material_source_id
+          AND ms.next_material_source_id IS NULL
+          AND s.next_stage_id IS NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+COMMENT ON FUNCTION stage_material_refresh_material(INTEGER) IS 'Recalculate stage_material for a material_source';
+CREATE OR REPLACE FUNCTION stage_material_stage_after_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- New stages need their material, superseded stages should lose theirs
+   PERFORM stage_material_refresh_stage(NEW.stage_id);
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_material_stage_after on stage;
+CREATE TRIGGER stage_material_stage_after AFTER INSERT OR UPDATE OF material_tags, next_stage_id ON stage FOR EACH ROW EXECUTE PROCEDURE stage_material_stage_after_fn();
+CREATE OR REPLACE FUNCTION stage_material_material_source_after_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- New material should be added to stages, superseded material removed
+   PERFORM stage_material_refresh_material(NEW.material_source_id);
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_material_material_source_after on material_source;
+CREATE TRIGGER stage_material_material_source_after AFTER INSERT OR UPDATE OF material_tags, permutation_count, initial_answered, initial_correct, next_material_source_id ON material_source FOR EACH ROW EXECUTE PROCEDURE stage_material_material_source_after_fn();
+DO
+$$
+BEGIN
+    IF NOT EXISTS(SELECT * FROM stage_material) THEN
+        -- Populate from existing stages
+        PERFORM stage_material_refresh_stage(s.stage_id)
+           FROM stage s
+          WHERE s.next_stage_id IS NULL;
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
 
 
 CREATE OR REPLACE VIEW stage_material_sources AS
@@ -71,18 +312,143 @@ CREATE OR REPLACE VIEW stage_material_sources AS
 COMMENT ON VIEW stage_material_sources IS 'All appropriate material for all stages, including historical';
 
 
-CREATE OR REPLACE VIEW stage_ugmaterial AS
-    SELECT DISTINCT ON (CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END)
-    a.*
-    , JSONB_AGG(JSONB_BUILD_ARRAY(user_id, review)) OVER curqn AS reviews
-    FROM answer a
-    WINDOW curqn AS (
-        -- i.e. all rows dealing with the current question
-        PARTITION BY CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END
-        ORDER BY CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END, a.time_end, a.answer_id
-        ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
-    )
-    ORDER BY CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END, a.time_end, a.answer_id;
-COMMENT ON VIEW stage_ugmaterial IS 'All user-generated content and reviews against them';
+DO
+$$
+BEGIN
+    -- stage_ugmaterial used to be a view, replace it with the table below
+    IF EXISTS(SELECT * FROM information_schema.views WHERE table_schema = 'public' AND table_name = 'stage_ugmaterial') THEN
+        DROP VIEW stage_ugmaterial;
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+CREATE TABLE IF NOT EXISTS stage_ugmaterial (
+    answer_id                INTEGER PRIMARY KEY,
+    FOREIGN KEY (answer_id) REFERENCES answer(answer_id) ON DELETE CASCADE,
+
+    stage_id                 INTEGER NOT NULL,
+    material_source_id       INTEGER,
+    user_id                  INTEGER,
+    time_end                 TIMESTAMP WITHOUT TIME ZONE,  -- NB: Always UTC
+    correct                  BOOLEAN NULL,
+
+    reviews                  JSONB NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS stage_ugmaterial_material_source_id ON stage_ugmaterial(material_source_id);
+CREATE INDEX IF NOT EXISTS stage_ugmaterial_user_id ON stage_ugmaterial(user_id);
+CREATE INDEX IF NOT EXISTS answer_ug_review ON answer((0 - permutation)) WHERE permutation < 0;  -- For finding reviews of UG material
+COMMENT ON TABLE  stage_ugmaterial IS 'All user-generated content and reviews against them, maintained by triggers';
+COMMENT ON COLUMN stage_ugmaterial.answer_id IS 'The answer that wrote the content, reviews have a permutation of 0 - answer_id';
+COMMENT ON COLUMN stage_ugmaterial.user_id IS 'The author of the content';
+COMMENT ON COLUMN stage_ugmaterial.correct IS 'Verdict on the content, copied from the author''s answer';
+COMMENT ON COLUMN stage_ugmaterial.reviews IS 'Array of [user_id, review] for the author and all reviewers, oldest first';
+CREATE OR REPLACE FUNCTION stage_ugmaterial_reviews(in_answer_id INTEGER) RETURNS JSONB AS $$
+BEGIN
+   RETURN (SELECT JSONB_AGG(JSONB_BUILD_ARRAY(r.user_id, r.review) ORDER BY r.time_end, r.answer_id)
+             FROM (SELECT user_id, review, time_end, answer_id
+                     FROM answer
+                    WHERE answer_id = in_answer_id
+                UNION ALL
+                   SELECT user_id, review, time_end, answer_id
+                     FROM answer
+                    WHERE permutation < 0
+                      AND 0 - permutation = in_answer_id) r);
+END;
+$$ LANGUAGE 'plpgsql' STABLE;
+COMMENT ON FUNCTION stage_ugmaterial_reviews(INTEGER) IS 'Array of [user_id, review] for the content written by answer_id and all reviews of it';
+CREATE OR REPLACE FUNCTION stage_ugmaterial_refresh(in_answer_id INTEGER) RETURNS VOID AS $$
+BEGIN
+   -- NB: Upsert rather than DELETE/INSERT, so concurrent reviews of the same content wait on the row lock instead of failing
+   INSERT INTO stage_ugmaterial (answer_id, stage_id, material_source_id, user_id, time_end, correct, reviews)
+       SELECT a.answer_id
+            , a.stage_id
+            , a.material_source_id
+            , a.user_id
+            , a.time_end
+            , a.correct
+            , stage_ugmaterial_reviews(a.answer_id)
+         FROM answer a
+         JOIN material_source ms ON ms.material_source_id = a.material_source_id
+        WHERE a.answer_id = in_answer_id
+          AND a.permutation >= 0
+          AND 'type.template' = ANY(ms.material_tags)
+   ON CONFLICT (answer_id) DO UPDATE
+           SET stage_id = EXCLUDED.stage_id
+             , material_source_id = EXCLUDED.material_source_id
+             , user_id = EXCLUDED.user_id
+             , time_end = EXCLUDED.time_end
+             , correct = EXCLUDED.correct
+             , reviews = EXCLUDED.reviews;
+   IF NOT FOUND THEN
+       -- Answer is gone, or no longer user-generated content
+       DELETE FROM stage_ugmaterial WHERE answer_id = in_answer_id;
+       RETURN;
+   END IF;
+
+   -- A concurrent review may have committed whilst we waited for the row lock, re-read with a fresh snapshot
+   UPDATE stage_ugmaterial
+      SET reviews = stage_ugmaterial_reviews(in_answer_id)
+    WHERE answer_id = in_answer_id
+      AND reviews IS DISTINCT FROM stage_ugmaterial_reviews(in_answer_id);
+END;
+$$ LANGUAGE 'plpgsql';
+COMMENT ON FUNCTION stage_ugmaterial_refresh(INTEGER) IS 'Recalculate stage_ugmaterial for the content written by answer_id';
+CREATE OR REPLACE FUNCTION stage_ugmaterial_answer_after_fn() RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_OP = 'DELETE' THEN
+       PERFORM stage_ugmaterial_refresh(CASE WHEN OLD.permutation < 0 THEN 0 - OLD.permutation ELSE OLD.answer_id END);
+       RETURN OLD;
+   END IF;
+   -- Either we are the content, or a review of it
+   PERFORM stage_ugmaterial_refresh(CASE WHEN NEW.permutation < 0 THEN 0 - NEW.permutation ELSE NEW.answer_id END);
+   RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_ugmaterial_answer_after on answer;
+CREATE TRIGGER stage_ugmaterial_answer_after AFTER INSERT OR DELETE OR UPDATE OF user_id, time_end, correct, review ON answer FOR EACH ROW EXECUTE PROCEDURE stage_ugmaterial_answer_after_fn();
+DO
+$$
+BEGIN
+    IF NOT EXISTS(SELECT * FROM stage_ugmaterial) THEN
+        -- Populate from existing answers
+        PERFORM stage_ugmaterial_refresh(a.answer_id)
+           FROM answer a
+           JOIN material_source ms ON ms.material_source_id = a.material_source_id
+          WHERE a.permutation >= 0
+            AND 'type.template' = ANY(ms.material_tags);
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+
+
+CREATE TABLE IF NOT EXISTS allocation_selection (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id) ON DELETE CASCADE,
+    PRIMARY KEY (stage_id, user_id),
+
+    selection_key            TEXT NOT NULL,
+    material_source_ids      INTEGER[] NOT NULL,
+    permutations             INTEGER[] NOT NULL
+);
+COMMENT ON TABLE  allocation_selection IS 'Material chosen for a student by the server-side allocation, where it cannot be regenerated from the seed alone';
+COMMENT ON COLUMN allocation_selection.selection_key IS 'Seed, refresh bucket & stage material hash this selection was made for';
+COMMENT ON COLUMN allocation_selection.material_source_ids IS 'Chosen material, paired with permutations';
+
+
+CREATE TABLE IF NOT EXISTS exam_paper (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    paper                    INTEGER NOT NULL,
+    PRIMARY KEY (stage_id, paper),
+
+    material_source_ids      INTEGER[] NOT NULL,
+    permutations             INTEGER[] NOT NULL
+);
+COMMENT ON TABLE  exam_paper IS 'Pre-generated papers for exam stages, students sit paper (allocation_seed % exam_papers). Fixed once generated, material changes do not alter them';
+COMMENT ON COLUMN exam_paper.material_source_ids IS 'Material in paper, paired with permutations';
+-- Papers stay fixed once issued, only regenerated explicitly (see exam_papers script)
+DROP TRIGGER IF EXISTS exam_paper_stage_material_after on stage_material;
+DROP FUNCTION IF EXISTS exam_paper_stage_material_after_fn();
 
 COMMIT;
@@ -13,4 +13,41 @@ CREATE TABLE IF NOT EXISTS student_dataframe (
 );
 
 
+CREATE TABLE IF NOT EXISTS stage_material_response (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id) ON DELETE CASCADE,
+    PRIMARY KEY (stage_id, user_id),
+
+    material_hash            TEXT NOT NULL,
+    etag                     TEXT NOT NULL,
+    body                     TEXT NOT NULL
+);
+COMMENT ON TABLE  stage_material_response IS 'Most recent /stage/material response for a student, served again whilst material_hash matches';
+COMMENT ON COLUMN stage_material_response.material_hash IS 'Hash of the allocation''s material selection this response was generated for';
+COMMENT ON COLUMN stage_material_response.etag IS 'Strong ETag for body, i.e. the SHA1 of its content';
+CREATE OR REPLACE FUNCTION stage_material_response_dataframe_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- Student's data changed, so will the rendered questions
+   DELETE FROM stage_material_response WHERE user_id = COALESCE(NEW.user_id, OLD.user_id);
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_material_response_dataframe on student_dataframe;
+CREATE TRIGGER stage_material_response_dataframe AFTER INSERT OR UPDATE OR DELETE ON student_dataframe
+    FOR EACH ROW EXECUTE PROCEDURE stage_material_response_dataframe_fn();
+CREATE OR REPLACE FUNCTION stage_material_response_material_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- Material was replaced in-place, no way of knowing who has it so forget everything
+   DELETE FROM stage_material_response;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_material_response_material on material_source;
+CREATE TRIGGER stage_material_response_material AFTER UPDATE OF md5sum ON material_source
+    FOR EACH ROW WHEN (OLD.md5sum IS DISTINCT FROM NEW.md5sum)
+    EXECUTE PROCEDURE stage_material_response_material_fn();
+
+
 COMMIT;
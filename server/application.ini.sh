@@ -39,6 +39,15 @@ EOF
 # Fish out all smileycoin settings from the environment
 set 2>&1 | grep -E '^APP_SMILEYCOIN_' | sed 's/APP_SMILEYCOIN_/smileycoin./g' | sed "s/'//g" >> ${OUTFILE}
 
+# Fish out all rst cache settings from the environment
+set 2>&1 | grep -E '^APP_RST_' | sed 's/APP_RST_/rst./g' | sed "s/'//g" >> ${OUTFILE}
+
+# Fish out all R render pool settings from the environment
+set 2>&1 | grep -E '^APP_R_RENDER_' | sed 's/APP_R_RENDER_/r_render./g' | sed "s/'//g" >> ${OUTFILE}
+
+# Fish out all render cache settings from the environment
+set 2>&1 | grep -E '^APP_RENDER_CACHE_' | sed 's/APP_RENDER_CACHE_/render_cache./g' | sed "s/'//g" >> ${OUTFILE}
+
 cat <<EOF >> ${OUTFILE}
 
 ###
@@ -63,6 +63,9 @@ setup(
             'student_import=tutorweb_quizdb.student.create:script_student_import',
             'material_update=tutorweb_quizdb.material.update:script_material_update',
             'material_render=tutorweb_quizdb.material.render:script_material_render',
+            'material_warm=tutorweb_quizdb.material.update:script_material_warm',
+            'exam_papers=tutorweb_quizdb.stage.exam:script_exam_papers',
+            'answer_stats_rebuild=tutorweb_quizdb.stage.answer_queue:script_answer_stats_rebuild',
         ],
     },
 )
@@ -0,0 +1,75 @@
+"""
+Benchmark BaseAllocation.get_stats against the tuple IN list it replaced
+
+Not collected by "make test", run with "make benchmark"
+"""
+import timeit
+import unittest
+
+from sqlalchemy import column, select, table, tuple_
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+
+from tutorweb_quizdb.stage.allocation import get_allocation
+
+
+SIZES = (10, 100, 1000, 10000)
+REPEATS = 5
+
+
+def get_stats_tuple_in(alloc, public_ids):
+    """Previous get_stats implementation, one bound pair per question"""
+    from tutorweb_quizdb import DBSession
+
+    q = select([
+        column('material_source_id'),
+        column('permutation'),
+        column('answered'),
+        column('correct'),
+    ]).select_from(table('answer_stats')).where(column('stage_id') == alloc.db_stage.stage_id)
+
+    material = alloc.from_public_ids(public_ids)
+    q = q.where(tuple_(
+        column('material_source_id'),
+        column('permutation')
+    ).in_(material))
+
+    stats = {}
+    for mss_id, permutation, answered, correct in DBSession.execute(q):
+        stats[(mss_id, permutation)] = dict(
+            stage_answered=answered,
+            stage_correct=correct,
+        )
+    return [stats.get(x, dict(stage_answered=0, stage_correct=0)) for x in material]
+
+
+class GetStatsBenchmark(RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def test_get_stats(self):
+        from tutorweb_quizdb import DBSession
+
+        self.db_stages = self.create_stages(1)
+        self.db_studs = self.create_students(1)
+        alloc = get_allocation(dict(
+            allocation_method='original',
+            allocation_seed=44,
+            allocation_encryption_key='toottoottoot',
+        ), self.db_stages[0], self.db_studs[0])
+
+        # Stats for every other question, so both sides of the LEFT JOIN are exercised
+        DBSession.execute("""
+            INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+            SELECT :stage_id, g, 1, g % 7 + 1, g % 3
+              FROM generate_series(1, :n, 2) g
+        """, dict(stage_id=self.db_stages[0].stage_id, n=max(SIZES)))
+        DBSession.execute("ANALYZE answer_stats")
+
+        print("")
+        print("%8s %14s %14s" % ("IDs", "tuple IN (ms)", "UNNEST (ms)"))
+        for size in SIZES:
+            public_ids = alloc.to_public_ids([(i, 1) for i in range(1, size + 1)])
+            self.assertEqual(alloc.get_stats(public_ids), get_stats_tuple_in(alloc, public_ids))
+
+            t_old = min(timeit.repeat(lambda: get_stats_tuple_in(alloc, public_ids), number=1, repeat=REPEATS))
+            t_new = min(timeit.repeat(lambda: alloc.get_stats(public_ids), number=1, repeat=REPEATS))
+            print("%8d %14.2f %14.2f" % (size, t_old * 1000, t_new * 1000))
@@ -6,7 +6,7 @@ from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 from .requires_materialbank import RequiresMaterialBank
 
-from tutorweb_quizdb.material.render import view_material_render
+from tutorweb_quizdb.material.render import material_render, render_cache_get, render_cache_key, render_cache_set, view_material_render
 
 
 class ViewMaterialRender(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
@@ -81,3 +81,116 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
             correct=[],
             tags=['ex.12', 'type.question'],
         ))
+
+
+class MaterialRenderCacheTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def test_cache(self):
+        from tutorweb_quizdb import DBSession, Base
+
+        def cache_entries():
+            return DBSession.execute("""
+                SELECT ms.path, mrc.permutation
+                  FROM material_render_cache mrc
+                  JOIN material_source ms ON ms.material_source_id = mrc.material_source_id
+              ORDER BY 1, 2
+            """).fetchall()
+
+        def get_ms(path):
+            return DBSession.query(Base.classes.material_source).filter_by(
+                path=path,
+                next_material_source_id=None,
+            ).one()
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = paste(permutation, runif(1)), correct = list())) }
+        ''')
+        self.mb_update()
+        DBSession.execute("DELETE FROM material_render_cache")  # NB: Remove the sanity-check render
+
+        # Renders get stored, and re-used
+        out1 = material_render(get_ms('example1.q.R'), 1)
+        out2 = material_render(get_ms('example1.q.R'), 2)
+        self.assertNotEqual(out1['content'], out2['content'])
+        self.assertEqual(material_render(get_ms('example1.q.R'), 1), out1)
+        self.assertEqual(material_render(get_ms('example1.q.R'), 2), out2)
+        self.assertEqual(cache_entries(), [
+            ('example1.q.R', 1),
+            ('example1.q.R', 2),
+        ])
+
+        # Previews aren't cached
+        material_render(self.mb_fake_ms('example1.q.R'), 3)
+        self.assertEqual(len(cache_entries()), 2)
+
+        # New version of the question means old renders are forgotten
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = paste("New", permutation), correct = list())) }
+        ''')
+        self.mb_update()
+        self.assertEqual(cache_entries(), [
+            ('example1.q.R', 1),  # NB: The sanity-check render
+        ])
+        self.assertEqual(material_render(get_ms('example1.q.R'), 2)['content'], 'New 2')
+
+    def test_cache_last_used(self):
+        from tutorweb_quizdb import DBSession, Base
+
+        def last_used():
+            return DBSession.execute("SELECT last_used FROM material_render_cache").fetchall()
+
+        self.mb_write_example('example1.q.R', ('ex.12',), 1)
+        self.mb_update()
+        ms = DBSession.query(Base.classes.material_source).filter_by(path='example1.q.R').one()
+        key = render_cache_key(ms, 1, {})
+        self.assertIsNotNone(render_cache_get(key))
+
+        # Recently used entries aren't touched
+        DBSession.execute("UPDATE material_render_cache SET last_used = NOW() - INTERVAL '10 minutes'")
+        recent = last_used()
+        self.assertIsNotNone(render_cache_get(key))
+        self.assertEqual(last_used(), recent)
+
+        # Stale entries get bumped
+        DBSession.execute("UPDATE material_render_cache SET last_used = '2000-01-01T00:00:00'")
+        stale = last_used()
+        self.assertIsNotNone(render_cache_get(key))
+        self.assertNotEqual(last_used(), stale)
+
+        # Missing entries return None
+        self.assertIsNone(render_cache_get(dict(key, permutation=99)))
+
+    def test_cache_set(self):
+        from tutorweb_quizdb import DBSession, Base
+
+        self.mb_write_example('example1.q.R', ('ex.12',), 3)
+        self.mb_update()
+        ms = DBSession.query(Base.classes.material_source).filter_by(path='example1.q.R').one()
+        keys = [render_cache_key(ms, p, {}) for p in (3, 1, 2)]
+        DBSession.execute("DELETE FROM material_render_cache")
+
+        # Batches can be stored in any order, and contain duplicates
+        render_cache_set([
+            (keys[0], dict(content='three')),
+            (keys[1], dict(content='one')),
+            (keys[0], dict(content='three again')),
+        ])
+        self.assertEqual(render_cache_get(keys[0]), dict(content='three'))
+        self.assertEqual(render_cache_get(keys[1]), dict(content='one'))
+        self.assertIsNone(render_cache_get(keys[2]))
+
+        # Existing entries are left alone, new ones added
+        render_cache_set([
+            (keys[1], dict(content='new one')),
+            (keys[2], dict(content='two')),
+        ])
+        self.assertEqual(render_cache_get(keys[1]), dict(content='one'))
+        self.assertEqual(render_cache_get(keys[2]), dict(content='two'))
+
+        # Nothing to do is fine
+        render_cache_set([])
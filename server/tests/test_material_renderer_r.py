@@ -6,6 +6,7 @@ import time
 import rpy2.robjects as robjects
 
 from tutorweb_quizdb.material.render import material_render, MissingDataException
+from tutorweb_quizdb.material.renderer import r as r_renderer
 from tutorweb_quizdb.material.renderer.r import rob_to_dict
 
 from .requires_materialbank import RequiresMaterialBank
@@ -175,3 +176,63 @@ question <- function(permutation, data_frames) {
 
         # Still in the right directory, not snuck into material bank
         self.assertEqual(orig_cwd, os.getcwd())
+
+
+class RWorkerPoolTest(RequiresMaterialBank, unittest.TestCase):
+    def setUp(self):
+        super(RWorkerPoolTest, self).setUp()
+        self.orig_config = r_renderer.CONFIG.copy()
+
+    def tearDown(self):
+        r_renderer.configure(self.orig_config)
+        super(RWorkerPoolTest, self).tearDown()
+
+    def test_pool(self):
+        """Renders happen in worker processes, which get recycled"""
+        r_renderer.configure(dict(pool_size=2, max_renders=3, timeout=5))
+        self.mb_write_file('example.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+question <- function(permutation, data_frames) {
+    if (permutation == 99) Sys.sleep(10)
+    if (permutation == 98) stop('Hammer time')
+    return(list(
+        content = paste0('<p>Question ', permutation, ' from ', Sys.getpid(), '</p>'),
+        correct = list()
+    ))
+}
+        ''')
+
+        def test_thread(perm):
+            return material_render(self.mb_fake_ms('example.q.R'), perm)['content']
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            out = list(executor.map(test_thread, range(1, 11)))
+        self.assertEqual(
+            [x.split(' from ')[0] for x in out],
+            ['<p>Question %d' % i for i in range(1, 11)],
+        )
+
+        # Not rendered in this process, and workers were recycled
+        pids = set(x.split(' from ')[1] for x in out)
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertGreaterEqual(len(pids), 4)
+        stats = r_renderer.pool_stats()
+        self.assertEqual(stats['renders'], 10)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertLessEqual(stats['workers'], 2)
+        self.assertGreaterEqual(stats['recycled'], 2)
+
+        # Errors are passed back
+        out = material_render(self.mb_fake_ms('example.q.R'), 98)
+        self.assertEqual(out['error'], 'RRuntimeError')
+        self.assertIn('Hammer time', out['content'])
+
+        # Slow renders time out
+        out = material_render(self.mb_fake_ms('example.q.R'), 99)
+        self.assertEqual(out['error'], 'TimeoutError')
+        self.assertEqual(r_renderer.pool_stats()['timeouts'], 1)
+
+        # Pool is still usable afterwards
+        out = material_render(self.mb_fake_ms('example.q.R'), 1)
+        self.assertTrue(out['content'].startswith('<p>Question 1 from '))
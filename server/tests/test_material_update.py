@@ -1,3 +1,4 @@
+import os
 import unittest
 
 from .requires_postgresql import RequiresPostgresql
@@ -89,3 +90,153 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
             'example.q.R': ('(untracked)+3', ['math099', 'Q-0990t0', 'lec050500', 'type.question']),
             'extra/another.q.R': ('(deleted)', ['deleted', 'type.question']),
         })
+
+    def test_warm_render_cache(self):
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.material.update import warm_render_cache
+
+        def cache_entries():
+            return DBSession.execute("""
+                SELECT ms.path, mrc.permutation
+                  FROM material_render_cache mrc
+                  JOIN material_source ms ON ms.material_source_id = mrc.material_source_id
+              ORDER BY 1, 2
+            """).fetchall()
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099
+# TW:PERMUTATIONS=3
+
+question <- function(permutation, data_frames) { return(list(content = paste(permutation), correct = list())) }
+        ''')
+        self.mb_write_file('example2.q.R', b'''
+# TW:TAGS=math099
+# TW:PERMUTATIONS=2
+
+question <- function(permutation, data_frames) {
+    if (permutation == 2) stop("Hammer time")
+    return(list(content = paste(permutation), correct = list()))
+}
+        ''')
+        self.mb_write_file('example3.q.R', b'''
+# TW:TAGS=math099
+# TW:PERMUTATIONS=2
+# TW:DATAFRAMES=agelength
+
+question <- function(permutation, data_frames) { return(list(content = paste(permutation), correct = list())) }
+        ''')
+        self.mb_update()
+
+        # Everything that can be rendered is, failures are reported
+        summary = warm_render_cache(self.material_bank.name, processes=2)
+        self.assertEqual(summary['rendered'], 4)
+        self.assertEqual([x[0:2] for x in summary['failures']], [
+            ('example2.q.R', 2),
+        ])
+        self.assertIn('Hammer time', summary['failures'][0][2])
+        self.assertEqual(cache_entries(), [
+            ('example1.q.R', 1),
+            ('example1.q.R', 2),
+            ('example1.q.R', 3),
+            ('example2.q.R', 1),
+        ])
+
+        # Second time around, only the failure is retried
+        summary = warm_render_cache(self.material_bank.name, processes=2)
+        self.assertEqual(summary['rendered'], 0)
+        self.assertEqual(len(summary['failures']), 1)
+
+    def test_indexed_md5sum(self):
+        """indexed_md5sum only reads files that have changed since the last scan"""
+        from unittest import mock
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.material import update as mb_update
+        from tutorweb_quizdb.material.utils import file_md5sum
+
+        def indexed_md5sum(path):
+            with mock.patch.object(mb_update, 'file_md5sum', side_effect=file_md5sum) as m:
+                out = mb_update.indexed_md5sum(self.material_bank.name, path)
+            self.assertEqual(out, file_md5sum(os.path.join(self.material_bank.name, path)))
+            return m.call_count
+
+        self.mb_write_example('a.q.R', ['math099'], 10)
+        self.mb_write_example('b.q.R', ['math099'], 10)
+
+        # Without a scan, files have to be read
+        self.assertEqual(indexed_md5sum('a.q.R'), 1)
+
+        # Files written around the time of the scan are read to be safe
+        mb_update.update(self.material_bank.name, incremental=True)
+        self.assertEqual(indexed_md5sum('a.q.R'), 1)
+
+        # Otherwise the index is used
+        DBSession.execute("UPDATE material_bank_scan SET scan_time_ns = scan_time_ns + 10 * 1000000000")
+        self.assertEqual(indexed_md5sum('a.q.R'), 0)
+        self.assertEqual(indexed_md5sum('b.q.R'), 0)
+
+        # ...until the file changes
+        self.mb_write_example('a.q.R', ['math099', 'math100'], 10)
+        self.assertEqual(indexed_md5sum('a.q.R'), 1)
+        self.assertEqual(indexed_md5sum('b.q.R'), 0)
+
+    def test_incremental(self):
+        """Incremental updates only read changed files"""
+        from unittest import mock
+        from tutorweb_quizdb import DBSession, Base
+        from tutorweb_quizdb.material import update as mb_update
+        from tutorweb_quizdb.material import utils as mb_utils
+
+        def incremental_update():
+            with mock.patch.object(mb_utils, 'file_md5sum', side_effect=mb_utils.file_md5sum) as m:
+                self.assertEqual(mb_update.update(self.material_bank.name, incremental=True), None)
+            out = {}
+            for ms in DBSession.query(Base.classes.material_source).filter_by(next_material_source_id=None):
+                out[ms.path] = ms.revision
+            return (out, sorted(os.path.basename(c[0][0]) for c in m.call_args_list))
+
+        def age_bank():
+            """Pretend files were written well before the last scan, so none are racy"""
+            DBSession.execute("UPDATE material_bank_scan SET scan_time_ns = scan_time_ns + 10 * 1000000000")
+
+        self.mb_write_example('a.q.R', ['math099'], 10)
+        self.mb_write_example('b.q.R', ['math099'], 10)
+        self.git('add', '.')
+        self.git('commit', '-m', 'a & b')
+        self.mb_write_example('c.q.R', ['math099'], 10)
+
+        # First scan reads everything
+        self.assertEqual(incremental_update(), ({
+            'a.q.R': self.git('rev-parse', 'HEAD').strip(),
+            'b.q.R': self.git('rev-parse', 'HEAD').strip(),
+            'c.q.R': '(untracked)+1',
+        }, ['a.q.R', 'b.q.R', 'c.q.R']))
+        age_bank()
+
+        # Second scan doesn't need to read anything
+        self.assertEqual(incremental_update()[1], [])
+        age_bank()
+
+        # Modify a committed file, only it is read
+        self.mb_write_example('a.q.R', ['math099', 'math100'], 10)
+        self.assertEqual(incremental_update(), ({
+            'a.q.R': self.git('rev-parse', 'HEAD').strip() + '+1',
+            'b.q.R': self.git('rev-parse', 'HEAD').strip(),
+            'c.q.R': '(untracked)+1',
+        }, ['a.q.R']))
+        age_bank()
+
+        # Files modified around the time of the last scan are re-read to be safe
+        DBSession.execute("UPDATE material_bank_scan SET scan_time_ns = 0")
+        self.assertEqual(incremental_update()[1], ['a.q.R', 'b.q.R', 'c.q.R'])
+        age_bank()
+
+        # Removing files is noticed
+        self.mb_remove_file('b.q.R', commit='remove b')
+        self.mb_remove_file('c.q.R')
+        (out, files_read) = incremental_update()
+        self.assertEqual(out['b.q.R'], '(deleted)')
+        self.assertEqual(out['c.q.R'], '(deleted)')
+        self.assertEqual(files_read, [])
+        self.assertEqual(DBSession.execute("SELECT path FROM material_bank_file ORDER BY path").fetchall(), [
+            ('a.q.R',),
+        ])
@@ -1,7 +1,8 @@
+import os
 import tempfile
 import unittest
 
-from tutorweb_quizdb.material.utils import path_tags, file_md5sum, path_to_materialsource
+from tutorweb_quizdb.material.utils import path_tags, file_md5sum, files_md5sum, path_to_materialsource, GitRevisions, _file_revision
 
 from .requires_materialbank import RequiresMaterialBank
 
@@ -24,6 +25,25 @@ class FileMd5SumTest(unittest.TestCase):
                 '5a3de09f90eb9af33afe34bb714c28f5',
             )
 
+            # Reading in small chunks gets the same answer
+            self.assertEqual(
+                file_md5sum(f.name, chunk_size=3),
+                '5a3de09f90eb9af33afe34bb714c28f5',
+            )
+
+    def test_files_md5sum(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = []
+            for i in range(10):
+                paths.append(os.path.join(d, 'file%d' % i))
+                with open(paths[-1], 'wb') as f:
+                    f.write(b'Some file contents' if i == 5 else b'File %d' % i)
+
+            out = files_md5sum(paths, max_workers=4)
+            self.assertEqual(out, dict((p, file_md5sum(p)) for p in paths))
+            self.assertEqual(out[paths[5]], '5a3de09f90eb9af33afe34bb714c28f5')
+            self.assertEqual(files_md5sum([]), {})
+
 
 class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
     def rev_parse(self, rev="HEAD"):
@@ -61,6 +81,35 @@ class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
         parp = path_to_materialsource(self.material_bank.name, 'parp', parp['revision'])
         self.assertEqual(parp['revision'], self.rev_parse('HEAD^') + '+3')
 
+    def test_gitrevisions(self):
+        """GitRevisions gives the same answers as asking git about each file"""
+        def all_revisions(prev_revisions):
+            git_revisions = GitRevisions(self.material_bank.name)
+            return (
+                dict((p, git_revisions.revision(p, r)) for p, r in prev_revisions.items()),
+                dict((p, _file_revision(self.material_bank.name, p, r)) for p, r in prev_revisions.items()),
+            )
+
+        self.mb_write_file('a.q.R', b'a', commit='a')
+        self.mb_write_file('b.q.R', b'b', commit='b')
+        self.mb_write_file('sub dir/c.q.R', b'c', commit='c')
+        self.mb_write_file('a.q.R', b'a again', commit='a again')
+        self.mb_write_file('b.q.R', b'b dirty')
+        self.mb_write_file('d.q.R', b'd untracked')
+        (batch, individual) = all_revisions({
+            'a.q.R': '',
+            'b.q.R': self.rev_parse('HEAD^^'),
+            'sub dir/c.q.R': None,
+            'd.q.R': '(untracked)+1',
+        })
+        self.assertEqual(batch, individual)
+        self.assertEqual(batch, {
+            'a.q.R': self.rev_parse('HEAD'),
+            'b.q.R': self.rev_parse('HEAD^^') + '+1',
+            'sub dir/c.q.R': self.rev_parse('HEAD^'),
+            'd.q.R': '(untracked)+2',
+        })
+
     def test_fileparsing(self):
         """Test file contents are correctly parsed"""
         # Non-existant files get "deleted" tags
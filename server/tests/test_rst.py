@@ -1,5 +1,9 @@
+import hashlib
+import os
+import tempfile
 import unittest
 
+from tutorweb_quizdb import rst
 from tutorweb_quizdb.rst import to_rst
 
 
@@ -80,3 +84,108 @@ camel
 </div><p>Camel
 camel</p><div class="alert-message block-message system-message error"><p class="system-message-title admonition-title">System Message: ERROR/3</p><span class="literal">&amp;lt;string&amp;gt;</span>line 3 <p>Unexpected indentation.</p></div><blockquote><p>camel</p></blockquote>
         """.strip())
+
+    def test_plain_text(self):
+        """Plain text skips docutils, but gets the same output"""
+        for t in [
+            "Hello world",
+            "Hello, world. It's (probably) fine!",
+            "I think so",
+            "x - y",
+            "trailing space ",
+        ]:
+            self.assertEqual(to_rst(t), rst._to_rst(t))
+            self.assertTrue(rst.PLAIN_TEXT_RE.match(t))
+
+        # Anything that could be markup goes through docutils
+        for t in [
+            "1. one",
+            "a) no",
+            "x.",
+            "- a",
+            " indented",
+            "*emph*",
+            "a < b",
+            "two\nlines",
+        ]:
+            self.assertFalse(rst.PLAIN_TEXT_RE.match(t))
+
+
+class ToRstCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.orig_config = rst.CONFIG.copy()
+        rst.cache_clear()
+
+    def tearDown(self):
+        rst.CONFIG.update(self.orig_config)
+        rst.cache_clear()
+
+    def test_cache(self):
+        self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+        self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+        self.assertEqual(to_rst("*oink*"), "<p><em>oink</em></p>")
+        self.assertEqual(to_rst("plain text"), "<p>plain text</p>")
+        self.assertEqual(rst.cache_stats(), dict(size=2, hits=1, disk_hits=0, misses=2, plain_text=1))
+
+        # Cache is bounded, least recently used item is dropped
+        rst.configure(dict(cache_size=2))
+        to_rst("*moo*")
+        to_rst("*oink*")
+        to_rst("*moo*")
+        to_rst("*baa*")
+        self.assertEqual(rst.cache_stats(), dict(size=2, hits=1, disk_hits=0, misses=3, plain_text=0))
+        to_rst("*moo*")
+        to_rst("*oink*")
+        self.assertEqual(rst.cache_stats(), dict(size=2, hits=2, disk_hits=0, misses=4, plain_text=0))
+
+        # Unknown settings are rejected
+        with self.assertRaisesRegex(ValueError, 'camel'):
+            rst.configure({'rst.camel': 1}, prefix='rst.')
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            rst.configure({'rst.cache_dir': cache_dir, 'rst.cache_size': '10', 'smileycoin.rpc_user': 'x'}, prefix='rst.')
+            self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # Another process with an empty in-memory cache can use the disk copy
+            rst.cache_clear()
+            self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+            self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+            self.assertEqual(rst.cache_stats(), dict(size=1, hits=1, disk_hits=1, misses=0, plain_text=0))
+
+    def test_disk_cache_size(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            rst.configure(dict(cache_dir=cache_dir, cache_dir_size=2, cache_dir_evict_every=1))
+
+            def disk_entries():
+                return sorted(f for (dirpath, dirnames, filenames) in os.walk(cache_dir) for f in filenames)
+
+            def disk_entry(incoming):
+                return hashlib.sha256(incoming.encode('utf8')).hexdigest() + '.html'
+
+            to_rst("*moo*")
+            to_rst("*oink*")
+            self.assertEqual(disk_entries(), sorted([disk_entry("*moo*"), disk_entry("*oink*")]))
+
+            # Make everything old, then use oink from disk again. moo is least recently used, so is evicted
+            for (dirpath, dirnames, filenames) in os.walk(cache_dir):
+                for f in filenames:
+                    os.utime(os.path.join(dirpath, f), (1000, 1000))
+            rst.cache_clear()
+            to_rst("*oink*")
+            to_rst("*baa*")
+            self.assertEqual(disk_entries(), sorted([disk_entry("*oink*"), disk_entry("*baa*")]))
+
+    def test_disk_cache_unwritable(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # cache_dir is a file, so nothing can be written under it
+            cache_dir = os.path.join(tmp_dir, 'not_a_dir')
+            with open(cache_dir, 'w') as f:
+                f.write('')
+            rst.configure(dict(cache_dir=cache_dir))
+
+            with self.assertLogs('tutorweb_quizdb', level='WARNING'):
+                self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+            self.assertEqual(to_rst("*moo*"), "<p><em>moo</em></p>")
+            self.assertEqual(rst.cache_stats(), dict(size=1, hits=1, disk_hits=0, misses=1, plain_text=0))
@@ -1,11 +1,15 @@
+import base64
+import struct
 import unittest
 
+import numpy
+
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 from .requires_materialbank import RequiresMaterialBank
 from .test_stage_answer_queue import aq_dict
 
-from tutorweb_quizdb.stage.allocation import get_allocation
+from tutorweb_quizdb.stage.allocation import get_allocation, question_weights, stage_material_list
 from tutorweb_quizdb.stage.answer_queue import sync_answer_queue
 
 
@@ -44,6 +48,34 @@ class OriginalAllocationTest(unittest.TestCase):
             alloc_b.to_public_id(11, 34),
         )
 
+    def test_to_from_public_ids(self):
+        """Batch versions match the single versions"""
+        def get_alloc():
+            return get_allocation(dict(
+                allocation_method='original',
+                allocation_seed=44,
+                allocation_encryption_key='toottoottoot',
+            ), 'fake_db_stage', 'fake_db_student')
+        alloc_a = get_alloc()
+        material = [(11, 34), (11, 1), (33, 1), (33, -34), (11, 34)]
+
+        public_ids = alloc_a.to_public_ids(material)
+        self.assertEqual(len(public_ids), 5)
+        self.assertEqual(public_ids[0], public_ids[4])
+        self.assertEqual(len(set(public_ids)), 4)
+        self.assertEqual(alloc_a.from_public_ids(public_ids), material)
+
+        # A fresh allocation (i.e. without memos) agrees
+        self.assertEqual([get_alloc().to_public_id(*x) for x in material], public_ids)
+        self.assertEqual([get_alloc().from_public_id(x) for x in public_ids], material)
+
+        # Pre-version-char IDs can still be decoded
+        old_id = base64.b64encode(struct.pack('II', alloc_a.cipher.encrypt(11), alloc_a.cipher.encrypt(34))).decode('ascii')
+        self.assertEqual(get_alloc().from_public_ids([old_id, public_ids[1]]), [(11, 34), (11, 1)])
+
+        self.assertEqual(alloc_a.to_public_ids([]), [])
+        self.assertEqual(alloc_a.from_public_ids([]), [])
+
 
 class OriginalAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
     def test_get_material(self):
@@ -99,6 +131,121 @@ class OriginalAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPo
 
         # TODO: Test capping / sampling
 
+    def test_stage_material(self):
+        """stage_material follows material & stage changes"""
+        from tutorweb_quizdb import DBSession
+
+        def stage_material(db_stage):
+            return sorted(
+                (self.mb_lookup_mss_id(mss_id).path, permutation)
+                for mss_id, permutation in DBSession.execute(
+                    "SELECT material_source_id, permutation FROM stage_material WHERE stage_id = :stage_id",
+                    dict(stage_id=db_stage.stage_id),
+                )
+            )
+
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 2)
+        self.mb_update()
+
+        self.db_stages = self.create_stages(2, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'common%d' % (i + 1),
+        ])
+        self.assertEqual(stage_material(self.db_stages[0]), [
+            ('common1_question.q.R', 1),
+            ('common1_question.q.R', 2),
+        ])
+        self.assertEqual(stage_material(self.db_stages[1]), [])
+
+        # New material gets added, changed material gets replaced
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 1)
+        self.mb_update()
+        self.assertEqual(stage_material(self.db_stages[0]), [
+            ('common1_question.q.R', 1),
+            ('common1_question.q.R', 2),
+            ('common1_question.q.R', 3),
+        ])
+        self.assertEqual(stage_material(self.db_stages[1]), [
+            ('common2_question.q.R', 1),
+        ])
+        (count,) = DBSession.execute(
+            "SELECT COUNT(*) FROM stage_material sm JOIN material_source ms ON ms.material_source_id = sm.material_source_id"
+            " WHERE ms.next_material_source_id IS NOT NULL"
+        ).fetchone()
+        self.assertEqual(count, 0)
+
+        # Upgrading a stage moves material to the new version
+        old_stage = self.db_stages[0]
+        self.db_stages[0] = self.upgrade_stage(self.db_stages[0], dict(allocation_refresh_interval=10))
+        self.assertEqual(stage_material(old_stage), [])
+        self.assertEqual(stage_material(self.db_stages[0]), [
+            ('common1_question.q.R', 1),
+            ('common1_question.q.R', 2),
+            ('common1_question.q.R', 3),
+        ])
+
+    def test_get_material_cached(self):
+        """Stage material follows material changes, selection is kept until the bucket changes"""
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.stage import allocation
+
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 3)
+        self.mb_update()
+
+        self.db_stages = self.create_stages(1, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'all',
+        ])
+        self.db_studs = self.create_students(1)
+
+        alloc_a = get_allocation(dict(
+            allocation_method='original',
+            allocation_seed=44,
+            allocation_encryption_key='toottoottoot',
+            allocation_refresh_interval=10,
+            question_cap=2,
+        ), self.db_stages[0], self.db_studs[0])
+        selection_0 = alloc_a.get_material()
+        self.assertEqual(len(selection_0), 2)
+        stage_material_0 = allocation.stage_material_list(self.db_stages[0])
+        self.assertEqual(len(stage_material_0), 6)
+        self.assertEqual(list(stage_material_0), sorted(stage_material_0))
+
+        # Asking again uses the same selection
+        selection_obj = alloc_a._selection[2]
+        self.assertEqual(alloc_a.get_material(), selection_0)
+        self.assertIs(alloc_a._selection[2], selection_obj)
+
+        # A new allocation object gets the same selection
+        alloc_b = get_allocation(dict(
+            allocation_method='original',
+            allocation_seed=44,
+            allocation_encryption_key='toottoottoot',
+            allocation_refresh_interval=10,
+            question_cap=2,
+        ), self.db_stages[0], self.db_studs[0])
+        self.assertEqual(alloc_b.get_material(), selection_0)
+        self.assertEqual(alloc_b.material_hash(), alloc_a.material_hash(selection_0))
+
+        # Adding material shows up straight away
+        self.mb_write_example('common3_question.q.R', ('all', 'common3',), 3)
+        self.mb_update()
+        stage_material_1 = allocation.stage_material_list(self.db_stages[0])
+        self.assertEqual(len(stage_material_1), 9)
+        self.assertEqual(len(alloc_a.get_material()), 2)
+        self.assertEqual(alloc_a._selection[0], stage_material_1)
+
+        # So do in-place changes to material_source
+        mss_id = stage_material_1[0][0]
+        DBSession.execute("UPDATE material_source SET permutation_count = 1 WHERE material_source_id = :mss_id", dict(mss_id=mss_id))
+        stage_material_2 = allocation.stage_material_list(self.db_stages[0])
+        self.assertEqual(len(stage_material_2), 7)
+        self.assertEqual([x for x in stage_material_2 if x[0] == mss_id], [(mss_id, 1)])
+
     def test_material_hash(self):
         """Refresh based on refresh_interval"""
         self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
@@ -150,3 +297,180 @@ class OriginalAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPo
         hash_2 = alloc_a.material_hash()
         self.assertEqual(len(hash_2), 40)
         self.assertNotEqual(hash_2, hash_0)
+
+    def test_get_stats(self):
+        """get_stats returns stats in public ID order, zero for unanswered"""
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_update()
+
+        self.db_stages = self.create_stages(1, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'all',
+        ])
+        self.db_studs = self.create_students(1)
+
+        alloc_a = get_allocation(dict(
+            allocation_method='original',
+            allocation_seed=44,
+            allocation_encryption_key='toottoottoot',
+        ), self.db_stages[0], self.db_studs[0])
+        material_a = alloc_a.to_public_ids(sorted(alloc_a.get_material()))
+        self.assertEqual(alloc_a.get_stats([]), [])
+
+        sync_answer_queue(alloc_a, [
+            aq_dict(uri=material_a[0], time_end=1010, correct=True),
+            aq_dict(uri=material_a[0], time_end=1020, correct=False),
+            aq_dict(uri=material_a[2], time_end=1030, correct=True),
+        ], 0)
+        self.assertEqual(alloc_a.get_stats([material_a[2], material_a[1], material_a[0], material_a[2]]), [
+            dict(stage_answered=1, stage_correct=1),
+            dict(stage_answered=0, stage_correct=0),
+            dict(stage_answered=2, stage_correct=1),
+            dict(stage_answered=1, stage_correct=1),
+        ])
+
+
+class QuestionWeightsTest(unittest.TestCase):
+    def test_question_weights(self):
+        """Weak students get easy questions, strong students hard ones"""
+        # 1000 well-answered questions, of increasing difficulty
+        chosen = numpy.full(1000, 100)
+        correct = numpy.arange(1000, 0, -1) // 10
+
+        def mean_difficulty(grade):
+            w = question_weights(chosen, correct, grade, rng=numpy.random.default_rng(0))
+            self.assertEqual(len(w), 1000)
+            self.assertTrue(numpy.all(numpy.isfinite(w)))
+            self.assertTrue(numpy.all(w >= 0))
+            return numpy.average(numpy.arange(1000), weights=w)
+
+        self.assertLess(mean_difficulty(1), 300)
+        self.assertGreater(mean_difficulty(5), 300)
+        self.assertLess(mean_difficulty(5), 700)
+        self.assertGreater(mean_difficulty(9), 700)
+
+        # Large stages don't underflow to nothing
+        w = question_weights(numpy.full(50000, 10), numpy.full(50000, 5), 9.5, rng=numpy.random.default_rng(0))
+        self.assertEqual(w.max(), 1.0)
+
+        self.assertEqual(len(question_weights(numpy.zeros(0), numpy.zeros(0), 5)), 0)
+
+
+class AdaptiveAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_get_material(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 30)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 30)
+        self.mb_update()
+
+        self.db_stages = self.create_stages(1, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'all',
+        ])
+        self.db_studs = self.create_students(2)
+
+        def get_alloc(i=0, seed=44):
+            return get_allocation(dict(
+                allocation_method='adaptive',
+                allocation_seed=seed,
+                allocation_encryption_key='toottoottoot',
+                allocation_refresh_interval=10,
+                question_cap=5,
+            ), self.db_stages[0], self.db_studs[i])
+        alloc_a = get_alloc()
+        selection_0 = alloc_a.get_material()
+        self.assertEqual(len(selection_0), 5)
+        self.assertEqual(len(set(selection_0)), 5)
+
+        # Same answer every time, and for a new allocation
+        self.assertEqual(alloc_a.get_material(), selection_0)
+        self.assertEqual(get_alloc().get_material(), selection_0)
+        self.assertEqual(get_alloc().material_hash(), alloc_a.material_hash())
+
+        # Selection was stored
+        (mss_ids, permutations) = DBSession.execute(
+            "SELECT material_source_ids, permutations FROM allocation_selection WHERE user_id = :user_id",
+            dict(user_id=self.db_studs[0].user_id),
+        ).fetchone()
+        self.assertEqual(list(zip(mss_ids, permutations)), selection_0)
+
+        # Other students get their own, as do other seeds
+        get_alloc(1).get_material()
+        (count,) = DBSession.execute("SELECT COUNT(*) FROM allocation_selection").fetchone()
+        self.assertEqual(count, 2)
+        self.assertNotEqual(
+            [get_alloc(0, seed).get_material() for seed in range(10)],
+            [selection_0] * 10,
+        )
+
+        # Answering questions moves us to a new bucket, and a new selection
+        public_ids = alloc_a.to_public_ids(selection_0)
+        sync_answer_queue(alloc_a, [
+            aq_dict(uri=public_ids[i % 5], time_end=1000 + i * 10, correct=(i % 2 == 0), grade_after=i / 2)
+            for i in range(10)
+        ], 0)
+        selection_1 = alloc_a.get_material()
+        self.assertEqual(len(selection_1), 5)
+        self.assertNotEqual(selection_1, selection_0)
+        self.assertEqual(get_alloc().get_material(), selection_1)
+
+        # Samples only from the material it's given, without fetching it again
+        material = list(stage_material_list(self.db_stages[0]))[3:10]
+        selection_2 = alloc_a._weighted_sample(material, 7)
+        self.assertEqual(len(selection_2), 5)
+        self.assertEqual(set(selection_2) - set(material), set())
+        self.assertEqual(alloc_a._weighted_sample(material[:4], 7), material[:4])
+
+
+class PassThroughAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_to_from_public_ids(self):
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 3)
+        self.mb_update()
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 2)
+        self.mb_update()
+
+        self.db_stages = self.create_stages(1, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'all',
+        ])
+        self.db_studs = self.create_students(1)
+
+        def get_alloc():
+            return get_allocation(dict(
+                allocation_method='passthrough',
+                allocation_bank_name=self.material_bank.name,
+            ), self.db_stages[0], self.db_studs[0])
+        alloc = get_alloc()
+
+        material = sorted(alloc.get_material())
+        public_ids = alloc.to_public_ids(material)
+        self.assertEqual(public_ids, [
+            'common1_question.q.R:2:1',
+            'common1_question.q.R:2:2',
+            'common2_question.q.R:1:1',
+            'common2_question.q.R:1:2',
+            'common2_question.q.R:1:3',
+        ])
+        self.assertEqual(alloc.from_public_ids(public_ids), material)
+
+        # Fetched everything in one go, including older versions
+        self.assertEqual(set(alloc._path_mss_ids.keys()), set(['common1_question.q.R', 'common2_question.q.R']))
+        self.assertEqual(set(alloc._path_mss_ids['common1_question.q.R'].keys()), set([1, 2]))
+
+        # Fresh allocations agree with the batched output
+        self.assertEqual([get_alloc().to_public_id(*x) for x in material], public_ids)
+        self.assertEqual([get_alloc().from_public_id(x) for x in public_ids], material)
+        old_mss_id = get_alloc().from_public_id('common1_question.q.R:1:1')[0]
+        self.assertNotIn(old_mss_id, [x[0] for x in material])
+        self.assertEqual(get_alloc().to_public_id(old_mss_id, 3), 'common1_question.q.R:1:3')
+
+        # Unknown questions are an error
+        with self.assertRaisesRegex(ValueError, r'common1_question\.q\.R:3'):
+            get_alloc().from_public_ids(['common1_question.q.R:3:1'])
+        with self.assertRaisesRegex(ValueError, r'not_a_question\.q\.R:1'):
+            get_alloc().from_public_ids(['not_a_question.q.R:1:1'])
@@ -9,7 +9,7 @@ from .requires_materialbank import RequiresMaterialBank
 
 from tutorweb_quizdb.stage.allocation import get_allocation
 from tutorweb_quizdb.stage.setting import getStudentSettings
-from tutorweb_quizdb.stage.answer_queue import sync_answer_queue, request_review
+from tutorweb_quizdb.stage.answer_queue import answer_queue_last_id, sync_answer_queue, request_review
 from tutorweb_quizdb.stage.material import stage_material
 from tutorweb_quizdb.syllabus.results import result_summary, result_full, view_syllabus_results
 from tutorweb_quizdb.student import get_group
@@ -147,6 +147,14 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
                 aq_dict(time_end=2013, uri='example9.q.R:1:1', grade_after=9.9)
             ], 0)
 
+        # All unknown items are reported at once
+        with self.assertRaisesRegex(ValueError, 'example8.q.R:1:1, example9.q.R:1:1'):
+            (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+                aq_dict(time_end=2012, uri='example8.q.R:1:1', grade_after=9.9),
+                aq_dict(time_end=2013, uri='example1.q.R:1:1', grade_after=9.9),
+                aq_dict(time_end=2014, uri='example9.q.R:1:1', grade_after=9.9),
+            ], 0)
+
         # Add some items into the queue, get them back again. Entries without time_end are ignored
         alloc = get_alloc(self.db_stages[0], self.db_studs[0])
         (out, additions) = sync_answer_queue(alloc, [
@@ -764,3 +772,436 @@ question <- function(permutation, data_frames) { return(list(content = 'parp', c
         self.assertEqual(out[-1]['correct'], True)  # Marked as correct already
         self.assertEqual(out[-1]['ug_reviews'][0]['vetted'], 49)
         self.assertEqual(self.coins_awarded(self.db_studs[1]), AWARD_UGMATERIAL_CORRECT * 2 + AWARD_UGMATERIAL_ACCEPTED * 2)
+
+    def test_since(self):
+        """Given answer_queue_last_id() from the last sync, only new / changed entries are returned"""
+        self.db_stages = self.create_stages(1, lec_parent='ut.ans_queue.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'lec050500',
+        ])
+        self.db_studs = self.create_students(1)
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+
+        alloc = get_alloc(self.db_stages[0], self.db_studs[0])
+        self.assertEqual(answer_queue_last_id(alloc), 0)
+        (out, additions) = sync_answer_queue(alloc, [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1.1),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=2.2),
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=3.3),
+        ], 0)
+        self.assertEqual(len(out), 3)
+        self.assertEqual(additions, 3)
+        since = answer_queue_last_id(alloc)
+        self.assertGreater(since, 0)
+
+        # Nothing new, we just get the final entry back for the current grade
+        (out, additions) = sync_answer_queue(alloc, [], 0, since=since)
+        self.assertEqual(out, [
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=3.3),
+        ])
+        self.assertEqual(additions, 0)
+        self.assertEqual(answer_queue_last_id(alloc), since)
+
+        # New entries are returned, old ones aren't
+        (out, additions) = sync_answer_queue(alloc, [
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=4.4),
+        ], 0, since=since)
+        self.assertEqual(out, [
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=4.4),
+        ])
+        self.assertEqual(additions, 1)
+        self.assertGreater(answer_queue_last_id(alloc), since)
+        since = answer_queue_last_id(alloc)
+
+        # Entries with new reviews are returned, along with the final entry
+        (out, additions) = sync_answer_queue(alloc, [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1.1, review=dict(hard="yes")),
+        ], 0, since=since)
+        self.assertEqual(out, [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1.1, review=dict(hard="yes")),
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=4.4),
+        ])
+        self.assertEqual(additions, 0)
+
+        # Another client syncs an answer older than everything this client has seen
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:5', time_end=1015, grade_after=1.5, client_id='02'),
+        ], 0)
+        self.assertEqual(additions, 1)
+
+        # ...which our client still gets, since it was stored after our last sync
+        (out, additions) = sync_answer_queue(alloc, [], 0, since=since)
+        self.assertEqual(out, [
+            aq_dict(uri='example1.q.R:1:5', time_end=1015, grade_after=1.5, client_id='02'),
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=4.4),
+        ])
+        self.assertEqual(additions, 0)
+        since = answer_queue_last_id(alloc)
+        (out, additions) = sync_answer_queue(alloc, [], 0, since=since)
+        self.assertEqual(out, [
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=4.4),
+        ])
+
+        # Without since we get everything back
+        (out, additions) = sync_answer_queue(alloc, [], 0)
+        self.assertEqual(out, [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1.1, review=dict(hard="yes")),
+            aq_dict(uri='example1.q.R:1:5', time_end=1015, grade_after=1.5, client_id='02'),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=2.2),
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=3.3),
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=4.4),
+        ])
+
+    def test_batched_writes(self):
+        """New answers are written in one INSERT, changes to existing answers in one UPDATE"""
+        from sqlalchemy import event
+        from tutorweb_quizdb import DBSession
+
+        statements = []
+
+        def log_statement(conn, cursor, statement, parameters, context, executemany):
+            words = statement.split()
+            if len(words) > 2 and words[0] in ('INSERT', 'UPDATE') and 'answer' in words[1:3]:
+                statements.append(words[0])
+
+        def db_answers():
+            return [tuple(x) for x in DBSession.execute("""
+                SELECT a.permutation, a.time_end, a.review, a.coins_awarded
+                  FROM answer a
+                 WHERE a.user_id = :user_id
+              ORDER BY a.answer_id
+            """, dict(user_id=self.db_studs[0].user_id))]
+
+        self.db_stages = self.create_stages(1, lec_parent='ut.ans_queue.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+            award_stage_answered=dict(value=AWARD_STAGE_ANSWERED),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'lec050500',
+        ])
+        self.db_studs = self.create_students(1)
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+        engine = DBSession.get_bind()
+        event.listen(engine, 'before_cursor_execute', log_statement)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', log_statement)
+
+        # Out-of-order entries are inserted in time order, in one go
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=3),
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=2),
+        ], 0)
+        self.assertEqual(additions, 3)
+        self.assertEqual(statements, ['INSERT'])
+        self.assertEqual([(x[0], x[3]) for x in db_answers()], [(1, 0), (2, 0), (3, 0)])
+        self.assertEqual([x['uri'] for x in out], ['example1.q.R:1:1', 'example1.q.R:1:2', 'example1.q.R:1:3'])
+
+        # Mixed sync: reviews & coins on existing entries are written in one UPDATE, new entries in one INSERT
+        DBSession.execute("UPDATE answer SET coins_awarded = 99 WHERE permutation = 3")
+        DBSession.expire_all()
+        del statements[:]
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1, review=dict(hard="yes")),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=2, review=dict(hard="no")),
+            aq_dict(uri='example1.q.R:1:4', time_end=1040, grade_after=6),
+        ], 0)
+        self.assertEqual(additions, 1)
+        self.assertEqual(statements, ['UPDATE', 'INSERT'])
+        self.assertEqual([(x[0], x[2], x[3]) for x in db_answers()], [
+            (1, dict(hard="yes"), 0),
+            (2, dict(hard="no"), 0),
+            (3, None, 0),
+            (4, None, AWARD_STAGE_ANSWERED),
+        ])
+        self.assertEqual([x['uri'] for x in out], [
+            'example1.q.R:1:1',
+            'example1.q.R:1:2',
+            'example1.q.R:1:3',
+            'example1.q.R:1:4',
+        ])
+
+        # Written values are committed as far as the ORM is concerned, so flushing doesn't write them again
+        del statements[:]
+        DBSession.flush()
+        self.assertEqual(statements, [])
+
+        # Nothing changed, nothing written
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=1),
+        ], 0)
+        self.assertEqual(additions, 0)
+        self.assertEqual(statements, [])
+
+    def test_grade_hwm(self):
+        """answer_grade_hwm follows the highest grade, and moves to new stage versions"""
+        from tutorweb_quizdb import DBSession
+
+        def grade_hwms():
+            return dict(DBSession.execute("""
+                SELECT stage_id, grade_hwm FROM answer_grade_hwm WHERE user_id = :user_id
+            """, dict(user_id=self.db_studs[0].user_id)).fetchall())
+
+        self.db_stages = self.create_stages(2, lec_parent='ut.ans_queue.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'lec050500',
+        ])
+        self.db_studs = self.create_students(2)
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+        self.assertEqual(grade_hwms(), {})
+
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=3.5),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=7.5),
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=5.5),
+        ], 0)
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[1], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1040, grade_after=1.5),
+        ], 0)
+        self.assertEqual(grade_hwms(), {
+            self.db_stages[0].stage_id: Decimal('7.500'),
+            self.db_stages[1].stage_id: Decimal('1.500'),
+        })
+
+        # Upgrading a stage moves the high-water-mark over to the new version
+        self.db_stages[0] = self.upgrade_stage(self.db_stages[0], dict(
+            upgraded=dict(value="1"),
+        ))
+        self.assertEqual(grade_hwms(), {
+            self.db_stages[0].stage_id: Decimal('7.500'),
+            self.db_stages[1].stage_id: Decimal('1.500'),
+        })
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:4', time_end=1050, grade_after=9.5),
+        ], 0)
+        self.assertEqual(grade_hwms(), {
+            self.db_stages[0].stage_id: Decimal('9.500'),
+            self.db_stages[1].stage_id: Decimal('1.500'),
+        })
+
+    def test_stage_lineage(self):
+        """stage_lineage tracks every revision of a stage"""
+        from tutorweb_quizdb import DBSession
+
+        def lineage(db_stage):
+            return DBSession.execute("""
+                SELECT stage_id, latest_stage_id, version
+                  FROM stage_lineage
+                 WHERE latest_stage_id = (SELECT latest_stage_id FROM stage_lineage WHERE stage_id = :stage_id)
+              ORDER BY version
+            """, dict(stage_id=db_stage.stage_id)).fetchall()
+
+        self.db_stages = self.create_stages(2, lec_parent='ut.ans_queue.0')
+        orig_stages = list(self.db_stages)
+        self.assertEqual(lineage(self.db_stages[0]), [
+            (self.db_stages[0].stage_id, self.db_stages[0].stage_id, 1),
+        ])
+
+        # Upgrade stage0 twice, all versions point at the latest
+        self.db_stages[0] = self.upgrade_stage(self.db_stages[0], dict(award_stage_answered=dict(value=1)))
+        self.db_stages[0] = self.upgrade_stage(self.db_stages[0], dict(award_stage_answered=dict(value=2)))
+        self.assertEqual(lineage(orig_stages[0]), [
+            (orig_stages[0].stage_id, self.db_stages[0].stage_id, 1),
+            (self.db_stages[0].stage_id - 1, self.db_stages[0].stage_id, 2),
+            (self.db_stages[0].stage_id, self.db_stages[0].stage_id, 3),
+        ])
+
+        # stage1 is unaffected
+        self.assertEqual(lineage(self.db_stages[1]), [
+            (self.db_stages[1].stage_id, self.db_stages[1].stage_id, 1),
+        ])
+
+    def test_stage_ugmaterial(self):
+        """stage_ugmaterial stays in step with the view it replaced as content & reviews change"""
+        from tutorweb_quizdb import DBSession
+
+        def stage_ugmaterial():
+            return DBSession.execute("""
+                SELECT answer_id, stage_id, material_source_id, user_id, time_end, correct, reviews
+                  FROM stage_ugmaterial
+              ORDER BY answer_id
+            """).fetchall()
+
+        def old_view():
+            return DBSession.execute("""
+                SELECT v.answer_id, v.stage_id, v.material_source_id, v.user_id, v.time_end, v.correct, v.reviews
+                  FROM (
+                    SELECT DISTINCT ON (CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END)
+                    a.*
+                    , JSONB_AGG(JSONB_BUILD_ARRAY(user_id, review)) OVER curqn AS reviews
+                    FROM answer a
+                    WINDOW curqn AS (
+                        PARTITION BY CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END
+                        ORDER BY CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END, a.time_end, a.answer_id
+                        ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+                    )
+                    ORDER BY CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END, a.time_end, a.answer_id
+                  ) v
+                  JOIN material_source ms ON ms.material_source_id = v.material_source_id
+                 WHERE v.permutation >= 0
+                   AND 'type.template' = ANY(ms.material_tags)
+              ORDER BY v.answer_id
+            """).fetchall()
+
+        self.db_stages = self.create_stages(1, lec_parent='ut.ans_queue.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.template',
+            'lec050500',
+        ])
+        self.db_studs = self.create_students(3)
+        self.mb_write_file('template1.t.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=1
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+
+        # Content gets a row each
+        sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='template1.t.R:1:1', time_end=1010, correct=None, student_answer=dict(text="content a")),
+            aq_dict(uri='template1.t.R:1:1', time_end=1020, correct=None, student_answer=dict(text="content b")),
+        ], 0)
+        (a_id, b_id) = [x[0] for x in DBSession.execute(
+            "SELECT answer_id FROM answer WHERE user_id = :user_id ORDER BY time_end",
+            dict(user_id=self.db_studs[0].user_id),
+        )]
+        self.assertEqual([x[0] for x in stage_ugmaterial()], [a_id, b_id])
+        self.assertEqual(stage_ugmaterial(), old_view())
+
+        # Reviews get added, in time order
+        sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[1]), [
+            aq_dict(uri='template1.t.R:1:-%d' % a_id, time_end=1040, review=dict(content=12, comments="good")),
+        ], 0)
+        sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[2]), [
+            aq_dict(uri='template1.t.R:1:-%d' % a_id, time_end=1030, review=dict(content=-12, comments="bad")),
+            aq_dict(uri='template1.t.R:1:-%d' % b_id, time_end=1050, review=dict(content=6, comments="ok")),
+        ], 0)
+        self.assertEqual([len(x[6]) for x in stage_ugmaterial()], [3, 2])
+        self.assertEqual(stage_ugmaterial(), old_view())
+
+        # Verdicts and reviews get updated
+        DBSession.execute("UPDATE answer SET correct = true WHERE answer_id = :answer_id", dict(answer_id=a_id))
+        DBSession.execute("UPDATE answer SET review = '{\"content\": 0}' WHERE permutation = :permutation", dict(permutation=0 - b_id))
+        self.assertEqual([x[5] for x in stage_ugmaterial()], [True, None])
+        self.assertEqual(stage_ugmaterial(), old_view())
+
+        # Deleted reviews & content disappear
+        DBSession.execute("DELETE FROM answer WHERE permutation = :permutation AND user_id = :user_id", dict(
+            permutation=0 - a_id,
+            user_id=self.db_studs[1].user_id,
+        ))
+        self.assertEqual([len(x[6]) for x in stage_ugmaterial()], [2, 2])
+        self.assertEqual(stage_ugmaterial(), old_view())
+        DBSession.execute("DELETE FROM answer WHERE answer_id = :answer_id", dict(answer_id=b_id))
+        self.assertEqual([x[0] for x in stage_ugmaterial()], [a_id])
+        self.assertEqual(stage_ugmaterial(), old_view())
+
+    def test_answer_stats(self):
+        """answer_stats counts answers as they arrive, and can be rebuilt from scratch"""
+        from tutorweb_quizdb import DBSession
+
+        def answer_stats():
+            return DBSession.execute("""
+                SELECT permutation, answered, correct
+                  FROM answer_stats
+                 WHERE stage_id = :stage_id
+              ORDER BY permutation
+            """, dict(stage_id=self.db_stages[0].stage_id)).fetchall()
+
+        self.db_stages = self.create_stages(1, lec_parent='ut.ans_queue.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'lec050500',
+        ])
+        self.db_studs = self.create_students(2)
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+        self.assertEqual(answer_stats(), [])
+
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, correct=True),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, correct=False),
+        ], 0)
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[1]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, correct=True),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, correct=None),
+        ], 0)
+        self.assertEqual(answer_stats(), [
+            (1, 2, 2),
+            (2, 2, 0),
+        ])
+
+        # Changing correct updates stats
+        DBSession.execute("UPDATE answer SET correct = true WHERE stage_id = :stage_id AND permutation = 2 AND correct IS NULL", dict(
+            stage_id=self.db_stages[0].stage_id,
+        ))
+        self.assertEqual(answer_stats(), [
+            (1, 2, 2),
+            (2, 2, 1),
+        ])
+
+        # Several answers to the same question in one statement all count
+        (out, additions) = sync_answer_queue(get_alloc(self.db_stages[0], self.db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, correct=True),
+            aq_dict(uri='example1.q.R:1:3', time_end=1040, correct=False),
+            aq_dict(uri='example1.q.R:1:3', time_end=1050, correct=True),
+            aq_dict(uri='example1.q.R:1:1', time_end=1060, correct=False),
+        ], 0)
+        self.assertEqual(answer_stats(), [
+            (1, 3, 2),
+            (2, 2, 1),
+            (3, 3, 2),
+        ])
+
+        # Deleting answers removes them from stats
+        DBSession.execute("DELETE FROM answer WHERE stage_id = :stage_id AND permutation = 3 AND correct", dict(
+            stage_id=self.db_stages[0].stage_id,
+        ))
+        self.assertEqual(answer_stats(), [
+            (1, 3, 2),
+            (2, 2, 1),
+            (3, 1, 0),
+        ])
+
+        # Rebuilding gets the same answer
+        DBSession.execute("UPDATE answer_stats SET answered = 99")
+        DBSession.execute("SELECT answer_stats_rebuild()")
+        self.assertEqual(answer_stats(), [
+            (1, 3, 2),
+            (2, 2, 1),
+            (3, 1, 0),
+        ])
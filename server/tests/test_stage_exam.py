@@ -0,0 +1,127 @@
+import unittest
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.stage.allocation import get_allocation
+from tutorweb_quizdb.stage.exam import exam_papers_generate, exam_papers_warm, is_exam_stage
+
+
+class FakeStage():
+    def __init__(self, stage_setting_spec):
+        self.stage_setting_spec = stage_setting_spec
+
+
+class IsExamStageTest(unittest.TestCase):
+    def test_is_exam_stage(self):
+        self.assertFalse(is_exam_stage(FakeStage(None)))
+        self.assertFalse(is_exam_stage(FakeStage(dict(allocation_method=dict(value='adaptive')))))
+        self.assertTrue(is_exam_stage(FakeStage(dict(allocation_method=dict(value='exam')))))
+
+        # Variants are considered too
+        self.assertTrue(is_exam_stage(FakeStage(dict(allocation_method={
+            'value': 'adaptive',
+            'variant:registered': dict(value='exam'),
+        }))))
+        self.assertFalse(is_exam_stage(FakeStage(dict(allocation_method={
+            'value': 'adaptive',
+            'variant:registered': dict(value='original'),
+        }))))
+        self.assertTrue(is_exam_stage(FakeStage(dict(allocation_method={
+            'value': 'exam',
+            'variant:registered': dict(value='original'),
+        }))))
+
+
+class ExamPapersTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_exam_papers(self):
+        from tutorweb_quizdb import DBSession
+
+        def papers(db_stage):
+            return [tuple(x) for x in DBSession.execute(
+                "SELECT paper, material_source_ids, permutations FROM exam_paper WHERE stage_id = :stage_id ORDER BY paper",
+                dict(stage_id=db_stage.stage_id),
+            )]
+
+        def cached_renders():
+            return set(tuple(x) for x in DBSession.execute("SELECT material_source_id, permutation FROM material_render_cache"))
+
+        self.mb_write_example('exam1_question.q.R', ('exam', 'exam1',), 10)
+        self.mb_write_example('exam2_question.q.R', ('exam', 'exam2',), 10)
+        self.mb_update()
+
+        # Importing an exam stage generates papers
+        self.db_stages = self.create_stages(1, lambda i: dict(
+            allocation_method=dict(value='exam'),
+            exam_papers=dict(value=3),
+            question_cap=dict(value=4),
+        ), lambda i: [
+            'type.question',
+            'exam',
+        ])
+        self.db_studs = self.create_students(1)
+        stage_papers = papers(self.db_stages[0])
+        self.assertEqual([x[0] for x in stage_papers], [0, 1, 2])
+        for paper, mss_ids, permutations in stage_papers:
+            self.assertEqual(len(mss_ids), 4)
+            self.assertEqual(len(set(zip(mss_ids, permutations))), 4)
+        self.assertNotEqual(tuple(stage_papers[0][1:]), tuple(stage_papers[1][1:]))
+
+        # ...which can be pre-rendered
+        exam_papers_warm(self.db_stages[0], processes=1)
+        for paper, mss_ids, permutations in stage_papers:
+            self.assertTrue(set(zip(mss_ids, permutations)).issubset(cached_renders()))
+
+        # Students get the paper for their seed
+        for seed in range(6):
+            alloc = get_allocation(dict(
+                allocation_method='exam',
+                allocation_seed=seed,
+                allocation_encryption_key='toottoottoot',
+                exam_papers=3,
+                question_cap=4,
+            ), self.db_stages[0], self.db_studs[0])
+            paper = stage_papers[seed % 3]
+            self.assertEqual(alloc.get_material(), list(zip(paper[1], paper[2])))
+            self.assertEqual(alloc.get_material(), list(zip(paper[1], paper[2])))
+
+        # Changing material leaves papers alone, students already sitting the exam keep their paper
+        self.mb_write_example('exam3_question.q.R', ('exam', 'exam3',), 10)
+        self.mb_update()
+        self.assertEqual(papers(self.db_stages[0]), stage_papers)
+        alloc = get_allocation(dict(
+            allocation_method='exam',
+            allocation_seed=1,
+            allocation_encryption_key='toottoottoot',
+            exam_papers=3,
+            question_cap=4,
+        ), self.db_stages[0], self.db_studs[0])
+        self.assertEqual(alloc.get_material(), list(zip(stage_papers[1][1], stage_papers[1][2])))
+
+        # Papers only change when explicitly regenerated
+        exam_papers_generate(self.db_stages[0])
+        self.assertEqual([x[0] for x in papers(self.db_stages[0])], [0, 1, 2])
+        self.assertNotEqual(papers(self.db_stages[0]), stage_papers)
+
+        # Missing papers are generated on first use, existing ones are left alone
+        stage_papers = papers(self.db_stages[0])
+        DBSession.execute("UPDATE exam_paper SET material_source_ids = ARRAY[]::INTEGER[], permutations = ARRAY[]::INTEGER[] WHERE paper = 2")
+        DBSession.execute("DELETE FROM exam_paper WHERE paper = 1")
+
+        def get_alloc(seed):
+            return get_allocation(dict(
+                allocation_method='exam',
+                allocation_seed=seed,
+                allocation_encryption_key='toottoottoot',
+                exam_papers=3,
+                question_cap=4,
+            ), self.db_stages[0], self.db_studs[0])
+        self.assertEqual(get_alloc(1).get_material(), list(zip(stage_papers[1][1], stage_papers[1][2])))
+        self.assertEqual(get_alloc(2).get_material(), [])
+        self.assertEqual(papers(self.db_stages[0]), stage_papers[0:2] + [(2, [], [])])
+
+        # Stages without any papers, e.g. from before exam papers existed, get them too
+        DBSession.execute("DELETE FROM exam_paper")
+        self.assertEqual(get_alloc(1).get_material(), list(zip(stage_papers[1][1], stage_papers[1][2])))
+        self.assertEqual(papers(self.db_stages[0]), stage_papers)
@@ -0,0 +1,128 @@
+import unittest
+
+import numpy
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+from .test_stage_answer_queue import aq_dict
+
+from tutorweb_quizdb.stage.allocation import get_allocation
+from tutorweb_quizdb.stage.answer_queue import sync_answer_queue
+from tutorweb_quizdb.stage.iaa import (
+    next_allocation,
+    NoQuestionsException,
+    qn_timeout,
+    question_bias,
+)
+
+
+class QnTimeoutTest(unittest.TestCase):
+    def test_qn_timeout(self):
+        # No timeout unless both max & min are set
+        self.assertEqual(qn_timeout(dict(), 5), None)
+        self.assertEqual(qn_timeout(dict(timeout_max='10'), 5), None)
+
+        # Shortest time at timeout_grade, tending to max away from it
+        settings = dict(timeout_max='10', timeout_min='3')
+        self.assertEqual(qn_timeout(settings, 5), 180)
+        self.assertEqual(qn_timeout(settings, 3), 600 - 254)
+        self.assertEqual(qn_timeout(settings, 0), 600 - 18)
+        self.assertEqual(qn_timeout(dict(timeout_grade='0', **settings), 0), 180)
+
+
+class QuestionBiasTest(unittest.TestCase):
+    def test_question_bias(self):
+        material = [(1, 1), (2, 1), (3, 1)]
+
+        # No answers, no bias
+        self.assertEqual(question_bias(material, []).tolist(), [1, 1, 1])
+
+        # Correct answers are less likely, incorrect more likely with age. Most recent answer wins
+        self.assertEqual(question_bias(material, [
+            (1, 1, True, 0),
+            (2, 1, False, 0),
+            (2, 1, True, 0),
+            (4, 1, False, 0),
+        ]).tolist(), [0.5, 1.05 ** -1, 1])
+        self.assertEqual(question_bias(material, [
+            (9, 1, True, 0),
+            (9, 1, True, 0),
+            (9, 1, True, 0),
+            (9, 1, True, 0),
+            (3, 1, False, 0),
+        ]).tolist(), [1, 1, 1.05 ** 2])
+
+
+class NextAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def get_alloc(self, **settings):
+        return get_allocation(dict(
+            allocation_method='passthrough',
+            allocation_bank_name=self.material_bank.name,
+            **settings
+        ), self.db_stages[0], self.db_studs[0])
+
+    def test_adaptive(self):
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 3)
+        self.mb_update()
+        self.db_stages = self.create_stages(1, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'all',
+        ])
+        self.db_studs = self.create_students(1)
+        alloc = self.get_alloc(timeout_max='10', timeout_min='3')
+        public_ids = alloc.to_public_ids(alloc.get_material())
+
+        # Get a question from the stage, with its data and timeout
+        out = next_allocation(alloc, rng=numpy.random.default_rng(4))
+        self.assertIn(out['uri'], public_ids)
+        self.assertEqual(out['stats']['uri'], out['uri'])
+        self.assertEqual(out['grade_before'], 0)
+        self.assertEqual(out['allotted_time'], 600 - 18)
+        self.assertEqual(out['student_answer'], {})
+        self.assertIn('content', out['data'])
+
+        # Every question is eligible
+        self.assertEqual(
+            set(next_allocation(alloc, rng=numpy.random.default_rng(i))['uri'] for i in range(200)),
+            set(public_ids),
+        )
+
+        # Grade comes from the most recent answer
+        sync_answer_queue(alloc, [
+            aq_dict(uri=public_ids[0], time_end=1000, correct=False, grade_after=2),
+            aq_dict(uri=public_ids[1], time_end=1010, correct=True, grade_after=5),
+        ], 0)
+        out = next_allocation(self.get_alloc(timeout_max='10', timeout_min='3'), practice=True)
+        self.assertEqual(out['grade_before'], 5)
+        self.assertEqual(out['allotted_time'], 180)
+        self.assertEqual(out['student_answer'], dict(practice=True))
+
+    def test_exam(self):
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 2)
+        self.mb_update()
+        self.db_stages = self.create_stages(1, lambda i: dict(
+        ), lambda i: [
+            'type.question',
+            'all',
+        ])
+        self.db_studs = self.create_students(1)
+        alloc = self.get_alloc(iaa_type='exam')
+        public_ids = alloc.to_public_ids(alloc.get_material())
+
+        # Questions are asked in order
+        self.assertEqual(next_allocation(alloc)['uri'], public_ids[0])
+        with self.assertRaisesRegex(ValueError, 'Practice'):
+            next_allocation(alloc, practice=True)
+        sync_answer_queue(alloc, [
+            aq_dict(uri=public_ids[0], time_end=1000),
+        ], 0)
+        self.assertEqual(next_allocation(alloc)['uri'], public_ids[1])
+        sync_answer_queue(alloc, [
+            aq_dict(uri=public_ids[0], time_end=1000),
+            aq_dict(uri=public_ids[1], time_end=1010),
+        ], 0)
+        with self.assertRaisesRegex(NoQuestionsException, 'answered all questions'):
+            next_allocation(alloc)
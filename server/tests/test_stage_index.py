@@ -1,6 +1,7 @@
 import unittest
 import urllib.parse
 
+from pyramid.httpexceptions import HTTPBadRequest
 
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
@@ -53,3 +54,28 @@ class StageIndexTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql,
         # material_uri path has a hash
         hash_1 = m_qs['hash'][0]
         self.assertEqual(len(hash_1), 40)
+
+    def test_since(self):
+        """answerQueueSince has to be an answerQueueLastId"""
+        self.db_stages = self.create_stages(1, lec_parent='ut.ans_queue.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'lec050500',
+        ])
+        self.db_studs = self.create_students(1)
+
+        def stage_index_since(since):
+            request = self.request(user=self.db_studs[0], params=dict(path=self.db_stages[0]))
+            request.body = b'{}'
+            request.json_body = dict(answerQueueSince=since)
+            return stage_index(request)
+
+        self.assertEqual(stage_index_since(1000)['answerQueueSince'], 1000)
+        self.assertEqual(stage_index_since('1000')['answerQueueSince'], 1000)
+        self.assertEqual(stage_index_since(None)['answerQueueSince'], None)
+        self.assertEqual(stage_index_since(None)['answerQueueLastId'], 0)
+        for since in ('yesterday', 'nan', 'inf', 1000.5, '1000.5', [1000], dict(a=1)):
+            with self.assertRaisesRegex(HTTPBadRequest, 'answerQueueSince'):
+                stage_index_since(since)
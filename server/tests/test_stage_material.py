@@ -1,8 +1,12 @@
+import json
 import unittest
 
+from webob import Request
+
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 from .requires_materialbank import RequiresMaterialBank
+from .test_stage_answer_queue import aq_dict
 
 from tutorweb_quizdb.stage.dataframe import view_stage_dataframe
 from tutorweb_quizdb.stage.material import view_stage_material
@@ -118,3 +122,211 @@ question <- function(permutation, data_frames) { return(list(content = paste('q3
         # The other user doesn't get anything
         with self.assertRaisesRegex(MissingDataException, r'df/data_[ab]\.json'):
             lec_2_material = view_stage_material(self.request(user=self.db_studs[1], params=dict(path=self.db_other_stages[0])))
+
+    def test_stream(self):
+        """format=ndjson streams the same material, one question per line"""
+        from tutorweb_quizdb import DBSession
+        self.DBSession = DBSession
+
+        self.db_stages = self.create_stages(1, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'ex.12',
+        ])
+        self.db_studs = self.create_students(1)
+        DBSession.flush()
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=2
+
+question <- function(permutation, data_frames) { return(list(content = paste('q1', permutation), correct = list())) }
+        ''')
+        self.mb_write_file('example2.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=2
+
+question <- function(permutation, data_frames) { return(list(content = paste('q2', permutation), correct = list())) }
+        ''')
+        self.mb_update()
+
+        # Stream first, so renders aren't already in the cache
+        response = view_stage_material(self.request(user=self.db_studs[0], params=dict(path=self.db_stages[0], format='ndjson')))
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        lines = [json.loads(x.decode('utf8')) for x in response.app_iter]
+        material = view_stage_material(self.request(user=self.db_studs[0], params=dict(path=self.db_stages[0])))
+
+        # One line per question, containing the same data as the regular response
+        self.assertEqual(
+            sorted(x['uri'] for x in lines),
+            sorted(material['data'].keys()),
+        )
+        for x in lines:
+            self.assertEqual(x['data'], material['data'][x['uri']])
+            self.assertEqual(x['stats'], [s for s in material['stats'] if s['uri'] == x['uri']][0])
+        self.assertEqual(set(x['data']['content'] for x in lines), set([
+            'q1 1', 'q1 2', 'q2 1', 'q2 2',
+        ]))
+
+    def test_mixed_ug(self):
+        """Regular & user-generated material come back in request order, as per-item lookups did"""
+        from unittest import mock
+        from tutorweb_quizdb import DBSession, Base
+        from tutorweb_quizdb.material.render import material_render
+        from tutorweb_quizdb.stage import material as stage_material_mod
+        from tutorweb_quizdb.stage.allocation import get_allocation
+        from tutorweb_quizdb.stage.answer_queue import sync_answer_queue
+        from tutorweb_quizdb.stage.setting import getStudentSettings
+        from tutorweb_quizdb.student import get_group, student_is_vetted
+
+        def get_alloc(db_student):
+            return get_allocation(getStudentSettings(self.db_stages[0], db_student), self.db_stages[0], db_student)
+
+        def old_stage_material(alloc, requested_ids):
+            """stage_material's previous implementation, one query per item"""
+            out = dict(stats=[], data={})
+            for mss_id, permutation in [alloc.from_public_id(x) for x in requested_ids]:
+                ms = DBSession.query(Base.classes.material_source).filter_by(material_source_id=mss_id).one()
+                rendered = material_render(ms, permutation, {})
+                if 'type.template' in ms.material_tags and permutation < 0:
+                    if student_is_vetted(alloc.db_student, alloc.db_stage):
+                        rendered['review_questions'] = stage_material_mod.VETTED_REVIEW_TEMPLATE + rendered['review_questions']
+                out['stats'].append(alloc.to_public_id(mss_id, permutation))
+                out['data'][out['stats'][-1]] = rendered
+            return out
+
+        self.db_stages = self.create_stages(1, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'ex.12',
+        ])
+        self.db_studs = self.create_students(2)
+        self.db_studs[1].groups.append(get_group('vetted.%s' % self.db_stages[0].syllabus.path[:-1], auto_create=True))
+        DBSession.flush()
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=2
+
+question <- function(permutation, data_frames) { return(list(content = paste('q1', permutation), correct = list())) }
+        ''')
+        self.mb_write_file('template1.t.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=1
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+
+        # Student 0 writes some content
+        sync_answer_queue(get_alloc(self.db_studs[0]), [
+            aq_dict(uri='template1.t.R:1:1', time_end=1010, correct=None, student_answer=dict(text="UG a")),
+            aq_dict(uri='template1.t.R:1:1', time_end=1020, correct=None, student_answer=dict(text="UG b")),
+        ], 0)
+        (a_id, b_id) = [x[0] for x in DBSession.execute(
+            "SELECT answer_id FROM answer WHERE user_id = :user_id ORDER BY time_end",
+            dict(user_id=self.db_studs[0].user_id),
+        )]
+        requested_ids = [
+            'example1.q.R:1:2',
+            'template1.t.R:1:-%d' % b_id,
+            'example1.q.R:1:1',
+            'template1.t.R:1:-%d' % a_id,
+        ]
+
+        for db_student, review_questions in [
+                (self.db_studs[0], ['content', 'presentation', 'difficulty']),
+                (self.db_studs[1], ['vetted', 'content', 'presentation', 'difficulty'])]:
+            alloc = get_alloc(db_student)
+            with mock.patch.object(stage_material_mod, 'student_is_vetted', side_effect=student_is_vetted) as m:
+                out = stage_material_mod.stage_material(alloc, requested_ids)
+            old_out = old_stage_material(alloc, requested_ids)
+
+            # Same order, same material, but vetted-ness only looked up once
+            self.assertEqual([x['uri'] for x in out['stats']], requested_ids)
+            self.assertEqual(old_out['stats'], requested_ids)
+            self.assertEqual(out['data'], old_out['data'])
+            self.assertEqual([x['name'] for x in out['data'][requested_ids[1]]['review_questions']], review_questions)
+            self.assertEqual([x['name'] for x in out['data'][requested_ids[3]]['review_questions']], review_questions)
+            self.assertEqual(out['data'][requested_ids[0]]['content'], 'q1 2')
+            self.assertEqual(m.call_count, 1)
+
+            # Without user-generated material, vetted-ness isn't looked up at all
+            with mock.patch.object(stage_material_mod, 'student_is_vetted', side_effect=student_is_vetted) as m:
+                out = stage_material_mod.stage_material(alloc, requested_ids[0::2])
+            self.assertEqual([x['uri'] for x in out['stats']], requested_ids[0::2])
+            self.assertEqual(m.call_count, 0)
+
+    def test_hash(self):
+        """Hash-addressed material is stored, and revalidated with an ETag"""
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.stage.index import stage_index
+        self.DBSession = DBSession
+
+        self.db_stages = self.create_stages(1, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.question',
+            'ex.12',
+        ])
+        self.db_studs = self.create_students(1)
+        DBSession.flush()
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=2
+
+question <- function(permutation, data_frames) { return(list(content = paste('q1', permutation), correct = list())) }
+        ''')
+        self.mb_update()
+
+        def get_material(if_none_match=None, **params):
+            request = self.request(user=self.db_studs[0], params=dict(path=self.db_stages[0], **params))
+            request.if_none_match = Request.blank('/', headers={'If-None-Match': if_none_match} if if_none_match else {}).if_none_match
+            return view_stage_material(request)
+
+        stage = stage_index(self.request(user=self.db_studs[0], params=dict(path=self.db_stages[0])))
+        material_hash = stage['material_uri'].split('hash=')[1]
+        material = get_material()
+
+        # Out-of-date hashes get regular, uncached, material
+        self.assertEqual(get_material(hash='not-a-hash'), material)
+
+        # Matching hash returns the same material, which caches have to revalidate
+        response = get_material(hash=material_hash)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(json.loads(response.text)['data'], material['data'])
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+
+        # ...without answer counts, which would go stale. The stage has them instead
+        self.assertEqual(json.loads(response.text)['stats'], [
+            dict((k, v) for k, v in stat.items() if k not in ('chosen', 'correct'))
+            for stat in material['stats']
+        ])
+        self.assertEqual(stage['questions'], material['stats'])
+        etag = response.headers['ETag']
+        self.assertRegex(etag, r'^"[0-9a-f]{40}"$')
+
+        # Response was stored, we get the same thing again without rendering
+        (count,) = DBSession.execute("SELECT COUNT(*) FROM stage_material_response").fetchone()
+        self.assertEqual(count, 1)
+        response = get_material(hash=material_hash)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        # Matching ETag gets a 304, anything else the body
+        response = get_material(hash=material_hash, if_none_match=etag)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response = get_material(hash=material_hash, if_none_match='"abcdef"')
+        self.assertEqual(response.status_int, 200)
+
+        # Updating dataframes forgets the stored response
+        DBSession.execute("INSERT INTO student_dataframe (user_id, bank, dataframe_path, data) VALUES (:user_id, 'x', 'y', '{}')", dict(
+            user_id=self.db_studs[0].user_id,
+        ))
+        (count,) = DBSession.execute("SELECT COUNT(*) FROM stage_material_response").fetchone()
+        self.assertEqual(count, 0)
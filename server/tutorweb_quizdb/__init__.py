@@ -12,7 +12,7 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy_utils import Ltree
 from zope.sqlalchemy import register
 
-from tutorweb_quizdb import smileycoin
+from tutorweb_quizdb import rst, smileycoin
 
 
 ACTIVE_HOST = 1  # The first host should be "us"
@@ -72,6 +72,12 @@ def main(global_config, **settings):
     config.add_static_view('static', 'deform:static')
 
     smileycoin.configure(settings, prefix='smileycoin.')
+    rst.configure(settings, prefix='rst.')
+
+    from tutorweb_quizdb.material.renderer import r as r_renderer
+    from tutorweb_quizdb.material.render import configure_render_cache
+    r_renderer.configure(settings, prefix='r_render.')
+    configure_render_cache(settings, prefix='render_cache.')
 
     # Prefer outputting json over HTML (for exceptions)
     config.add_accept_view_order('text/html')
@@ -1,8 +1,10 @@
+import hashlib
 import html
 import logging
 import json
 
 from pyramid.httpexceptions import HTTPForbidden
+from zope.sqlalchemy import mark_changed
 
 from tutorweb_quizdb.student import get_group
 from tutorweb_quizdb import DBSession, Base
@@ -13,6 +15,13 @@ from .utils import material_bank_open
 
 logger = logging.getLogger(__package__)
 
+RENDER_CACHE_CONFIG = dict(
+    enabled='true',
+    max_entries=200000,  # Entries to keep in material_render_cache
+    evict_every=1000,  # Trim material_render_cache after this many new entries
+)
+_render_cache_inserts = 0
+
 
 class MissingDataException(Exception):
     status_code = 400
@@ -30,29 +39,112 @@ def dataframe_template(material_bank, path):
         return json.load(f)
 
 
-def material_render(ms, permutation, student_dataframes={}):
+def configure_render_cache(settings, prefix=''):
+    for (k, v) in settings.items():
+        if prefix:
+            if not k.startswith(prefix):
+                continue
+            k = k.replace(prefix, '')
+        if k not in RENDER_CACHE_CONFIG:
+            raise ValueError("Unknown setting (%s)%s" % (prefix, k))
+        RENDER_CACHE_CONFIG[k] = v if k == 'enabled' else int(v)
+    return RENDER_CACHE_CONFIG
+
+
+def render_cache_key(ms, permutation, student_dataframes):
     """
-    Render a question
+    Return key for the material_render_cache, or None if this render can't be cached
     """
-    # If we don't have everything we need, bleat.
-    missing = [x for x in ms.dataframe_paths if x not in student_dataframes]
-    if len(missing) > 0:
-        raise MissingDataException(missing)
+    if str(RENDER_CACHE_CONFIG['enabled']).lower() not in ('true', '1', 'yes'):
+        return None
+    if not getattr(ms, 'material_source_id', None):
+        # Not a material_source from the DB, e.g. a preview
+        return None
+    if 'type.template' in ms.material_tags and permutation < 0:
+        # User-generated content can be rewritten, so isn't safe to cache
+        return None
 
-    if ms.permutation_count < permutation:
-        # Otherwise, permutation should be in range
-        raise ValueError("Question %s only has %d permutations, not %d" % (
-            ms.path,
-            ms.permutation_count,
-            permutation,
+    # NB: The material_source_id implies a path and md5sum
+    return dict(
+        material_source_id=ms.material_source_id,
+        permutation=permutation,
+        dataframe_hash=hashlib.sha1(json.dumps(
+            dict((k, student_dataframes[k]) for k in ms.dataframe_paths),
+            sort_keys=True,
+        ).encode('utf8')).hexdigest(),
+    )
+
+
+def render_cache_get(key):
+    """Fetch any cached render for key, updating it's last_used if not touched in the last hour"""
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    row = session.execute("""
+        SELECT rendered
+             , last_used < NOW() - INTERVAL '1 hour' AS stale
+          FROM material_render_cache
+         WHERE material_source_id = :material_source_id
+           AND permutation = :permutation
+           AND dataframe_hash = :dataframe_hash
+    """, key).fetchone()
+    if row is None:
+        return None
+
+    if row[1]:
+        # Only write when last_used is out of date, so most cache hits stay read-only
+        session.execute("""
+            UPDATE material_render_cache
+               SET last_used = NOW()
+             WHERE material_source_id = :material_source_id
+               AND permutation = :permutation
+               AND dataframe_hash = :dataframe_hash
+        """, key)
+        mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+    return row[0]
+
+
+def render_cache_set(entries):
+    """
+    Store [(key, out), ...] in the render cache, evicting old entries every so often.
+    Entries are written in key order, and existing entries are left alone, so
+    concurrent requests caching the same material don't deadlock. Since any locks
+    are held until commit, call this once rendering is finished.
+    """
+    global _render_cache_inserts
+
+    entries = sorted(
+        (dict(rendered=json.dumps(out), **key) for key, out in entries),
+        key=lambda e: (e['material_source_id'], e['permutation'], e['dataframe_hash']),
+    )
+    if len(entries) == 0:
+        return
+
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    session.execute("""
+        INSERT INTO material_render_cache (material_source_id, permutation, dataframe_hash, rendered)
+             VALUES (:material_source_id, :permutation, :dataframe_hash, :rendered)
+        ON CONFLICT (material_source_id, permutation, dataframe_hash) DO NOTHING
+    """, entries)
+
+    _render_cache_inserts += len(entries)
+    if _render_cache_inserts >= RENDER_CACHE_CONFIG['evict_every']:
+        _render_cache_inserts = 0
+        session.execute("SELECT material_render_cache_evict(:max_entries)", dict(
+            max_entries=RENDER_CACHE_CONFIG['max_entries'],
         ))
+    mark_changed(session)  # Mark this session changed, so sqlalchemy commits
 
+
+def material_render_output(ms, permutation, student_dataframes={}, r_renderer=r_render):
+    """
+    Render a question with the appropriate renderer, turning any exceptions into an error
+    - r_renderer: Function to render R questions with, e.g. a RWorkerPool's render
+    """
     try:
         if 'type.template' in ms.material_tags and permutation < 0:
             # For templates, permutations < 0 are user-generated material
             out = ug_render(ms, permutation, student_dataframes)
         elif ms.path.endswith('.R'):
-            out = r_render(ms, permutation, student_dataframes)
+            out = r_renderer(ms, permutation, student_dataframes)
         else:
             raise ValueError("Don't know how to render %s" % ms.path)
     except Exception as e:
@@ -68,13 +160,54 @@ def material_render(ms, permutation, student_dataframes={}):
     if 'tags' not in out:
         # TODO: Something more sensible to do?
         out['tags'] = ms.material_tags
+    return out
+
 
+def material_render_check(ms, permutation, student_dataframes={}):
+    """
+    Make sure we have everything needed to render (ms, permutation), raise an exception otherwise
+    """
+    # If we don't have everything we need, bleat.
+    missing = [x for x in ms.dataframe_paths if x not in student_dataframes]
+    if len(missing) > 0:
+        raise MissingDataException(missing)
+
+    if ms.permutation_count < permutation:
+        # Otherwise, permutation should be in range
+        raise ValueError("Question %s only has %d permutations, not %d" % (
+            ms.path,
+            ms.permutation_count,
+            permutation,
+        ))
+
+
+def material_render(ms, permutation, student_dataframes={}, new_cache_entries=None):
+    """
+    Render a question, using material_render_cache if we've rendered it before
+    - new_cache_entries: If given, a list to add new (key, out) entries to, for
+      render_cache_set() once all rendering is done. Otherwise store immediately
+    """
+    material_render_check(ms, permutation, student_dataframes)
+
+    cache_key = render_cache_key(ms, permutation, student_dataframes)
+    if cache_key is not None:
+        out = render_cache_get(cache_key)
+        if out is not None:
+            return out
+
+    out = material_render_output(ms, permutation, student_dataframes)
+
+    if cache_key is not None and 'error' not in out:
+        if new_cache_entries is None:
+            render_cache_set([(cache_key, out)])
+        else:
+            new_cache_entries.append((cache_key, out))
     return out
 
 
 def view_material_render(request):
-    from tutorweb_quizdb.material.utils import file_md5sum, path_to_materialsource
-    import os.path
+    from tutorweb_quizdb.material.update import indexed_md5sum
+    from tutorweb_quizdb.material.utils import path_to_materialsource
 
     if not request.user or get_group('admin.material_render') not in request.user.groups:
         raise HTTPForbidden()
@@ -83,7 +216,7 @@ def view_material_render(request):
     material_bank = request.json.get('material_bank', request.registry.settings['tutorweb.material_bank.default'])
     ms = Base.classes.material_source(
         **path_to_materialsource(material_bank, request.json['path'], None, git_broken_okay=True),
-        md5sum=file_md5sum(os.path.join(material_bank, request.json['path'])))
+        md5sum=indexed_md5sum(material_bank, request.json['path']))
 
     # Find all data templates for this question, and add to response
     out = dict(dataframe_templates={})
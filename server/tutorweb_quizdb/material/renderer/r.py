@@ -1,6 +1,9 @@
 import json
+import multiprocessing
 import os
+import resource
 import threading
+import types
 import warnings
 
 import rpy2.rinterface
@@ -11,6 +14,37 @@ from rpy2.robjects.packages import importr
 R_INTERPRETER_LOCK = threading.Lock()
 jsonlite = importr("jsonlite")
 
+CONFIG = dict(
+    pool_size=0,  # Number of R worker processes, 0 renders within this process
+    timeout=30,  # Seconds a render can take before the worker is killed
+    max_renders=1000,  # Replace worker after this many renders
+    max_memory=0,  # Replace worker once it's peak resident memory goes above this many MiB
+    python_executable='',  # Python binary for workers, if sys.executable isn't (e.g. uwsgi)
+)
+INT_SETTINGS = set(('pool_size', 'timeout', 'max_renders', 'max_memory'))
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(settings, prefix=''):
+    global _pool
+
+    for (k, v) in settings.items():
+        if prefix:
+            if not k.startswith(prefix):
+                continue
+            k = k.replace(prefix, '')
+        if k not in CONFIG:
+            raise ValueError("Unknown setting (%s)%s" % (prefix, k))
+        CONFIG[k] = int(v) if k in INT_SETTINGS else v
+
+    # Any existing pool will have the old configuration
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    return CONFIG
+
 
 def rob_to_dict(a):
     """
@@ -38,8 +72,14 @@ def rob_to_dict(a):
 
 
 def r_render(ms, permutation, student_dataframes={}):
-    """Execute R script to generate content"""
-    # TODO: Caching of question objects?
+    """Execute R script to generate content, using the worker pool if configured"""
+    if CONFIG['pool_size'] > 0:
+        return get_pool().render(ms, permutation, student_dataframes)
+    return r_render_local(ms, permutation, student_dataframes)
+
+
+def r_render_local(ms, permutation, student_dataframes={}):
+    """Execute R script to generate content within this process"""
     with R_INTERPRETER_LOCK:
         try:
             old_wd = os.getcwd()
@@ -63,3 +103,165 @@ def r_render(ms, permutation, student_dataframes={}):
             return rv
         finally:
             os.chdir(old_wd)
+
+
+def get_pool():
+    """Return the worker pool, starting it if need be"""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = RWorkerPool(**CONFIG)
+        return _pool
+
+
+def pool_stats():
+    """Return queue depth / worker metrics for the pool, or None if not in use"""
+    return _pool.stats() if _pool is not None else None
+
+
+def r_worker_main(conn):
+    """Worker process: render whatever we're sent, until the pipe closes"""
+    while True:
+        try:
+            (ms_attrs, permutation, student_dataframes) = conn.recv()
+        except EOFError:
+            return
+        try:
+            out = ('ok', r_render_local(types.SimpleNamespace(**ms_attrs), permutation, student_dataframes))
+        except Exception as e:
+            out = ('error', e)
+
+        # Report peak memory usage (in KiB on Linux), so the pool can decide to recycle us
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            conn.send(out + (maxrss,))
+        except Exception:
+            # Exception couldn't be pickled, send something that can
+            conn.send(('error', ValueError("%s: %s" % (out[1].__class__.__name__, out[1])), maxrss))
+
+
+class RWorker():
+    def __init__(self, ctx):
+        (self.conn, child_conn) = ctx.Pipe()
+        self.process = ctx.Process(target=r_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.renders = 0
+        self.maxrss = 0
+
+    def close(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class RWorkerPool():
+    """
+    Pool of processes each with their own R interpreter, so renders don't
+    block each other behind R_INTERPRETER_LOCK
+    """
+    def __init__(self, pool_size, timeout, max_renders, max_memory, python_executable=''):
+        self.ctx = multiprocessing.get_context('spawn')  # NB: Forking an embedded R isn't safe
+        if python_executable:
+            self.ctx.set_executable(python_executable)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_renders = max_renders
+        self.max_memory = max_memory
+
+        self.cond = threading.Condition()
+        self.closed = False
+        self.idle = []
+        self.worker_count = 0
+        self.counters = dict(
+            waiting=0,
+            renders=0,
+            timeouts=0,
+            recycled=0,
+        )
+
+    def _acquire(self):
+        with self.cond:
+            self.counters['waiting'] += 1
+            try:
+                while len(self.idle) == 0 and self.worker_count >= self.pool_size:
+                    self.cond.wait()
+                if len(self.idle) > 0:
+                    return self.idle.pop()
+                self.worker_count += 1
+            finally:
+                self.counters['waiting'] -= 1
+
+        # Start a new worker outside the lock, it can take a while
+        try:
+            return RWorker(self.ctx)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, worker):
+        if worker is not None and self.closed:
+            # Pool is shutting down, don't keep this worker
+            worker.close()
+            worker = None
+
+        with self.cond:
+            if worker is None:
+                self.worker_count -= 1
+            else:
+                self.idle.append(worker)
+            self.cond.notify()
+
+    def render(self, ms, permutation, student_dataframes={}):
+        """Render (ms) in one of the workers, waiting for one to become free"""
+        worker = self._acquire()
+        try:
+            worker.conn.send((dict(bank=ms.bank, path=ms.path), permutation, student_dataframes))
+            if not worker.conn.poll(self.timeout):
+                with self.cond:
+                    self.counters['timeouts'] += 1
+                raise TimeoutError("R question %s took longer than %d seconds to render" % (ms.path, self.timeout))
+            (status, out, worker.maxrss) = worker.conn.recv()
+            worker.renders += 1
+        except Exception:
+            # Can't be sure what state the worker is in, replace it
+            worker.close()
+            self._release(None)
+            raise
+
+        with self.cond:
+            self.counters['renders'] += 1
+        if worker.renders >= self.max_renders or (self.max_memory and worker.maxrss > self.max_memory * 1024):
+            with self.cond:
+                self.counters['recycled'] += 1
+            worker.close()
+            self._release(None)
+        else:
+            self._release(worker)
+
+        if status == 'error':
+            raise out
+        return out
+
+    def stats(self):
+        """Return queue depth & worker metrics"""
+        with self.cond:
+            return dict(
+                workers=self.worker_count,
+                idle=len(self.idle),
+                busy=self.worker_count - len(self.idle),
+                **self.counters
+            )
+
+    def close(self):
+        """Stop all idle workers, busy workers will be closed when released"""
+        with self.cond:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.worker_count -= len(idle)
+        for w in idle:
+            w.close()
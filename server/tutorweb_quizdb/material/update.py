@@ -1,29 +1,161 @@
+import concurrent.futures
 import os
+import time
+import types
+
+from zope.sqlalchemy import mark_changed
 
 from tutorweb_quizdb import DBSession, Base
 
-from tutorweb_quizdb.material.render import material_render
-from tutorweb_quizdb.material.utils import path_tags, file_md5sum, path_to_materialsource
+from tutorweb_quizdb.material.render import material_render, material_render_output, render_cache_key, render_cache_set
+from tutorweb_quizdb.material.utils import path_tags, file_md5sum, files_md5sum, path_to_materialsource, git_head, git_changed_paths, git_tracked_paths, GitRevisions
+
+RACY_WINDOW_NS = 2 * 10 ** 9  # Files modified this close to a scan could change again without their mtime changing
 
 
-def update(material_bank):
+def walk_material_bank(material_bank):
     """
-    Ingest material from a given path and update database on it's existence
+    Yield paths of all material files within the bank
     """
-    # Generate dict of path => md5sum
-    material_paths = {}
     for root, dirs, files in os.walk(material_bank):
         if '.git' in root:
             continue
         for f in files:
             if len(path_tags(f)) > 0:  # i.e. This file has a recognisable type, not just something to ignore
-                material_paths[os.path.normpath(os.path.join(os.path.relpath(root, material_bank), f))] = file_md5sum(os.path.join(root, f))
+                yield os.path.normpath(os.path.join(os.path.relpath(root, material_bank), f))
+
+
+def scan_material_bank(material_bank, incremental=False):
+    """
+    Return dict of path => md5sum for all material in the bank, and update the
+    material_bank_file index of what we found.
+
+    If (incremental), only consider files git says have changed since the last
+    scan, and only read files whose size / mtime don't match the index.
+    """
+    scan_time_ns = time.time_ns()
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    index = dict(
+        (path, (size, mtime_ns, md5sum))
+        for (path, size, mtime_ns, md5sum)
+        in session.execute("""
+            SELECT path, size, mtime_ns, md5sum FROM material_bank_file WHERE bank = :bank
+        """, dict(bank=material_bank))
+    )
+    prev_scan = session.execute("""
+        SELECT git_commit, scan_time_ns FROM material_bank_scan WHERE bank = :bank
+    """, dict(bank=material_bank)).fetchone()
+    git_commit = git_head(material_bank)
+
+    # Files changed just before the last scan might have been changed again without altering mtime
+    racy_after = prev_scan[1] - RACY_WINDOW_NS if prev_scan else None
+
+    git_changed = None
+    if incremental and prev_scan and prev_scan[0] and git_commit and len(index) > 0:
+        git_changed = git_changed_paths(material_bank, prev_scan[0])
+    if git_changed is not None:
+        # Only look at what git thinks has changed, and anything we weren't sure of last time
+        to_check = set(p for p in git_changed if len(path_tags(p)) > 0)
+        to_check.update(p for p, (size, mtime_ns, md5sum) in index.items() if mtime_ns >= racy_after)
+        # Git won't tell us if untracked files get removed, so check those too
+        tracked = git_tracked_paths(material_bank)
+        to_check.update(p for p in index.keys() if p not in tracked)
+        material_paths = dict((p, md5sum) for p, (size, mtime_ns, md5sum) in index.items() if p not in to_check)
+    else:
+        to_check = walk_material_bank(material_bank)
+        material_paths = {}
+
+    stats = {}
+    to_hash = []
+    for path in to_check:
+        try:
+            stats[path] = os.stat(os.path.join(material_bank, path))
+        except FileNotFoundError:
+            continue  # Removed, will get dropped from index below
+        prev = index.get(path, None)
+        st = stats[path]
+        if incremental and prev and prev[0:2] == (st.st_size, st.st_mtime_ns) and (racy_after is None or st.st_mtime_ns < racy_after):
+            # Unchanged since last time, don't bother reading
+            material_paths[path] = prev[2]
+        else:
+            to_hash.append(path)
+
+    # Read all changed files in parallel
+    md5sums = files_md5sum(os.path.join(material_bank, path) for path in to_hash)
+    for path in to_hash:
+        material_paths[path] = md5sums[os.path.join(material_bank, path)]
+
+    index_updates = []
+    for path, st in stats.items():
+        if index.get(path, None) != (st.st_size, st.st_mtime_ns, material_paths[path]):
+            index_updates.append(dict(
+                bank=material_bank,
+                path=path,
+                size=st.st_size,
+                mtime_ns=st.st_mtime_ns,
+                md5sum=material_paths[path],
+            ))
+
+    # Write back changes to index
+    if len(index_updates) > 0:
+        session.execute("""
+            INSERT INTO material_bank_file (bank, path, size, mtime_ns, md5sum)
+                 VALUES (:bank, :path, :size, :mtime_ns, :md5sum)
+            ON CONFLICT (bank, path) DO UPDATE
+                    SET size = EXCLUDED.size
+                      , mtime_ns = EXCLUDED.mtime_ns
+                      , md5sum = EXCLUDED.md5sum
+        """, index_updates)
+    removed = [p for p in index.keys() if p not in material_paths]
+    if len(removed) > 0:
+        session.execute("""
+            DELETE FROM material_bank_file WHERE bank = :bank AND path = ANY(:paths)
+        """, dict(bank=material_bank, paths=removed))
+    session.execute("""
+        INSERT INTO material_bank_scan (bank, git_commit, scan_time_ns)
+             VALUES (:bank, :git_commit, :scan_time_ns)
+        ON CONFLICT (bank) DO UPDATE
+                SET git_commit = EXCLUDED.git_commit
+                  , scan_time_ns = EXCLUDED.scan_time_ns
+    """, dict(bank=material_bank, git_commit=git_commit, scan_time_ns=scan_time_ns))
+    mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+
+    return material_paths
+
+
+def indexed_md5sum(material_bank, path):
+    """
+    Return md5sum of (path) within the bank, using the material_bank_file index
+    instead of reading the file if it hasn't changed since the last scan
+    """
+    full_path = os.path.join(material_bank, path)
+    st = os.stat(full_path)
+    row = DBSession.execute("""
+        SELECT mbf.size, mbf.mtime_ns, mbf.md5sum, mbs.scan_time_ns
+          FROM material_bank_file mbf
+          JOIN material_bank_scan mbs ON mbs.bank = mbf.bank
+         WHERE mbf.bank = :bank
+           AND mbf.path = :path
+    """, dict(bank=material_bank, path=os.path.normpath(path))).fetchone()
+    if row is not None and (row[0], row[1]) == (st.st_size, st.st_mtime_ns) and st.st_mtime_ns < row[3] - RACY_WINDOW_NS:
+        return row[2]
+    return file_md5sum(full_path)
+
+
+def update(material_bank, incremental=False):
+    """
+    Ingest material from a given path and update database on it's existence
+    - incremental: Only read files that have changed since the last update, see scan_material_bank()
+    """
+    # Generate dict of path => md5sum
+    material_paths = scan_material_bank(material_bank, incremental=incremental)
+    git_revisions = GitRevisions(material_bank)  # NB: Only asks git once a revision is needed
 
     # For all paths in the database...
     for m in DBSession.query(Base.classes.material_source).filter_by(bank=material_bank, next_material_source_id=None):
         if material_paths.get(m.path, None) != m.md5sum:
             # MD5sum changed (or file now nonexistant), add new materialsource entry
-            new_m = Base.classes.material_source(**path_to_materialsource(material_bank, m.path, m.revision), md5sum=material_paths.get(m.path, None))
+            new_m = Base.classes.material_source(**path_to_materialsource(material_bank, m.path, m.revision, git_revisions=git_revisions), md5sum=material_paths.get(m.path, None))
             DBSession.add(new_m)
             DBSession.flush()
             m.next_material_source_id = new_m.material_source_id
@@ -40,7 +172,7 @@ def update(material_bank):
 
     # For any remaining paths, insert afresh into DB
     for path, md5sum in material_paths.items():
-        new_m = Base.classes.material_source(**path_to_materialsource(material_bank, path, None), md5sum=md5sum)
+        new_m = Base.classes.material_source(**path_to_materialsource(material_bank, path, None, git_revisions=git_revisions), md5sum=md5sum)
         DBSession.add(new_m)
         # Make sure this new item renders before we carry on
         if new_m.permutation_count > 0:
@@ -49,6 +181,82 @@ def update(material_bank):
     DBSession.flush()
 
 
+def warm_render_cache(material_bank, processes=4, material=None):
+    """
+    Render every permutation of current material that isn't in material_render_cache yet,
+    using a pool of (processes) R workers. Returns a summary of what was done
+    - material: Only render these (mss_id, permutation) tuples, from any bank
+    """
+    from tutorweb_quizdb.material.renderer import r as r_renderer
+
+    q = DBSession.query(Base.classes.material_source)
+    if material is None:
+        wanted = None
+        q = q.filter_by(bank=material_bank, next_material_source_id=None)
+    else:
+        wanted = {}
+        for mss_id, permutation in material:
+            wanted.setdefault(mss_id, set()).add(permutation)
+        if len(wanted) == 0:
+            return dict(rendered=0, failures=[])
+        q = q.filter(Base.classes.material_source.material_source_id.in_(wanted.keys()))
+
+    # Find everything that needs rendering. NB: Questions that use dataframes depend on the student, so can't be warmed
+    to_render = []
+    for m in q:
+        if len(m.dataframe_paths) > 0:
+            continue
+        # NB: A detached copy, so worker threads don't touch the DB session
+        ms = types.SimpleNamespace(**dict((k, getattr(m, k)) for k in (
+            'material_source_id', 'bank', 'path', 'material_tags', 'dataframe_paths', 'permutation_count',
+        )))
+        cache_key = render_cache_key(ms, 1, {})
+        if cache_key is None:
+            # Caching turned off, nothing to warm
+            continue
+        cached = set(x[0] for x in DBSession.execute("""
+            SELECT permutation FROM material_render_cache
+             WHERE material_source_id = :material_source_id
+               AND dataframe_hash = :dataframe_hash
+        """, cache_key))
+        for permutation in range(1, ms.permutation_count + 1):
+            if permutation in cached:
+                continue
+            if wanted is not None and permutation not in wanted[ms.material_source_id]:
+                continue
+            to_render.append((ms, permutation))
+
+    summary = dict(
+        rendered=0,
+        failures=[],
+    )
+    if len(to_render) == 0:
+        return summary
+
+    new_cache_entries = []
+    pool = r_renderer.RWorkerPool(**dict(r_renderer.CONFIG, pool_size=processes))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+            futures = dict(
+                (executor.submit(material_render_output, ms, permutation, {}, pool.render), (ms, permutation))
+                for ms, permutation in to_render
+            )
+            for future in concurrent.futures.as_completed(futures):
+                (ms, permutation) = futures[future]
+                out = future.result()
+                if 'error' in out:
+                    summary['failures'].append((ms.path, permutation, out['content']))
+                else:
+                    new_cache_entries.append((render_cache_key(ms, permutation, {}), out))
+                    summary['rendered'] += 1
+    finally:
+        pool.close()
+    render_cache_set(new_cache_entries)
+
+    summary['failures'].sort()
+    return summary
+
+
 def view_material_update(request):
     return update(
         material_bank=request.registry.settings['tutorweb.material_bank.default'],
@@ -64,9 +272,48 @@ def script_material_update():
 
     argparse_arguments = [
         dict(description='Update material bank database from file-system'),
+        dict(
+            name='--full',
+            help="Read every file in the material bank, rather than only those that have changed since last time",
+            action="store_true",
+            default=False,
+        ),
+        dict(
+            name='--warm',
+            help="Afterwards, pre-render all new material with this many R processes",
+            type=int,
+            default=0,
+        ),
+    ]
+
+    with setup_script(argparse_arguments) as env:
+        material_bank = env['request'].registry.settings['tutorweb.material_bank.default']
+        update(material_bank=material_bank, incremental=not env['args'].full)
+        if env['args'].warm > 0:
+            print_warm_summary(warm_render_cache(material_bank, processes=env['args'].warm))
+
+
+def script_material_warm():
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Pre-render all permutations of material into the render cache'),
+        dict(
+            name='--processes',
+            help="Number of R processes to render with",
+            type=int,
+            default=4,
+        ),
     ]
 
     with setup_script(argparse_arguments) as env:
-        return update(
+        print_warm_summary(warm_render_cache(
             material_bank=env['request'].registry.settings['tutorweb.material_bank.default'],
-        )
+            processes=env['args'].processes,
+        ))
+
+
+def print_warm_summary(summary):
+    for (path, permutation, error) in summary['failures']:
+        print("%s:%d: %s" % (path, permutation, error))
+    print("Rendered %d permutations, %d failures" % (summary['rendered'], len(summary['failures'])))
@@ -1,3 +1,4 @@
+import concurrent.futures
 import hashlib
 import os.path
 import re
@@ -6,6 +7,8 @@ import git
 
 
 MAX_TEMPLATE_PERMUTATIONS = 10  # After this we consider them ugmaterial
+MD5_CHUNK_SIZE = 1024 * 1024
+MD5_WORKERS = 8
 
 
 def path_tags(path):
@@ -31,17 +34,146 @@ def parse_list(line):
             yield x
 
 
-def file_md5sum(path):
+def file_md5sum(path, chunk_size=MD5_CHUNK_SIZE):
     """
-    Return MD5-sum string of file at (path)
+    Return MD5-sum string of file at (path), reading (chunk_size) bytes at a time
     """
+    h = hashlib.md5()
     with open(path, 'rb') as f:
-        return(hashlib.md5(f.read()).hexdigest())
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def files_md5sum(paths, max_workers=MD5_WORKERS):
+    """
+    Return dict of path -> MD5-sum string for all (paths), hashed in parallel
+    NB: hashlib releases the GIL whilst hashing, so threads are enough
+    """
+    paths = list(paths)
+    if len(paths) < 2 or max_workers < 2:
+        return dict((p, file_md5sum(p)) for p in paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(file_md5sum, paths)))
+
+
+def git_head(material_bank):
+    """
+    Return the commit the material bank currently has checked out, or None if not a git repository
+    """
+    try:
+        return git.Repo(material_bank).head.commit.hexsha
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError, ValueError):
+        return None
+
+
+def git_changed_paths(material_bank, since_commit):
+    """
+    Return set of paths that differ in the working tree from (since_commit),
+    including untracked files. None if git can't tell us
+    """
+    repo = git.Repo(material_bank)
+    try:
+        out = repo.git.diff('--name-only', '--no-renames', '-z', since_commit).split('\0')
+    except git.GitCommandError:
+        # Commit no longer exists, e.g. history rewritten
+        return None
+    out.extend(repo.untracked_files)
+    return set(os.path.normpath(p) for p in out if p)
+
+
+def git_tracked_paths(material_bank):
+    """
+    Return set of all paths git is tracking
+    """
+    repo = git.Repo(material_bank)
+    return set(os.path.normpath(p) for p in repo.git.ls_files('-z').split('\0') if p)
+
+
+class GitRevisions():
+    """
+    Find the last commit for many files at once, from a single git log / git
+    status, rather than asking git about each file in turn
+    """
+    def __init__(self, material_bank, git_broken_okay=False):
+        self.material_bank = material_bank
+        self.git_broken_okay = git_broken_okay
+        self._last_commit = None
+        self._dirty = None
+
+    def _load(self):
+        repo = git.Repo(self.material_bank)
+        self._last_commit = {}
+        self._dirty = set()
+
+        # Log is newest first, so the first time we see a path is it's last commit
+        if repo.head.is_valid():
+            # Output is NUL-separated: "\x01(commit)", "\n(first path)", "(path)", ... "\x01(commit)", ...
+            commit = None
+            for entry in repo.git.log('--name-only', '--no-renames', '-z', '--format=%x01%H').split('\0'):
+                if entry.startswith('\x01'):
+                    commit = entry[1:]
+                    continue
+                entry = entry.lstrip('\n')
+                if entry:
+                    self._last_commit.setdefault(os.path.normpath(entry), commit)
+
+        # Status entries are "XY path", renames / copies are followed by the original path
+        entries = iter(repo.git.status('--porcelain', '-z', '--untracked-files=all').split('\0'))
+        for entry in entries:
+            if not entry:
+                continue
+            self._dirty.add(os.path.normpath(entry[3:]))
+            if entry[0] in 'RC':
+                self._dirty.add(os.path.normpath(next(entries)))
+
+    def revision(self, path, prev_revision):
+        """
+        Find out git revision for file, adding to it for each dirty version we see
+        """
+        if self._last_commit is None:
+            try:
+                self._load()
+            except (ValueError, git.GitCommandError) as e:
+                if self.git_broken_okay:
+                    # NB: Later versions of git can fail to read version information on a repository we don't own:
+                    #     ValueError: SHA could not be resolved, git returned: b''
+                    #     /preview has no need for the revision anyway, so ignore the error.
+                    return '(git-error)'
+                raise e
+        path = os.path.normpath(path)
+        return _add_rev_count(
+            self._last_commit.get(path, '(untracked)'),
+            prev_revision,
+            lambda: path in self._dirty,
+        )
+
+
+def _add_rev_count(git_revision, prev_revision, is_dirty):
+    """
+    Add a count of dirty versions we've seen to (git_revision)
+    - is_dirty: Function returning True iff the file differs from git_revision
+    """
+    m = re.search(r'^(.*)\+(\d+)$', prev_revision) if prev_revision else None
+    if m and m.group(1) == git_revision:
+        # The previous git revision is the same as this one, our count should be one higher
+        rev_count = int(m.group(2) or '0') + 1
+    elif prev_revision == git_revision:
+        # We're part of the same revision, which was clean from git
+        # NB: We know at this point the file is different, no point re-checking
+        rev_count = 1
+    else:
+        # New revision, start from 1 if it's dirty
+        rev_count = 1 if is_dirty() else 0
+
+    # Add rev_count to git_revision if it's greater than zero
+    return "%s+%d" % (git_revision, rev_count) if rev_count > 0 else git_revision
 
 
 def _file_revision(material_bank, path, prev_revision, git_broken_okay=False):
     """
     Find out git revision for file, adding to it for each dirty version we see
+    NB: Only asks git about (path), use GitRevisions when resolving many paths
     """
     # Get git revision for file
     repo = git.Repo(material_bank)
@@ -58,21 +190,11 @@ def _file_revision(material_bank, path, prev_revision, git_broken_okay=False):
     for rev in revs:
         git_revision = str(rev)
 
-    m = re.search(r'^(.*)\+(\d+)$', prev_revision) if prev_revision else None
-    if m and m.group(1) == git_revision:
-        # The previous git revision is the same as this one, our count should be one higher
-        rev_count = int(m.group(2) or '0') + 1
-    elif prev_revision == git_revision:
-        # We're part of the same revision, which was clean from git
-        # NB: We know at this point the file is different, no point re-checking
-        rev_count = 1
-    else:
-        # New revision, start from 1 if it's dirty
-        is_dirty = repo.is_dirty(path=path, untracked_files=True)
-        rev_count = 1 if is_dirty else 0
-
-    # Add rev_count to git_revision if it's greater than zero
-    return "%s+%d" % (git_revision, rev_count) if rev_count > 0 else git_revision
+    return _add_rev_count(
+        git_revision,
+        prev_revision,
+        lambda: repo.is_dirty(path=path, untracked_files=True),
+    )
 
 
 def material_bank_open(material_bank, path, *args):
@@ -82,10 +204,11 @@ def material_bank_open(material_bank, path, *args):
     return open(combined_path, *args)
 
 
-def path_to_materialsource(material_bank, path, prev_revision, git_broken_okay=False):
+def path_to_materialsource(material_bank, path, prev_revision, git_broken_okay=False, git_revisions=None):
     """
     Read in metadata from file, turn into dict of options
     to create materialsource
+    - git_revisions: GitRevisions object to use, if resolving many paths at once
     """
     file_metadata = dict(TAGS='')
     setting_re = re.compile(r'^[#]\s*TW:(\w+)=(.*)')
@@ -95,7 +218,10 @@ def path_to_materialsource(material_bank, path, prev_revision, git_broken_okay=F
                 m = setting_re.search(line)
                 if m:
                     file_metadata[m.group(1)] = m.group(2)
-        revision = _file_revision(material_bank, path, prev_revision, git_broken_okay)
+        if git_revisions is None:
+            revision = _file_revision(material_bank, path, prev_revision, git_broken_okay)
+        else:
+            revision = git_revisions.revision(path, prev_revision)
     except FileNotFoundError:
         file_metadata = dict(
             PERMUTATIONS=0,
@@ -1,15 +1,186 @@
+import collections
+import hashlib
 import html
 import io
+import logging
+import os
 import re
+import tempfile
+import threading
 
 from html5css3 import Writer as Html5Writer
 from docutils.core import publish_string
 
 
+logger = logging.getLogger(__package__)
+
 MESSAGE_TEMPLATE = '<div class="system-message %s"><div class="system-message-title">System message:</div>%s</div>'
 
+# Single line of words & punctuation that can't be a list / section / inline markup, i.e. docutils will only wrap in <p>
+PLAIN_TEXT_RE = re.compile(r"^[A-Za-z0-9]+(?:[ ,][A-Za-z0-9 ,.!?'\"()\-]*)?$")
+
+CONFIG = dict(
+    cache_size=2000,  # Fragments to keep in memory
+    cache_dir='',  # Directory to share cached fragments between processes, if any
+    cache_dir_size=100000,  # Fragments to keep in cache_dir
+    cache_dir_evict_every=1000,  # Trim cache_dir after this many new fragments
+)
+CACHE_STATS = dict(
+    hits=0,
+    disk_hits=0,
+    misses=0,
+    plain_text=0,
+)
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+_disk_writes = 0
+
+
+def configure(settings, prefix=''):
+    for (k, v) in settings.items():
+        if prefix:
+            if not k.startswith(prefix):
+                continue
+            k = k.replace(prefix, '')
+        if k not in CONFIG:
+            raise ValueError("Unknown setting (%s)%s" % (prefix, k))
+        CONFIG[k] = v if k == 'cache_dir' else int(v)
+    cache_clear()
+    return CONFIG
+
+
+def cache_clear():
+    """Empty the in-process cache & reset counters"""
+    global _disk_writes
+
+    with _cache_lock:
+        _cache.clear()
+        _disk_writes = 0
+        for k in CACHE_STATS.keys():
+            CACHE_STATS[k] = 0
+
+
+def cache_stats():
+    """Return hit/miss counters for the cache"""
+    with _cache_lock:
+        return dict(size=len(_cache), **CACHE_STATS)
+
+
+def _disk_path(key):
+    return os.path.join(CONFIG['cache_dir'], key[:2], key + '.html')
+
+
+def _cache_get(key):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            CACHE_STATS['hits'] += 1
+            return _cache[key]
+
+    if CONFIG['cache_dir']:
+        try:
+            with open(_disk_path(key), 'r', encoding='utf8') as f:
+                out = f.read()
+        except OSError:
+            # Not there, or disk cache unreadable. Either way render it again
+            pass
+        else:
+            try:
+                os.utime(_disk_path(key))  # NB: Mark as recently used, so _disk_evict keeps it
+            except OSError:
+                pass
+            with _cache_lock:
+                CACHE_STATS['disk_hits'] += 1
+            _cache_set(key, out, write_disk=False)
+            return out
+
+    with _cache_lock:
+        CACHE_STATS['misses'] += 1
+    return None
+
+
+def _cache_set(key, out, write_disk=True):
+    global _disk_writes
+
+    with _cache_lock:
+        _cache[key] = out
+        _cache.move_to_end(key)
+        while len(_cache) > CONFIG['cache_size']:
+            _cache.popitem(last=False)
+
+    if write_disk and CONFIG['cache_dir']:
+        try:
+            _disk_write(key, out)
+        except OSError as e:
+            # Disk full / read-only, carry on with what we rendered
+            logger.warning("Could not write RST cache entry %s: %s" % (key, e))
+            return
+
+        with _cache_lock:
+            _disk_writes += 1
+            evict = _disk_writes >= CONFIG['cache_dir_evict_every']
+            if evict:
+                _disk_writes = 0
+        if evict:
+            _disk_evict()
+
+
+def _disk_write(key, out):
+    """Write to a temporary file first, so other processes never see half a file"""
+    os.makedirs(os.path.dirname(_disk_path(key)), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(_disk_path(key)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(out)
+        os.replace(tmp_path, _disk_path(key))
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _disk_evict():
+    """Remove least recently used fragments from cache_dir, until there's only cache_dir_size left"""
+    entries = []
+    for (dirpath, dirnames, filenames) in os.walk(CONFIG['cache_dir']):
+        for filename in filenames:
+            if not filename.endswith('.html'):
+                # NB: Could be another process' half-written temporary file
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # Another process got there first
+                pass
+
+    entries.sort()
+    for (mtime, path) in entries[:max(len(entries) - CONFIG['cache_dir_size'], 0)]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
 
 def to_rst(incoming):
+    """Convert RST -> HTML, using cached output if we've seen incoming before"""
+    if PLAIN_TEXT_RE.match(incoming):
+        # Nothing for docutils to do, don't bother
+        with _cache_lock:
+            CACHE_STATS['plain_text'] += 1
+        return '<p>%s</p>' % incoming.rstrip()
+
+    key = hashlib.sha256(incoming.encode('utf8')).hexdigest()
+    out = _cache_get(key)
+    if out is None:
+        out = _to_rst(incoming)
+        _cache_set(key, out)
+    return out
+
+
+def _to_rst(incoming):
     """Convert RST -> HTML"""
     warnings = io.StringIO()
     try:
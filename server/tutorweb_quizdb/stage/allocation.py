@@ -3,17 +3,71 @@ import hashlib
 import random
 import struct
 
-from sqlalchemy import column, select, table, tuple_
+import numpy
+from sqlalchemy import column, select, table
+from zope.sqlalchemy import mark_changed
 
 import skippy
 
 from tutorweb_quizdb import DBSession
 
 
+EXAM_PAPERS_DEFAULT = 10  # Number of papers to generate for an exam stage
+
+
+def stage_material_list(db_stage):
+    """
+    Return a tuple of (mss_id, permutation) tuples for all current material in
+    a stage, in a stable order. stage_material is kept up to date by triggers,
+    so this is a single index scan
+    """
+    q = select([
+        column('material_source_id'),
+        column('permutation'),
+    ]).select_from(table('stage_material')).where(
+        column('stage_id') == db_stage.stage_id
+    ).order_by(column('material_source_id'), column('permutation'))
+    return tuple((mss_id, permutation) for mss_id, permutation in DBSession.execute(q))
+
+
+def question_weights(chosen, correct, grade, gpow=1, rng=numpy.random):
+    """
+    Vectorised version of questionDistribution() in client/lib/iaa.js, given
+    arrays of chosen/correct counts & student's grade (0..10), return an array
+    of relative probabilities of choosing each question
+    """
+    n = len(chosen)
+    if n == 0:
+        return numpy.zeros(0)
+
+    # Questions with enough answers are placed by how often they are answered incorrectly
+    # New questions are marked easy / hard, so they are likely to get them regardless.
+    difficulty_new = ((chosen - correct) / 2.0 + rng.random(n)) / 100.0
+    difficulty = numpy.where(
+        chosen > 5,
+        1.0 - correct / numpy.maximum(chosen, 1),
+        difficulty_new if grade < 1.5 else 1.0 - difficulty_new,
+    )
+
+    # Position of each question when sorted by difficulty
+    rank = numpy.empty(n, dtype=numpy.int64)
+    rank[numpy.argsort(difficulty, kind='stable')] = numpy.arange(n)
+
+    # ia_pdf(): pdf = x^alpha * (1-x)^beta, in log space so large stages don't underflow
+    x = (rank + 1) / (n + 1.0)
+    q = n / 10.0
+    alpha = q * (min(max(grade, 0), 10) / 10.0) ** gpow
+    beta = q - alpha
+    log_pdf = alpha * numpy.log(x) + beta * numpy.log1p(-x)
+    return numpy.exp(log_pdf - log_pdf.max())
+
+
 def get_allocation(settings, *args, **kwargs):
     name = settings.get('allocation_method', 'original')
     if name == 'original':
         return OriginalAllocation(settings, *args, **kwargs)
+    elif name == 'adaptive':
+        return AdaptiveAllocation(settings, *args, **kwargs)
     elif name == 'passthrough':
         return PassThroughAllocation(settings, *args, **kwargs)
     elif name == 'exam':
@@ -33,12 +87,7 @@ class BaseAllocation():
         Return a list of mss_id/permutation/answered/correct tuples
         of suitable material for this student.
         """
-        q = select([
-            column('material_source_id'),
-            column('permutation'),
-        ]).select_from(table('stage_material')).where(column('stage_id') == self.db_stage.stage_id)
-
-        return DBSession.execute(q).fetchall()
+        return list(stage_material_list(self.db_stage))
 
     def to_public_id(self, mss_id, permutation):
         """
@@ -52,38 +101,55 @@ class BaseAllocation():
         """
         return tuple(int(x) for x in public_id.split(":", 1))
 
+    def to_public_ids(self, material):
+        """
+        Turn a list of (mss_id, permutation) tuples into public question IDs
+        """
+        return [self.to_public_id(mss_id, permutation) for mss_id, permutation in material]
+
+    def from_public_ids(self, public_ids):
+        """
+        Turn a list of public IDs back into (mss_id, permutation) tuples
+        """
+        return [self.from_public_id(x) for x in public_ids]
+
     def get_stats(self, public_ids):
         """
         Fetch the updated answered/correct stats for given public IDs
         """
-        q = select([
-            column('material_source_id'),
-            column('permutation'),
-            column('answered'),
-            column('correct'),
-        ]).select_from(table('answer_stats')).where(column('stage_id') == self.db_stage.stage_id)
-
-        q = q.where(tuple_(
-            column('material_source_id'),
-            column('permutation')
-        ).in_(self.from_public_id(x) for x in public_ids))
+        material = self.from_public_ids(public_ids)
+        if len(material) == 0:
+            return []
 
+        # Join against parallel arrays, so the statement is the same however many IDs there are
         # Return stats, sorted by incoming public_ids
-        stats = {}
-        for mss_id, permutation, answered, correct in DBSession.execute(q):
-            stats[self.to_public_id(mss_id, permutation)] = dict(
-                stage_answered=answered,
-                stage_correct=correct,
-            )
-        return [stats.get(x, dict(stage_answered=0, stage_correct=0)) for x in public_ids]
+        return [dict(
+            stage_answered=answered,
+            stage_correct=correct,
+        ) for answered, correct in DBSession.execute("""
+            SELECT COALESCE(ast.answered, 0)
+                 , COALESCE(ast.correct, 0)
+              FROM UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[]))
+                   WITH ORDINALITY AS m(material_source_id, permutation, i)
+              LEFT JOIN answer_stats ast
+                ON ast.stage_id = :stage_id
+               AND ast.material_source_id = m.material_source_id
+               AND ast.permutation = m.permutation
+          ORDER BY m.i
+        """, dict(
+            stage_id=self.db_stage.stage_id,
+            mss_ids=[int(x[0]) for x in material],
+            permutations=[int(x[1]) for x in material],
+        ))]
 
-    def material_hash(self):
+    def material_hash(self, material=None):
         """
         Get a hash representing current material selection
+        - material: Result of get_material(), if already fetched
         """
         mat_bytes = b"/".join(
             b"%d:%d" % (mss_id, permutation)
-            for mss_id, permutation in self.get_material()
+            for mss_id, permutation in (self.get_material() if material is None else material)
         )
         return hashlib.sha1(mat_bytes).hexdigest()
 
@@ -109,40 +175,186 @@ class OriginalAllocation(BaseAllocation):
         self.cipher = skippy.Skippy(settings['allocation_encryption_key'].encode('ascii'))
         self.refresh_int = int(float(self.settings.get('allocation_refresh_interval', 20)))
         self.question_cap = int(float(self.settings.get('question_cap', 100)))
+        self._selection = None  # (stage material, (seed, bucket), selection) from the last get_material()
+        self._public_ids = {}  # (mss_id, permutation) -> public ID
+        self._private_ids = {}  # public ID -> (mss_id, permutation)
+        self._encrypted = {}  # Plaintext -> cipher.encrypt(plaintext)
+        self._decrypted = {}  # Ciphertext -> cipher.decrypt(ciphertext)
 
     def to_public_id(self, mss_id, permutation):
-        return base64.b64encode(struct.pack(
-            'cII',
-            b'B' if permutation < 0 else b'A',
-            self.cipher.encrypt(mss_id),
-            self.cipher.encrypt(abs(permutation)),
-        )).decode('ascii')
+        return self.to_public_ids([(mss_id, permutation)])[0]
 
     def from_public_id(self, public_id):
-        public_id = base64.b64decode(public_id)
-        if len(public_id) < 9:
-            # Pre-version-char format
-            version_char = b'A'
-            mss_id, permutation = struct.unpack('II', public_id)
-        else:
-            version_char, mss_id, permutation = struct.unpack('cII', public_id)
-        mss_id = self.cipher.decrypt(mss_id)
-        permutation = self.cipher.decrypt(permutation)
-        if version_char == b'B':
-            permutation = 0 - permutation
-        return mss_id, permutation
+        return self.from_public_ids([public_id])[0]
+
+    def to_public_ids(self, material):
+        # NB: Material shares mss_ids & permutation numbers, so only encrypt each value once
+        material = list(material)
+        for mss_id, permutation in material:
+            if (mss_id, permutation) in self._public_ids:
+                continue
+            for x in (mss_id, abs(permutation)):
+                if x not in self._encrypted:
+                    self._encrypted[x] = self.cipher.encrypt(x)
+            public_id = base64.b64encode(struct.pack(
+                'cII',
+                b'B' if permutation < 0 else b'A',
+                self._encrypted[mss_id],
+                self._encrypted[abs(permutation)],
+            )).decode('ascii')
+            self._public_ids[(mss_id, permutation)] = public_id
+            self._private_ids[public_id] = (mss_id, permutation)
+        return [self._public_ids[(mss_id, permutation)] for mss_id, permutation in material]
+
+    def from_public_ids(self, public_ids):
+        public_ids = list(public_ids)
+        for public_id in public_ids:
+            if public_id in self._private_ids:
+                continue
+            raw_id = base64.b64decode(public_id)
+            if len(raw_id) < 9:
+                # Pre-version-char format
+                version_char = b'A'
+                mss_id, permutation = struct.unpack('II', raw_id)
+            else:
+                version_char, mss_id, permutation = struct.unpack('cII', raw_id)
+            for x in (mss_id, permutation):
+                if x not in self._decrypted:
+                    self._decrypted[x] = self.cipher.decrypt(x)
+            mss_id = self._decrypted[mss_id]
+            permutation = self._decrypted[permutation]
+            if version_char == b'B':
+                permutation = 0 - permutation
+            self._private_ids[public_id] = (mss_id, permutation)
+        return [self._private_ids[x] for x in public_ids]
 
     def get_material(self):
-        material = super(OriginalAllocation, self).get_material()
+        material = stage_material_list(self.db_stage)
 
         # If there are enough, sample based on our seed & how many questions student has answered
         if self.question_cap < len(material):
-            # TODO: We should be choosing based on difficulty, but to do that we need
-            # updated stats, and the current grade
-            local_random = random.Random()
-            local_random.seed(self.seed + (self._aq_length() // self.refresh_int))
-            material = local_random.sample(material, self.question_cap)
-        return material
+            # Selection only changes when the student moves to the next refresh_int bucket
+            key = (self.seed, self._aq_length() // self.refresh_int)
+            if self._selection is None or self._selection[0] != material or self._selection[1] != key:
+                self._selection = (material, key, self._select(material, key[1]))
+            return list(self._selection[2])
+        return list(material)
+
+    def _select(self, material, bucket):
+        """Choose question_cap items from material for the student's current refresh bucket"""
+        # NB: AdaptiveAllocation chooses based on difficulty
+        local_random = random.Random()
+        local_random.seed(self.seed + bucket)
+        return local_random.sample(material, self.question_cap)
+
+
+class AdaptiveAllocation(OriginalAllocation):
+    """
+    As OriginalAllocation, but when capping choose questions weighted by their
+    difficulty & the student's grade, as the client's adaptive IAA does.
+
+    Stats move on with every answer, so a selection is stored in
+    allocation_selection and re-used until the refresh bucket changes.
+    """
+    def __init__(self, settings, db_stage, db_student):
+        super(AdaptiveAllocation, self).__init__(settings, db_stage, db_student)
+        self.gpow = float(self.settings.get('iaa_adaptive_gpow', 1))
+
+    def _bucket_grade(self, bucket):
+        """Student's grade at the start of this bucket, so it doesn't change within it"""
+        if bucket == 0:
+            return 0.0
+        row = DBSession.execute(
+            'SELECT grade'
+            ' FROM answer'
+            ' WHERE stage_id = :stage_id'
+            '   AND user_id = :user_id'
+            ' ORDER BY time_end, time_offset'
+            ' OFFSET :offset LIMIT 1',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                offset=bucket * self.refresh_int - 1,
+            )
+        ).fetchone()
+        return float(row[0]) if row else 0.0
+
+    def _weighted_sample(self, material, bucket):
+        """Choose question_cap items from material, weighted by question_weights()"""
+        if len(material) <= self.question_cap:
+            return list(material)
+
+        # Stats for the material we were given, so we sample from the same snapshot
+        chosen = numpy.zeros(len(material), dtype=numpy.int64)
+        correct = numpy.zeros(len(material), dtype=numpy.int64)
+        rows = DBSession.execute(
+            'SELECT m.i - 1'
+            '     , ms.initial_answered + COALESCE(ast.answered, 0)'
+            '     , ms.initial_correct + COALESCE(ast.correct, 0)'
+            '  FROM UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[]))'
+            '       WITH ORDINALITY AS m(material_source_id, permutation, i)'
+            '  JOIN material_source ms ON ms.material_source_id = m.material_source_id'
+            '  LEFT JOIN answer_stats ast'
+            '    ON ast.stage_id = :stage_id'
+            '   AND ast.material_source_id = m.material_source_id'
+            '   AND ast.permutation = m.permutation',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                mss_ids=[int(x[0]) for x in material],
+                permutations=[int(x[1]) for x in material],
+            )
+        ).fetchall()
+        if len(rows) > 0:
+            arr = numpy.array(rows, dtype=numpy.int64)
+            chosen[arr[:, 0]] = arr[:, 1]
+            correct[arr[:, 0]] = arr[:, 2]
+
+        rng = numpy.random.default_rng((self.seed, bucket))
+        weights = question_weights(chosen, correct, self._bucket_grade(bucket), self.gpow, rng)
+
+        # Weighted sampling without replacement (Efraimidis & Spirakis): keep the largest u^(1/w)
+        with numpy.errstate(divide='ignore', over='ignore'):
+            keys = numpy.log(rng.random(len(weights))) / weights
+        picked = numpy.argpartition(-keys, self.question_cap - 1)[:self.question_cap]
+        picked.sort()
+        return [(int(material[i][0]), int(material[i][1])) for i in picked]
+
+    def _select(self, material, bucket):
+        selection_key = '%d:%d:%s' % (self.seed, bucket, self.material_hash(material))
+        row = DBSession.execute(
+            'SELECT material_source_ids, permutations'
+            '  FROM allocation_selection'
+            ' WHERE stage_id = :stage_id'
+            '   AND user_id = :user_id'
+            '   AND selection_key = :selection_key',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                selection_key=selection_key,
+            )
+        ).fetchone()
+        if row is not None:
+            return list(zip(row[0], row[1]))
+
+        selection = self._weighted_sample(material, bucket)
+        session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+        session.execute(
+            'INSERT INTO allocation_selection (stage_id, user_id, selection_key, material_source_ids, permutations)'
+            ' VALUES (:stage_id, :user_id, :selection_key, :material_source_ids, :permutations)'
+            ' ON CONFLICT (stage_id, user_id) DO UPDATE'
+            '   SET selection_key = EXCLUDED.selection_key'
+            '     , material_source_ids = EXCLUDED.material_source_ids'
+            '     , permutations = EXCLUDED.permutations',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                selection_key=selection_key,
+                material_source_ids=[x[0] for x in selection],
+                permutations=[x[1] for x in selection],
+            )
+        )
+        mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+        return selection
 
 
 class PassThroughAllocation(BaseAllocation):
@@ -155,50 +367,107 @@ class PassThroughAllocation(BaseAllocation):
     def __init__(self, settings, db_stage, db_student):
         super(PassThroughAllocation, self).__init__(settings, db_stage, db_student)
         self.bank = settings['allocation_bank_name']
+        self._mss_versions = {}  # mss_id -> (path, version)
+        self._path_mss_ids = {}  # path -> {version: mss_id}
 
-    def to_public_id(self, mss_id, permutation):
+    def _fetch_versions(self, mss_ids=(), paths=()):
         """
-        Turn (mss_id, permutation) into a public question ID
+        Fetch (path, version) for every material_source sharing a path with
+        (mss_ids) or in (paths), in one query, caching for future calls
         """
-        (mss_path,) = DBSession.execute("""
-            SELECT path
-             FROM material_source
-             WHERE material_source_id = :mss_id
-        """, dict(
-            mss_id=mss_id,
-        )).fetchone()
+        mss_ids = list(set(x for x in mss_ids if x not in self._mss_versions))
+        paths = list(set(x for x in paths if x not in self._path_mss_ids))
+        if len(mss_ids) == 0 and len(paths) == 0:
+            return
 
-        (version,) = DBSession.execute("""
-            SELECT COUNT(*)
+        for mss_id, path, version in DBSession.execute("""
+            SELECT material_source_id
+                 , path
+                 , ROW_NUMBER() OVER (PARTITION BY path ORDER BY material_source_id) AS version
               FROM material_source
-             WHERE material_source_id <= :mss_id
-               AND path = :mss_path
+             WHERE path IN (SELECT path FROM material_source WHERE material_source_id = ANY(CAST(:mss_ids AS INTEGER[])))
+                OR path = ANY(CAST(:paths AS TEXT[]))
         """, dict(
-            mss_id=mss_id,
-            mss_path=mss_path,
-        )).fetchone()
+            mss_ids=mss_ids,
+            paths=paths,
+        )):
+            self._mss_versions[mss_id] = (path, version)
+            self._path_mss_ids.setdefault(path, {})[version] = mss_id
 
-        return '%s:%d:%d' % (mss_path, version, permutation)
+        # Remember paths that don't exist, so we don't look again
+        for path in paths:
+            self._path_mss_ids.setdefault(path, {})
+
+    def to_public_id(self, mss_id, permutation):
+        """
+        Turn (mss_id, permutation) into a public question ID
+        """
+        return self.to_public_ids([(mss_id, permutation)])[0]
 
     def from_public_id(self, public_id):
         """
         Turn the public ID back into a (mss_id, permutation) tuple
         """
-        (mss_path, version, permutation) = public_id.split(":", 2)
-
-        # Get all possible MSS IDs for this path, assume we want the version'th
-        mss_ids = DBSession.execute("""
-            SELECT material_source_id
-              FROM material_source
-             WHERE path = :mss_path
-          ORDER BY material_source_id
-        """, dict(
-            mss_path=mss_path
-        )).fetchall()
-
-        return (mss_ids[int(version) - 1][0], int(permutation),)
+        return self.from_public_ids([public_id])[0]
+
+    def to_public_ids(self, material):
+        material = list(material)
+        self._fetch_versions(mss_ids=(mss_id for mss_id, permutation in material))
+
+        out = []
+        for mss_id, permutation in material:
+            if mss_id not in self._mss_versions:
+                raise ValueError("Unknown material_source_id %d" % mss_id)
+            out.append('%s:%d:%d' % (self._mss_versions[mss_id] + (permutation,)))
+        return out
+
+    def from_public_ids(self, public_ids):
+        # Each public ID is (path, version, permutation)
+        parsed = [x.split(":", 2) for x in public_ids]
+        self._fetch_versions(paths=(mss_path for mss_path, version, permutation in parsed))
+
+        out = []
+        for mss_path, version, permutation in parsed:
+            # Get all possible MSS IDs for this path, assume we want the version'th
+            mss_id = self._path_mss_ids[mss_path].get(int(version), None)
+            if mss_id is None:
+                raise ValueError("Unknown question %s:%s" % (mss_path, version))
+            out.append((mss_id, int(permutation),))
+        return out
+
+
+class ExamAllocation(OriginalAllocation):
+    """
+    Each student sits one of a fixed set of papers for the stage, chosen by
+    their seed. Papers are generated when the stage is imported (see
+    tutorweb_quizdb.stage.exam), so starting an exam is one lookup. Stages
+    that predate exam papers get theirs generated on first use.
+    """
+    def __init__(self, settings, db_stage, db_student):
+        super(ExamAllocation, self).__init__(settings, db_stage, db_student)
+        self.paper_count = int(float(self.settings.get('exam_papers', EXAM_PAPERS_DEFAULT)))
+        self._paper = None
 
+    def _fetch_paper(self):
+        return DBSession.execute(
+            'SELECT material_source_ids, permutations'
+            '  FROM exam_paper'
+            ' WHERE stage_id = :stage_id'
+            '   AND paper = :paper',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                paper=self.seed % self.paper_count,
+            )
+        ).fetchone()
 
-class ExamAllocation(BaseAllocation):
-    # TODO:
-    pass
+    def get_material(self):
+        if self._paper is None:
+            row = self._fetch_paper()
+            if row is None:
+                from .exam import exam_papers_generate
+
+                # Add missing papers, leaving any that students may already be sitting alone
+                exam_papers_generate(self.db_stage, paper_count=self.paper_count, replace=False)
+                row = self._fetch_paper()
+            self._paper = list(zip(row[0], row[1]))
+        return list(self._paper)
@@ -1,6 +1,9 @@
+import json
 import logging
 
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from zope.sqlalchemy import mark_changed
 
 from tutorweb_quizdb import DBSession, Base
 from tutorweb_quizdb.rst import to_rst
@@ -9,6 +12,13 @@ from tutorweb_quizdb.syllabus import path_to_ltree
 from tutorweb_quizdb.timestamp import timestamp_to_datetime, datetime_to_timestamp
 
 VETTED_ACCEPT_CUTOFF = 40
+ANSWER_INSERT_COLUMNS = (
+    'stage_id', 'user_id',
+    'material_source_id', 'permutation', 'client_id', 'time_start', 'time_end', 'time_offset',
+    'correct', 'grade', 'coins_awarded',
+    'student_answer', 'review',
+)
+ANSWER_UPDATE_COLUMNS = ('review', 'correct', 'coins_awarded')
 
 
 log = logging.getLogger(__name__)
@@ -32,17 +42,13 @@ def mark_aq_entry(db_a, alloc, grade_hwm):
         """Return the high-water-mark for every other stage in the tutorial"""
         return DBSession.execute("""
             SELECT st.stage_id
-                 , (SELECT COALESCE(MAX(a.grade), 0)
-                      FROM answer a, all_stage_versions asv
-                     WHERE a.stage_id = asv.stage_id
-                       AND asv.latest_stage_id = st.stage_id -- i.e we want answer items for all versions of this stage
-                       AND a.user_id = :user_id) grade_hwm
-              FROM stage st, syllabus sy
-             WHERE sy.syllabus_id = st.syllabus_id
-               AND sy.path <@ :tut_path
+                 , COALESCE(h.grade_hwm, 0) grade_hwm  -- NB: answer_grade_hwm includes all versions of this stage
+              FROM stage st
+              JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+         LEFT JOIN answer_grade_hwm h ON h.stage_id = st.stage_id AND h.user_id = :user_id
+             WHERE sy.path <@ :tut_path
                AND st.stage_id != :stage_id
                AND st.next_stage_id IS NULL
-            GROUP BY st.stage_id
         """, dict(
             user_id=db_a.user_id,
             stage_id=db_a.stage_id,
@@ -125,8 +131,11 @@ def mark_aq_entry_usergenerated(db_a, alloc, ug_reviews):
             db_a.coins_awarded += get_award_setting('ugmaterial_accepted')
 
 
-def db_to_incoming(alloc, db_a):
-    """Turn db entry back to wire-format"""
+def db_to_incoming(alloc, db_a, uri=None):
+    """
+    Turn db entry back to wire-format
+    - uri: The entry's public ID, if already known
+    """
     def format_review(reviewer_user_id, review):
         """Format incoming review object from stage_ugmaterial for client"""
         if not review:
@@ -138,7 +147,7 @@ def db_to_incoming(alloc, db_a):
         return review
 
     return dict(
-        uri=alloc.to_public_id(db_a.material_source_id, db_a.permutation),
+        uri=uri or alloc.to_public_id(db_a.material_source_id, db_a.permutation),
         client_id=db_a.client_id,
         time_start=datetime_to_timestamp(db_a.time_start),
         time_end=datetime_to_timestamp(db_a.time_end),
@@ -162,28 +171,60 @@ def db_to_incoming(alloc, db_a):
     )
 
 
-def incoming_to_db(alloc, in_a):
-    """Turn wire-format into a DB answer entry"""
+def resolve_incoming_uris(alloc, uris):
+    """
+    Turn all (uris) into a dict of uri -> (material_source_id, permutation),
+    raising a ValueError listing every URI that we can't find
+    """
+    uris = list(dict.fromkeys(uris))  # NB: Unique, but keeping order
     try:
-        (mss_id, permutation) = alloc.from_public_id(in_a['uri'])
+        out = dict(zip(uris, alloc.from_public_ids(uris)))
     except Exception:
-        # Log exception along with real error
-        log.exception("Could not parse question ID %s" % in_a['uri'])
-        raise ValueError("Could not parse question ID %s" % in_a['uri'])
-    try:
-        ms = DBSession.query(Base.classes.material_source).filter_by(material_source_id=mss_id).one()
-    except NoResultFound:
-        log.exception("Could not parse question ID %s" % in_a['uri'])
-        raise ValueError("Cannot find question %s for user %s (are you logged in as the right user?)" % (
-            in_a['uri'],
+        # Something is broken, go through one-by-one to find out what
+        out = {}
+        unparseable = []
+        for uri in uris:
+            try:
+                out[uri] = alloc.from_public_id(uri)
+            except Exception:
+                # Log exception along with real error
+                log.exception("Could not parse question ID %s" % uri)
+                unparseable.append(uri)
+        if unparseable:
+            raise ValueError("Could not parse question IDs %s" % ", ".join(unparseable))
+
+    # Check all material_sources exist in one go
+    mss_ids = set(mss_id for (mss_id, permutation) in out.values())
+    if len(mss_ids) > 0:
+        found = set(x[0] for x in DBSession.query(Base.classes.material_source.material_source_id).filter(
+            Base.classes.material_source.material_source_id.in_(mss_ids)
+        ))
+    else:
+        found = set()
+    missing = [uri for uri, (mss_id, permutation) in out.items() if mss_id not in found]
+    if missing:
+        log.warning("Could not find question IDs %s" % ", ".join(missing))
+        raise ValueError("Cannot find questions %s for user %s (are you logged in as the right user?)" % (
+            ", ".join(missing),
             alloc.db_student.user_name,
         ))
+    return out
+
+
+def incoming_to_db(alloc, in_a, resolved_uris=None):
+    """
+    Turn wire-format into a DB answer entry
+    - resolved_uris: Output of resolve_incoming_uris() containing in_a['uri'], if available
+    """
+    if resolved_uris is None or in_a['uri'] not in resolved_uris:
+        resolved_uris = resolve_incoming_uris(alloc, [in_a['uri']])
+    (mss_id, permutation) = resolved_uris[in_a['uri']]
 
     return Base.classes.answer(
         stage_id=alloc.db_stage.stage_id,  # NB: Assume incoming answers are based on the latest stage
         user_id=alloc.db_student.id,
 
-        material_source_id=ms.material_source_id,
+        material_source_id=mss_id,
         permutation=permutation,
         client_id=in_a['client_id'],
         time_start=timestamp_to_datetime(in_a['time_start']),
@@ -198,14 +239,78 @@ def incoming_to_db(alloc, in_a):
     )
 
 
-def sync_answer_queue(alloc, in_queue, time_offset):
+def insert_answers(db_entries):
+    """Insert all (db_entries) in one multi-row INSERT, in the order given"""
+    if len(db_entries) == 0:
+        return
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    session.execute(Base.classes.answer.__table__.insert().values([
+        dict((k, getattr(db_a, k)) for k in ANSWER_INSERT_COLUMNS)
+        for db_a in db_entries
+    ]))
+    mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+
+
+def update_answers(db_entries):
+    """Write any modified review / correct / coins_awarded in (db_entries) in one UPDATE"""
+    modified = [
+        db_a for db_a in db_entries
+        if any(inspect(db_a).attrs[k].history.has_changes() for k in ANSWER_UPDATE_COLUMNS)
+    ]
+    if len(modified) == 0:
+        return
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    session.execute("""
+        UPDATE answer a
+           SET review = u.review
+             , correct = u.correct
+             , coins_awarded = u.coins_awarded
+          FROM UNNEST(
+                   CAST(:answer_ids AS INTEGER[]),
+                   CAST(:reviews AS JSONB[]),
+                   CAST(:corrects AS BOOLEAN[]),
+                   CAST(:coins_awarded AS INTEGER[])
+               ) AS u(answer_id, review, correct, coins_awarded)
+         WHERE a.answer_id = u.answer_id
+    """, dict(
+        answer_ids=[db_a.answer_id for db_a in modified],
+        reviews=[None if db_a.review is None else json.dumps(db_a.review) for db_a in modified],
+        corrects=[db_a.correct for db_a in modified],
+        coins_awarded=[db_a.coins_awarded for db_a in modified],
+    ))
+    mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+
+    # Written out, so the ORM shouldn't consider these modified any more
+    for db_a in modified:
+        for k in ANSWER_UPDATE_COLUMNS:
+            set_committed_value(db_a, k, getattr(db_a, k))
+
+
+def sync_answer_queue(alloc, in_queue, time_offset, since=None):
+    """
+    Merge incoming answer queue with the DB, return (combined queue, number of additions)
+    - alloc: Stage allocation for this student
+    - in_queue: Incoming answer queue from the client
+    - time_offset: Difference between server and client time, to store against new entries
+    - since: If given, answer_queue_last_id() from the client's last sync. Only entries
+      stored after this point, or ones that have changed during this sync, are returned.
+      The final entry is always returned, so the current grade is available.
+    """
     # Fetch all past stage_ids for this stage_id, so we consider answers from older stave revisions
     all_stages = [x[0] for x in DBSession.execute("""
-        SELECT stage_id FROM all_stage_versions WHERE latest_stage_id = :stage_id
+        SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id
     """, dict(
         stage_id=alloc.db_stage.stage_id,
     ))]
 
+    # Wait for any other sync for this student to finish, so we see everything it inserted.
+    # NB: Row locks alone won't do, the SELECT below wouldn't see rows committed whilst it waited,
+    #     and answer_ids handed out to concurrent inserts aren't in commit order.
+    DBSession.execute("SELECT pg_advisory_xact_lock(:stage_id, :user_id)", dict(
+        stage_id=alloc.db_stage.stage_id,
+        user_id=alloc.db_student.id,
+    ))
+
     # Lock answer_queue for this student, to stop any concorrent updates
     db_queue = (DBSession.query(Base.classes.answer)
                 .filter(Base.classes.answer.stage_id.in_(all_stages))
@@ -240,58 +345,116 @@ def sync_answer_queue(alloc, in_queue, time_offset):
     # Re-sort based on time
     in_queue.sort(key=lambda a: (a['time_end'], a.get('time_offset', time_offset)))
 
-    db_i = 0
-    in_i = 0
-    additions = 0
-    out = []
-    grade_hwm = 0
-    while True:
-        if db_i >= len(db_queue):
-            # Ran off the end of DB items, anything extra should be added to incoming
-            cmp = -1
-
-            if in_i >= len(in_queue):
-                # Parsed both lists, done
-                break
-        elif in_i >= len(in_queue):
-            # Ran off the end of incoming items, anything extra should be added to DB
-            cmp = 1
-        else:
-            # Find smallest of DB/incoming entries
-            cmp = in_queue[in_i]['time_end'] - datetime_to_timestamp(db_queue[db_i].time_end)
-
-        if cmp == 0:
-            # Matching items, update any review
-            # NB: Only update the review when there's something to replace it with, so view_stage_ug_rewrite is saved
-            if in_queue[in_i].get('review', None):
-                db_queue[db_i].review = in_queue[in_i]['review']
-            db_entry = db_queue[db_i]
-            db_i += 1
-            in_i += 1
-
-        elif cmp < 0:
-            # An extra incoming item, insert it
-            db_entry = incoming_to_db(alloc, in_queue[in_i])
-            db_entry.time_offset = time_offset
-            DBSession.add(db_entry)
-            additions += 1
-            in_i += 1
-
-        else:  # i.e. cmp < 0
-            # An extra DB item, do nothing, will get added to outgoing list
-            db_entry = db_queue[db_i]
-            db_i += 1
-
-        # If reviews are present, update DB entry based on them
-        db_entry.ug_reviews = stage_ug_reviews.get(db_entry.answer_id, None)
-        mark_aq_entry(db_entry, alloc, grade_hwm)
-        out.append(db_to_incoming(alloc, db_entry))
-        if db_entry.grade > grade_hwm:
-            grade_hwm = db_entry.grade
-
-        DBSession.flush()
+    # Resolve the question IDs of everything we're about to insert in one go
+    db_time_ends = set(datetime_to_timestamp(db_a.time_end) for db_a in db_queue)
+    resolved_uris = resolve_incoming_uris(alloc, [
+        in_a['uri'] for in_a in in_queue if in_a['time_end'] not in db_time_ends
+    ])
+
+    # NB: Nothing should be written until we're done, so changes go out in one UPDATE
+    #     rather than being autoflushed row-by-row by any query along the way
+    with DBSession.no_autoflush:
+        db_i = 0
+        in_i = 0
+        new_entries = []
+        out_entries = []
+        last_entry = None
+        grade_hwm = 0
+        while True:
+            if db_i >= len(db_queue):
+                # Ran off the end of DB items, anything extra should be added to incoming
+                cmp = -1
+
+                if in_i >= len(in_queue):
+                    # Parsed both lists, done
+                    break
+            elif in_i >= len(in_queue):
+                # Ran off the end of incoming items, anything extra should be added to DB
+                cmp = 1
+            else:
+                # Find smallest of DB/incoming entries
+                cmp = in_queue[in_i]['time_end'] - datetime_to_timestamp(db_queue[db_i].time_end)
+
+            if cmp == 0:
+                # Matching items, update any review
+                # NB: Only update the review when there's something to replace it with, so view_stage_ug_rewrite is saved
+                if in_queue[in_i].get('review', None):
+                    db_queue[db_i].review = in_queue[in_i]['review']
+                    changed = True
+                else:
+                    changed = False
+                db_entry = db_queue[db_i]
+                db_i += 1
+                in_i += 1
+
+            elif cmp < 0:
+                # An extra incoming item, insert it
+                # NB: Not added to the session, we write all new entries in one go afterwards
+                db_entry = incoming_to_db(alloc, in_queue[in_i], resolved_uris)
+                db_entry.time_offset = time_offset
+                new_entries.append(db_entry)
+                in_i += 1
+                changed = True
+
+            else:  # i.e. cmp < 0
+                # An extra DB item, do nothing, will get added to outgoing list
+                db_entry = db_queue[db_i]
+                db_i += 1
+                changed = False
+
+            # If reviews are present, update DB entry based on them
+            db_entry.ug_reviews = stage_ug_reviews.get(db_entry.answer_id, None)
+            old_correct = db_entry.correct
+            mark_aq_entry(db_entry, alloc, grade_hwm)
+            if db_entry.grade > grade_hwm:
+                grade_hwm = db_entry.grade
+
+            # Only serialise entries the client doesn't already have
+            # NB: UG entries are always returned, as others may have reviewed them since
+            if since is None or changed or \
+               db_entry.ug_reviews is not None or \
+               db_entry.correct != old_correct or \
+               db_entry.answer_id > since:
+                out_entries.append(db_entry)
+                last_entry = None
+            else:
+                last_entry = db_entry
+
+        if last_entry is not None:
+            # Final entry not already returned, add it so the client has the current grade
+            out_entries.append(last_entry)
+
+        # Serialise all at once, so public IDs are generated in one batch
+        out = [
+            db_to_incoming(alloc, db_entry, uri)
+            for db_entry, uri in zip(out_entries, alloc.to_public_ids(
+                (db_entry.material_source_id, db_entry.permutation) for db_entry in out_entries
+            ))
+        ]
+
+        # Write out all changes at once, rather than a round trip per entry
+        update_answers(db_queue)
+        insert_answers(new_entries)
+
     # Return combination of answer queues, and how many new entries we found
-    return (out, additions)
+    return (out, len(new_entries))
+
+
+def answer_queue_last_id(alloc):
+    """
+    Return the highest answer_id in the student's queue, to give as sync_answer_queue(since=...)
+    next time. Call after sync_answer_queue(), so nothing else can be adding to the queue
+    """
+    (out,) = DBSession.execute("""
+        SELECT COALESCE(MAX(answer_id), 0)
+          FROM answer
+         WHERE stage_id IN (SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id)
+           AND user_id = :user_id
+    """, dict(
+        stage_id=alloc.db_stage.stage_id,
+        user_id=alloc.db_student.id,
+    )).fetchone()
+    return out
 
 
 def request_review(alloc):
@@ -347,3 +510,16 @@ def request_review(alloc):
 
     # No available material to review
     return dict()
+
+
+def script_answer_stats_rebuild():
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Regenerate answer_stats from all answers, should they get out of sync'),
+    ]
+
+    with setup_script(argparse_arguments) as env:  # noqa
+        session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+        session.execute("SELECT answer_stats_rebuild()")
+        mark_changed(session)  # Mark this session changed, so sqlalchemy commits
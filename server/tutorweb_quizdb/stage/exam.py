@@ -0,0 +1,134 @@
+"""
+Exam papers: a fixed set of (mss_id, permutation) lists for an exam stage,
+generated when the stage is imported & pre-rendered by the exam_papers script,
+so ExamAllocation has nothing to do when hundreds of students start at once.
+Missing papers are generated on first use, but existing papers are never
+regenerated behind students' backs, only by request.
+"""
+import numpy
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession, Base
+from .allocation import stage_material_list, EXAM_PAPERS_DEFAULT
+from .setting import SettingSpec
+
+
+def stage_setting_value(db_stage, key, default):
+    """Get the stage-wide value for setting (key), ignoring any per-student customisation"""
+    spec = (db_stage.stage_setting_spec or {}).get(key, None) or {}
+    return spec.get('value', default)
+
+
+def stage_setting_values(db_stage, key, default):
+    """
+    Get all values setting (key) could take for students of this stage,
+    resolving "variant:" specs the same way getStudentSettings() does
+    """
+    spec = (db_stage.stage_setting_spec or {}).get(key, None) or {}
+    out = set()
+    for variant in [None] + [k for k in spec.keys() if k.startswith('variant:')]:
+        value = SettingSpec(key, spec, lambda v, variant=variant: v == variant).spec.get('value', None)
+        out.add(default if value is None else value)
+    return out
+
+
+def is_exam_stage(db_stage):
+    """Would any student of this stage get an ExamAllocation?"""
+    return 'exam' in stage_setting_values(db_stage, 'allocation_method', 'original')
+
+
+def exam_papers_generate(db_stage, paper_count=None, replace=True):
+    """
+    (Re)generate exam papers for a stage, returning a list of (mss_id, permutation) lists.
+    Papers are seeded on stage_id, so regenerating without material changes gives the same papers.
+    - paper_count: Number of papers to generate, default is the stage's exam_papers setting
+    - replace: Replace existing papers, otherwise only add missing ones
+    """
+    if paper_count is None:
+        paper_count = int(float(stage_setting_value(db_stage, 'exam_papers', EXAM_PAPERS_DEFAULT)))
+    question_cap = int(float(stage_setting_value(db_stage, 'question_cap', 100)))
+
+    material = numpy.array(sorted(stage_material_list(db_stage)), dtype=numpy.int64).reshape(-1, 2)
+    papers = []
+    for paper in range(paper_count):
+        if len(material) > question_cap:
+            rng = numpy.random.default_rng((db_stage.stage_id, paper))
+            papers.append(material[numpy.sort(rng.choice(len(material), size=question_cap, replace=False))])
+        else:
+            papers.append(material)
+
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    if replace:
+        session.execute(
+            'DELETE FROM exam_paper WHERE stage_id = :stage_id AND paper >= :paper_count',
+            dict(stage_id=db_stage.stage_id, paper_count=paper_count),
+        )
+    session.execute(
+        'INSERT INTO exam_paper (stage_id, paper, material_source_ids, permutations)'
+        ' VALUES (:stage_id, :paper, :material_source_ids, :permutations)'
+        ' ON CONFLICT (stage_id, paper) DO ' + (
+            'UPDATE'
+            '   SET material_source_ids = EXCLUDED.material_source_ids'
+            '     , permutations = EXCLUDED.permutations'
+            if replace else 'NOTHING'
+        ),
+        [dict(
+            stage_id=db_stage.stage_id,
+            paper=paper,
+            material_source_ids=[int(x) for x in p[:, 0]],
+            permutations=[int(x) for x in p[:, 1]],
+        ) for paper, p in enumerate(papers)],
+    )
+    mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+    return [[(int(mss_id), int(permutation)) for mss_id, permutation in p] for p in papers]
+
+
+def exam_papers_get(db_stage):
+    """Return the stage's current papers, as a list of (mss_id, permutation) lists"""
+    return [list(zip(mss_ids, permutations)) for mss_ids, permutations in DBSession.execute(
+        'SELECT material_source_ids, permutations FROM exam_paper WHERE stage_id = :stage_id ORDER BY paper',
+        dict(stage_id=db_stage.stage_id),
+    )]
+
+
+def exam_papers_warm(db_stage, processes=4):
+    """
+    Pre-render all material in the stage's existing papers.
+    Returns a warm_render_cache() summary
+    """
+    from tutorweb_quizdb.material.update import warm_render_cache
+
+    material = set()
+    for paper in exam_papers_get(db_stage):
+        material.update(paper)
+    return warm_render_cache(None, processes=processes, material=sorted(material))
+
+
+def script_exam_papers():
+    from tutorweb_quizdb import setup_script
+    from tutorweb_quizdb.material.update import print_warm_summary
+
+    argparse_arguments = [
+        dict(description='Pre-render papers for all current exam stages, generating any that are missing'),
+        dict(
+            name='--processes',
+            help="Number of R processes to render with",
+            type=int,
+            default=4,
+        ),
+        dict(
+            name='--regenerate',
+            help="Throw away existing papers and generate new ones. Do not use whilst students are sitting the exam",
+            action="store_true",
+            default=False,
+        ),
+    ]
+
+    with setup_script(argparse_arguments) as env:
+        for db_stage in DBSession.query(Base.classes.stage).filter_by(next_stage_id=None):
+            if not is_exam_stage(db_stage):
+                continue
+            print("Stage %d (%s):" % (db_stage.stage_id, db_stage.stage_name))
+            if env['args'].regenerate or len(exam_papers_get(db_stage)) == 0:
+                exam_papers_generate(db_stage)
+            print_warm_summary(exam_papers_warm(db_stage, processes=env['args'].processes))
@@ -0,0 +1,185 @@
+"""
+Server-side version of client/lib/iaa.js, so clients can ask for their next
+question instead of downloading every question & its stats
+"""
+import math
+
+import numpy
+from pyramid.settings import asbool
+
+from tutorweb_quizdb import DBSession
+from .allocation import question_weights
+from .index import alloc_for_view
+from .material import stage_material
+
+
+class NoQuestionsException(Exception):
+    status_code = 400
+    print_stack = False
+
+
+def get_setting(settings, key, default):
+    """As getSetting() in client/lib/settings.js, return float value of key, or default"""
+    if isinstance(default, str):
+        return settings.get(key, None) or default
+    try:
+        return float(settings.get(key, None))
+    except (TypeError, ValueError):
+        return default
+
+
+def qn_timeout(settings, grade):
+    """Given user's current grade, return how long they should have to do the next question in seconds"""
+    t_max = get_setting(settings, 'timeout_max', 0) * 60  # Parameter in mins, t_max in secs
+    t_min = get_setting(settings, 'timeout_min', 0) * 60  # Parameter in mins, t_min in secs
+    g_star = get_setting(settings, 'timeout_grade', 5)
+    s = get_setting(settings, 'timeout_std', 2)
+
+    if t_max == 0 or t_min == 0:
+        return None
+    return t_max - math.floor(
+        (t_max - t_min) * math.exp(-math.pow(grade - g_star, 2) / (2 * math.pow(s, 2)))
+    )
+
+
+def material_stats(alloc, material):
+    """
+    Return arrays of (chosen, correct) for each (mss_id, permutation) in material,
+    including the initial values from the material source
+    """
+    chosen = numpy.zeros(len(material), dtype=numpy.int64)
+    correct = numpy.zeros(len(material), dtype=numpy.int64)
+    if len(material) == 0:
+        return chosen, correct
+
+    rows = DBSession.execute("""
+        SELECT m.i - 1
+             , ms.initial_answered + COALESCE(ast.answered, 0)
+             , ms.initial_correct + COALESCE(ast.correct, 0)
+          FROM UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[]))
+               WITH ORDINALITY AS m(material_source_id, permutation, i)
+          JOIN material_source ms ON ms.material_source_id = m.material_source_id
+          LEFT JOIN answer_stats ast
+            ON ast.stage_id = :stage_id
+           AND ast.material_source_id = m.material_source_id
+           AND ast.permutation = m.permutation
+    """, dict(
+        stage_id=alloc.db_stage.stage_id,
+        mss_ids=[int(x[0]) for x in material],
+        permutations=[int(x[1]) for x in material],
+    )).fetchall()
+    if len(rows) > 0:
+        arr = numpy.array(rows, dtype=numpy.int64)
+        chosen[arr[:, 0]] = arr[:, 1]
+        correct[arr[:, 0]] = arr[:, 2]
+    return chosen, correct
+
+
+def recent_answers(alloc, limit=21):
+    """
+    Return (total answers, [(mss_id, permutation, correct, grade), ...]) for
+    the student's most recent (limit) answers in this stage, most recent first
+    """
+    rows = DBSession.execute("""
+        SELECT COUNT(*) OVER ()
+             , a.material_source_id
+             , a.permutation
+             , a.correct
+             , a.grade
+          FROM answer a
+         WHERE a.stage_id IN (SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id)
+           AND a.user_id = :user_id
+      ORDER BY a.time_end DESC, a.time_offset DESC
+         LIMIT :limit
+    """, dict(
+        stage_id=alloc.db_stage.stage_id,
+        user_id=alloc.db_student.user_id,
+        limit=limit,
+    )).fetchall()
+    if len(rows) == 0:
+        return 0, []
+    return rows[0][0], [tuple(r[1:]) for r in rows]
+
+
+def question_bias(material, answers):
+    """
+    Bias questions based on previous answers (NB: Most recent answers will overwrite older)
+    If question incorrect, probablity increases with time. Correct questions less likely
+    - answers: Up to 21 most recent answers, most recent first
+    """
+    index = dict((tuple(m), i) for i, m in enumerate(material))
+    bias = numpy.ones(len(material))
+    for age, (mss_id, permutation, correct, grade) in reversed(list(enumerate(answers))):
+        i = index.get((mss_id, permutation), None)
+        if i is not None:
+            bias[i] = 0.5 if correct else math.pow(1.05, age - 2)
+    return bias
+
+
+def iaa_adaptive(alloc, material, answers, grade, rng=numpy.random):
+    """Choose a question from material, weighted by difficulty & grade. Returns index into material"""
+    chosen, correct = material_stats(alloc, material)
+    weights = question_weights(
+        chosen,
+        correct,
+        grade,
+        get_setting(alloc.settings, 'iaa_adaptive_gpow', 1),
+        rng,
+    ) * question_bias(material, answers)
+    return int(rng.choice(len(material), p=weights / weights.sum()))
+
+
+def iaa_exam(alloc, material, answer_count, practice=False):
+    """Exam questions are asked in order. Returns index into material"""
+    if practice:
+        raise ValueError("Practice during an exam is not allowed")
+    if answer_count >= len(material):
+        raise NoQuestionsException("tutorweb::noquestions::You have answered all questions. Press 'Back to main menu' to choose another lecture")
+    return answer_count
+
+
+def next_allocation(alloc, practice=False, rng=numpy.random):
+    """
+    As newAllocation() in client/lib/iaa.js, choose the next question for
+    the student, returning the answerQueue entry & question
+    """
+    material = alloc.get_material()
+    if len(material) == 0:
+        raise NoQuestionsException("tutorweb::noquestions::Lecture has no questions")
+    answer_count, answers = recent_answers(alloc)
+    grade = float(answers[0][3]) if len(answers) > 0 else 0
+
+    iaa_type = get_setting(alloc.settings, 'iaa_type', 'adaptive')
+    if iaa_type == 'exam':
+        i = iaa_exam(alloc, material, answer_count, practice)
+    elif iaa_type == 'adaptive':
+        i = iaa_adaptive(alloc, material, answers, grade, rng)
+    else:
+        raise ValueError("Unknown IAA %s" % iaa_type)
+
+    out = stage_material(alloc, [material[i]])
+    return dict(
+        uri=out['stats'][0]['uri'],
+        allotted_time=qn_timeout(alloc.settings, grade),
+        grade_before=grade,
+        student_answer=dict(practice=True) if practice else dict(),
+        stats=out['stats'][0],
+        data=out['data'][out['stats'][0]['uri']],
+    )
+
+
+def view_stage_next_question(request):
+    """
+    Choose the next question for the student, based on answers synced so far
+
+    params:
+    - path: Stage path
+    - practice: Student is in practice mode
+    """
+    alloc = alloc_for_view(request)
+    return next_allocation(alloc, practice=asbool(request.params.get('practice', False)))
+
+
+def includeme(config):
+    config.add_view(view_stage_next_question, route_name='stage_next_question', renderer='json')
+    config.add_route('stage_next_question', '/stage/next-question')
@@ -1,10 +1,13 @@
 import time
 
+from pyramid.httpexceptions import HTTPBadRequest
+
+from tutorweb_quizdb import DBSession, Base
 from tutorweb_quizdb.stage.utils import stage_url, get_current_stage
 from tutorweb_quizdb.student import get_current_student
 from tutorweb_quizdb.lti import lti_replace_grade
 from .allocation import get_allocation
-from .answer_queue import sync_answer_queue
+from .answer_queue import answer_queue_last_id, sync_answer_queue
 from .setting import getStudentSettings, clientside_settings
 
 
@@ -19,6 +22,27 @@ def update_stats(alloc, questions):
         q['correct'] = q['initial_correct'] + s['stage_correct']
 
 
+def material_questions(alloc, material):
+    """Return stats for each (mss_id, permutation) in material, including current answered / correct counts"""
+    mss_ids = set(mss_id for mss_id, permutation in material)
+    initial = dict(
+        (ms.material_source_id, ms)
+        for ms in DBSession.query(Base.classes.material_source).filter(
+            Base.classes.material_source.material_source_id.in_(mss_ids)
+        )
+    ) if len(mss_ids) > 0 else {}
+    questions = [
+        dict(
+            uri=uri,
+            initial_answered=initial[mss_id].initial_answered,
+            initial_correct=initial[mss_id].initial_correct,
+            _type='regular',
+        ) for (mss_id, permutation), uri in zip(material, alloc.to_public_ids(material))
+    ]
+    update_stats(alloc, questions)
+    return questions
+
+
 def alloc_for_view(request):
     """
     Return a configured allocation object based in request params
@@ -46,16 +70,28 @@ def stage_index(request):
     # Work out how far off client clock is to ours, to nearest 10s (we're interested in clock-setting issues, request-timing)
     time_offset = round(time.time() - incoming.get('current_time', time.time()), -2)
 
-    # Sync answer queue
-    (answer_queue, additions) = sync_answer_queue(alloc, incoming.get('answerQueue', []), time_offset)
+    # Sync answer queue, only returning the changes if the client tells us what it has already
+    # NB: Clients that have lost their local state should leave out answerQueueSince to get everything
+    since = incoming.get('answerQueueSince', None)
+    if since is not None:
+        try:
+            since = int(str(since))  # NB: Via str() so floats are rejected, not truncated
+        except ValueError:
+            raise HTTPBadRequest("answerQueueSince should be an answerQueueLastId, not %s" % since)
+    (answer_queue, additions) = sync_answer_queue(
+        alloc,
+        incoming.get('answerQueue', []),
+        time_offset,
+        since=since,
+    )
 
     # Sync LTI if possible
     if len(answer_queue) > 0:
         lti_replace_grade(alloc.db_stage, alloc.db_student, answer_queue[-1].get('grade_after', 0))
 
-    # Get new stats for each question, update
-    questions = incoming.get('questions', [])
-    update_stats(alloc, questions)
+    # Current stats for all questions, hash-addressed material won't have them
+    material = alloc.get_material()
+    questions = material_questions(alloc, material)
 
     return dict(
         uri=stage_url(path=request.params['path']),
@@ -67,9 +103,11 @@ def stage_index(request):
         questions=questions,
         material_uri='/api/stage/material?path=%s&hash=%s' % (
             request.params['path'],
-            alloc.material_hash(),
+            alloc.material_hash(material),
         ),
         answerQueue=answer_queue,
+        answerQueueSince=since,  # i.e. answerQueue is only the entries that changed after this point
+        answerQueueLastId=answer_queue_last_id(alloc),  # i.e. answerQueueSince for the next sync
         time_offset=time_offset,
     )
 
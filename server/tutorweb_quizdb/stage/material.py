@@ -1,5 +1,25 @@
+import concurrent.futures
+import datetime
+import decimal
+import hashlib
+import json
+import types
+
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.response import Response
+from sqlalchemy.orm.exc import NoResultFound
+import transaction
+from zope.sqlalchemy import mark_changed
+
 from tutorweb_quizdb import DBSession, Base
-from tutorweb_quizdb.material.render import material_render
+from tutorweb_quizdb.material.render import (
+    material_render,
+    material_render_check,
+    material_render_output,
+    render_cache_get,
+    render_cache_key,
+    render_cache_set,
+)
 from tutorweb_quizdb.student import get_current_student, student_is_vetted
 from .allocation import get_allocation
 from .index import update_stats
@@ -19,6 +39,8 @@ VETTED_REVIEW_TEMPLATE = [
     ),
 ]
 VETTED_ACCEPT_CUTOFF = 40
+STREAM_RENDER_WORKERS = 4  # Questions to render at once when streaming material
+MATERIAL_CACHE_CONTROL = 'private, no-cache'  # Dataframe / UG review changes alter the body at the same URL, so always revalidate with the ETag
 
 
 def material_student_dataframes(ms_arr, student):
@@ -42,50 +64,217 @@ def material_student_dataframes(ms_arr, student):
     return student_dataframes
 
 
-def stage_material(alloc, requested_ids):
-    """Turn list of (mss_id, permutation) or public ID into a structure with both material stats and data"""
+def stage_material_prepare(alloc, requested_ids, live_stats=True):
+    """
+    Turn list of (mss_id, permutation) or public ID into a list of (material_source, permutation)
+    tuples, with corresponding stats & the student dataframes needed to render them
+    - live_stats: Include current answered / correct counts in stats
+    """
     # Given public IDs, make them mss_id/permutation tuples
     if len(requested_ids) > 0 and isinstance(requested_ids[0], str):
-        requested_ids = [alloc.from_public_id(x) for x in requested_ids]
+        requested_ids = alloc.from_public_ids(requested_ids)
 
-    # Turn tuples into DB objects
+    # Turn tuples into DB objects, fetching all in one go
+    mss_ids = set(mss_id for mss_id, permutation in requested_ids)
+    db_mss = dict(
+        (ms.material_source_id, ms)
+        for ms in DBSession.query(Base.classes.material_source).filter(
+            Base.classes.material_source.material_source_id.in_(mss_ids)
+        )
+    ) if len(mss_ids) > 0 else {}
+    missing = [mss_id for mss_id in mss_ids if mss_id not in db_mss]
+    if len(missing) > 0:
+        raise NoResultFound("Unknown material_source_id(s) %s" % ", ".join(str(x) for x in sorted(missing)))
     requested_material = [
-        (DBSession.query(Base.classes.material_source).filter_by(material_source_id=mss_id).one(), permutation)
+        (db_mss[mss_id], permutation)
         for mss_id, permutation in requested_ids
     ]
 
-    out = dict(
-        stats=[
-            dict(
-                uri=alloc.to_public_id(ms.material_source_id, permutation),
-                initial_answered=ms.initial_answered,
-                initial_correct=ms.initial_correct,
-                _type='regular',  # TODO: ...or historical?
-            ) for ms, permutation in requested_material
-        ],
-        data={},
-    )
-    update_stats(alloc, out['stats'])
+    stats = [
+        dict(
+            uri=uri,
+            initial_answered=ms.initial_answered,
+            initial_correct=ms.initial_correct,
+            _type='regular',  # TODO: ...or historical?
+        ) for (ms, permutation), uri in zip(requested_material, alloc.to_public_ids(requested_ids))
+    ]
+    if live_stats:
+        update_stats(alloc, stats)
 
     student_dataframes = material_student_dataframes(
         (ms for ms, _ in requested_material),
         alloc.db_student
     )
-    for ms, permutation in requested_material:
-        rendered = material_render(ms, permutation, student_dataframes[ms.bank])
+    return requested_material, stats, student_dataframes
+
 
+class VettedReview():
+    """Add special review boxes to user-generated questions, if the student is a vetted reviewer"""
+    def __init__(self, alloc):
+        self.alloc = alloc
+        self.is_vetted = None
+
+    def __call__(self, ms, permutation, rendered):
         if 'type.template' in ms.material_tags and permutation < 0:
-            # It's a user-generated question, add in special review boxes for vetted reviewers
-            if student_is_vetted(alloc.db_student, alloc.db_stage):
+            if self.is_vetted is None:
+                self.is_vetted = student_is_vetted(self.alloc.db_student, self.alloc.db_stage)
+            if self.is_vetted:
                 rendered['review_questions'] = VETTED_REVIEW_TEMPLATE + rendered['review_questions']
+        return rendered
+
 
-        out['data'][alloc.to_public_id(ms.material_source_id, permutation)] = rendered
+def stage_material(alloc, requested_ids, live_stats=True):
+    """
+    Turn list of (mss_id, permutation) or public ID into a structure with both material stats and data
+    - live_stats: Include current answered / correct counts in stats
+    """
+    requested_material, stats, student_dataframes = stage_material_prepare(alloc, requested_ids, live_stats)
+    vetted_review = VettedReview(alloc)
+
+    out = dict(stats=stats, data={})
+    new_cache_entries = []
+    for (ms, permutation), stat in zip(requested_material, stats):
+        rendered = material_render(ms, permutation, student_dataframes[ms.bank], new_cache_entries=new_cache_entries)
+        out['data'][stat['uri']] = vetted_review(ms, permutation, rendered)
+
+    # Only cache renders now we're done, so we don't hold any locks whilst rendering
+    render_cache_set(new_cache_entries)
     return out
 
 
+def json_default(obj):
+    """Serialise objects as the pyramid JSON renderer would"""
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+def ndjson_line(obj):
+    """Encode obj as a line of NDJSON"""
+    return (json.dumps(obj, default=json_default) + "\n").encode('utf8')
+
+
+def stage_material_stream(alloc, requested_ids, max_workers=STREAM_RENDER_WORKERS):
+    """
+    As stage_material, but return an iterator of NDJSON lines, one per question,
+    each containing "uri", "stats" and "data". Lines are emitted as soon as each
+    render finishes, so order isn't guaranteed.
+
+    All database work (stats, render cache lookups, user-generated renders) happens
+    up-front, so errors are raised before the response starts. R questions are then
+    rendered concurrently in a thread pool whilst the response is streamed.
+    """
+    requested_material, stats, student_dataframes = stage_material_prepare(alloc, requested_ids)
+    vetted_review = VettedReview(alloc)
+
+    ready = []
+    to_render = []
+    for (ms, permutation), stat in zip(requested_material, stats):
+        dfs = student_dataframes[ms.bank]
+        material_render_check(ms, permutation, dfs)
+
+        if 'type.template' in ms.material_tags and permutation < 0:
+            # User-generated content renders from the DB, so do it now
+            rendered = material_render(ms, permutation, dfs)
+            ready.append(dict(uri=stat['uri'], stats=stat, data=vetted_review(ms, permutation, rendered)))
+            continue
+
+        cache_key = render_cache_key(ms, permutation, dfs)
+        rendered = render_cache_get(cache_key) if cache_key is not None else None
+        if rendered is not None:
+            ready.append(dict(uri=stat['uri'], stats=stat, data=rendered))
+            continue
+
+        # Take a copy of everything the renderer needs, the DB object will be expired by the time we render
+        to_render.append((stat, cache_key, types.SimpleNamespace(
+            material_source_id=ms.material_source_id,
+            bank=ms.bank,
+            path=ms.path,
+            material_tags=list(ms.material_tags),
+            dataframe_paths=list(ms.dataframe_paths),
+            permutation_count=ms.permutation_count,
+        ), permutation, dfs))
+
+    def app_iter():
+        for x in ready:
+            yield ndjson_line(x)
+        if len(to_render) == 0:
+            return
+
+        new_cache_entries = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = dict(
+                (executor.submit(material_render_output, ms, permutation, dfs), (stat, cache_key))
+                for stat, cache_key, ms, permutation, dfs in to_render
+            )
+            for f in concurrent.futures.as_completed(futures):
+                stat, cache_key = futures[f]
+                rendered = f.result()
+                if cache_key is not None and 'error' not in rendered:
+                    new_cache_entries.append((cache_key, rendered))
+                yield ndjson_line(dict(uri=stat['uri'], stats=stat, data=rendered))
+        finally:
+            # NB: If the client went away, don't wait for renders nobody wants
+            executor.shutdown(wait=False)
+
+        # Request transaction is long gone, store new renders in a fresh one
+        if len(new_cache_entries) > 0:
+            with transaction.manager:
+                render_cache_set(new_cache_entries)
+
+    return app_iter()
+
+
+def stage_material_stored(alloc, requested_ids, material_hash):
+    """
+    Return (etag, body) for the stage_material response matching material_hash,
+    generating & storing it if we haven't already
+    """
+    row = DBSession.execute(
+        "SELECT etag, body"
+        "  FROM stage_material_response"
+        " WHERE stage_id = :stage_id"
+        "   AND user_id = :user_id"
+        "   AND material_hash = :material_hash",
+        dict(
+            stage_id=alloc.db_stage.stage_id,
+            user_id=alloc.db_student.user_id,
+            material_hash=material_hash,
+        )
+    ).fetchone()
+    if row is not None:
+        return row[0], row[1]
+
+    # NB: Answer counts change with every answer, so leave them out. Clients get them from stage_index
+    body = json.dumps(stage_material(alloc, requested_ids, live_stats=False), default=json_default)
+    etag = hashlib.sha1(body.encode('utf8')).hexdigest()
+    session = DBSession()  # Get a real session, not just a sessionmaker factory, so we can mark_changed
+    session.execute(
+        "INSERT INTO stage_material_response (stage_id, user_id, material_hash, etag, body)"
+        " VALUES (:stage_id, :user_id, :material_hash, :etag, :body)"
+        " ON CONFLICT (stage_id, user_id) DO UPDATE"
+        "   SET material_hash = EXCLUDED.material_hash, etag = EXCLUDED.etag, body = EXCLUDED.body",
+        dict(
+            stage_id=alloc.db_stage.stage_id,
+            user_id=alloc.db_student.user_id,
+            material_hash=material_hash,
+            etag=etag,
+            body=body,
+        )
+    )
+    mark_changed(session)  # Mark this session changed, so sqlalchemy commits
+    return etag, body
+
+
 def view_stage_material(request):
     """
-    Get one, or all material for a stage
+    Get one, or all material for a stage. Add format=ndjson to stream
+    one question per line as each is rendered. If hash matches the
+    current material selection, the response is stored and can be
+    revalidated with its ETag
     """
     db_stage = get_current_stage(request)
     db_student = get_current_student(request)
@@ -96,6 +285,27 @@ def view_stage_material(request):
         requested_material = [request.params['id']]
     else:
         requested_material = alloc.get_material()
+
+    if request.params.get('hash', None) and not request.params.get('id', None) and request.params.get('format', None) != 'ndjson':
+        material_hash = alloc.material_hash(requested_material)
+        if request.params['hash'] == material_hash:
+            # Hash-addressed material is stored, so caches can revalidate cheaply
+            etag, body = stage_material_stored(alloc, requested_material, material_hash)
+            if etag in request.if_none_match:
+                response = HTTPNotModified()
+            else:
+                response = Response(text=body, content_type='application/json', charset='utf-8')
+            response.etag = etag
+            response.cache_control = MATERIAL_CACHE_CONTROL
+            return response
+        # Otherwise the client has an out-of-date hash, return current material as normal
+
+    if request.params.get('format', None) == 'ndjson':
+        return Response(
+            app_iter=stage_material_stream(alloc, requested_material),
+            content_type='application/x-ndjson',
+            charset='utf-8',
+        )
     return stage_material(alloc, requested_material)
 
 
@@ -13,6 +13,7 @@ from tutorweb_quizdb import DBSession, Base
 INTEGER_SETTINGS = set((
     'allocation_seed',
     'question_cap',
+    'exam_papers',
     'award_lecture_answered',
     'award_lecture_aced',
     'award_tutorial_aced',
@@ -38,6 +39,7 @@ SERVERSIDE_SETTINGS = set((
     'cap_template_qns',
     'cap_template_qn_reviews',
     'question_cap',
+    'exam_papers',
     'award_lecture_answered',
     'ugreview_capfalse',
     'ugreview_captrue',
@@ -46,6 +46,7 @@ from sqlalchemy_utils import Ltree
 from sqlalchemy_utils.types.ltree import LQUERY
 
 from tutorweb_quizdb import DBSession, Base, ACTIVE_HOST
+from tutorweb_quizdb.stage.exam import is_exam_stage, exam_papers_generate
 from tutorweb_quizdb.student import get_group
 
 
@@ -142,15 +143,20 @@ def lec_import(tut_struct):
                         DBSession.flush()
                     continue
             # Add it, let the database worry about bumping version
-            DBSession.add(Base.classes.stage(
+            db_stage = Base.classes.stage(
                 syllabus=db_lec,
                 stage_name=stage_tmpl['name'],
                 title=stage_tmpl['title'],
                 material_tags=material_tags,
                 stage_setting_spec=setting_spec
-            ))
+            )
+            DBSession.add(db_stage)
             DBSession.flush()
 
+            if is_exam_stage(db_stage):
+                # Fix papers before students arrive. Pre-rendering is left to the exam_papers script
+                exam_papers_generate(db_stage)
+
     # Tidy up any unused lectures
     for s in db_lecs.values():
         deleted_id = get_group('admin.deleted', auto_create=True).id